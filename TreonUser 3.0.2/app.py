@@ -1,4 +1,4 @@
-import csv
+import io
 import os
 import uuid
 import json
@@ -7,10 +7,18 @@ import firebase_admin
 from firebase_admin import credentials, firestore, storage
 from datetime import datetime
 from flask import Flask, Response, send_from_directory, render_template, request, jsonify, send_file
-from lip import generate_frames, set_color, capture_frame
+from lip import frame_hub, set_color, capture_frame
+from metrics import pipeline_metrics, stream_stats
+from webrtc_stream import WebRTCStreamer
+from outbox import Outbox
+from catalog import product_catalog
+from session_store import SessionStore
+from event_log import EventLog
+from firestore_batcher import FirestoreBatcher
 import pytz
 import threading
 import atexit
+import importlib.util
 
 # Philippine Timezone
 ph_timezone = pytz.timezone('Asia/Manila')
@@ -49,8 +57,9 @@ firebase_initialized = False
 db = None
 bucket = None
 
-# Global variables to store products data
-products_data = {"brands": [], "shades": []}
+# Products live in the in-process catalog (catalog.py), fed by the Firestore listener below;
+# the warm-start copy serves shades until (or without) Firestore
+product_catalog.load_warm_start()
 products_listener = None
 
 try:
@@ -118,6 +127,41 @@ except Exception as e:
     db = None
     bucket = None
 
+# -------------------------
+# Capture outbox: uploads and metadata writes run off the request, survive restarts and retry
+# -------------------------
+def upload_capture_file(payload, deps):
+    """Outbox 'upload' job: one local capture file -> Storage"""
+    if bucket is None:
+        raise RuntimeError("Storage not available")
+    blob = bucket.blob(payload["remote_path"])
+    blob.upload_from_filename(payload["local_path"])
+    return {"url": blob.public_url, "path": payload["remote_path"]}
+
+def write_capture_metadata(payload, deps):
+    """Outbox 'capture_metadata' job: Firestore capture document, with the URLs of the finished uploads"""
+    if db is None:
+        raise RuntimeError("Firestore not available")
+    lipstick = deps.get("lipstick")
+    mask = deps.get("mask")
+    capture_data = dict(payload)
+    capture_data["timestamp"] = datetime.fromisoformat(payload["timestamp"])
+    capture_data["lipstick_image_url"] = lipstick["url"] if lipstick else None
+    capture_data["mask_image_url"] = mask["url"] if mask else None
+    capture_data["upload_successful"] = lipstick is not None and mask is not None
+    if lipstick and mask:
+        capture_data["storage_paths"] = {"lipstick": lipstick["path"], "mask": mask["path"]}
+    db.collection("captures").document(payload["capture_id"]).set(capture_data)
+    print(f"💾 Capture metadata saved to Firestore for user {payload['user_id']}")
+    return {"document": f"captures/{payload['capture_id']}"}
+
+capture_outbox = Outbox(os.environ.get("TREON_OUTBOX_DB", "outbox.db"),
+                        workers=int(os.environ.get("TREON_OUTBOX_WORKERS", "3")))
+capture_outbox.register("upload", upload_capture_file)
+capture_outbox.register("capture_metadata", write_capture_metadata)
+capture_outbox.start()
+atexit.register(capture_outbox.stop)
+
 # Function to ensure collections exist
 def ensure_collections_exist():
     """Ensure all required collections exist in Firestore"""
@@ -155,72 +199,25 @@ def setup_products_listener():
         print(f"❌ Failed to set up products listener: {e}")
 
 def on_products_update(query_snapshot, changes, read_time):
-    """Callback function when products collection changes"""
-    global products_data
-    
+    """Callback function when products collection changes: apply only the changed documents"""
     try:
-        print("🔄 Products collection updated - processing changes...")
-        
-        # Clear existing data
-        new_brands = []
-        new_shades = []
-        
-        # Process all documents in the collection
-        for doc in query_snapshot:
-            product_data = doc.to_dict()
-            product_data["id"] = doc.id
-            
-            # Organize data by type
-            if product_data.get("type") == "brand":
-                new_brands.append(product_data)
-            elif product_data.get("type") == "shade":
-                new_shades.append(product_data)
-        
-        # Update global data
-        products_data["brands"] = new_brands
-        products_data["shades"] = new_shades
-        
-        print(f"✅ Updated products data: {len(products_data['brands'])} brands, {len(products_data['shades'])} shades")
-        
-        # Update the lip module with new data if it has the capability
-        try:
-            if hasattr(lip, 'update_products'):
-                lip.update_products(products_data)
-                print("✅ Updated lip module with new products data")
-        except Exception as e:
-            print(f"⚠️ Could not update lip module: {e}")
-            
+        print(f"🔄 Products collection updated - {len(changes)} changed document(s)")
+        if product_catalog.apply_changes(changes):
+            # lip.update_products is subscribed to the catalog
+            print(f"✅ Catalog version {product_catalog.version}: {len(product_catalog)} shades")
     except Exception as e:
         print(f"❌ Error processing products update: {e}")
 
 def load_initial_products():
     """Load initial products data from Firestore"""
-    global products_data
-    
     if not firebase_initialized:
         print("❌ Firebase not initialized, cannot load products")
         return
     
     try:
-        products_ref = db.collection('products')
-        docs = products_ref.stream()
-        
-        new_brands = []
-        new_shades = []
-        
-        for doc in docs:
-            product_data = doc.to_dict()
-            product_data["id"] = doc.id
-            
-            if product_data.get("type") == "brand":
-                new_brands.append(product_data)
-            elif product_data.get("type") == "shade":
-                new_shades.append(product_data)
-        
-        products_data["brands"] = new_brands
-        products_data["shades"] = new_shades
-        
-        print(f"✅ Loaded initial products: {len(products_data['brands'])} brands, {len(products_data['shades'])} shades")
+        docs = db.collection('products').stream()
+        product_catalog.replace((doc.id, doc.to_dict() or {}) for doc in docs)
+        print(f"✅ Loaded initial products: {len(product_catalog)} shades (catalog version {product_catalog.version})")
         
     except Exception as e:
         print(f"❌ Failed to load initial products: {e}")
@@ -244,8 +241,43 @@ if firebase_initialized:
 
 app = Flask(__name__, static_folder='.', template_folder='.')
 
-# In-memory sessions
-sessions = {}
+# WebRTC viewers get the same processed frames as /video_feed (optional, needs aiortc)
+webrtc = WebRTCStreamer(frame_hub)
+atexit.register(webrtc.close)
+
+# Client-side compositing viewers get lip geometry over a WebSocket (optional, needs flask-sock)
+if importlib.util.find_spec("flask_sock") is not None:
+    from flask_sock import Sock
+    sock = Sock(app)
+else:
+    sock = None
+    print("⚠️ flask-sock not installed, client-side compositing (/geometry) disabled")
+
+# Ratings, session snapshots and finished sessions: queued, coalesced and batch-committed
+# off the request thread (firestore_batcher.py)
+firestore_writes = FirestoreBatcher(db)
+if firebase_initialized:
+    firestore_writes.start()
+    atexit.register(firestore_writes.stop)
+
+# Ratings / feedback rows: queued by requests, group-committed by one writer thread (event_log.py)
+event_log = EventLog()
+event_log.register("shade_ratings", ["timestamp", "user_id", "brand", "shade_id", "shade_name", "rating"],
+                   mirror_path="shade_ratings.csv")
+event_log.register("feedback", ["timestamp", "user_id", "rating", "comment"], mirror_path="feedback.csv")
+event_log.start()
+atexit.register(event_log.stop)
+
+# Visitor sessions: bounded, idle ones finalized like /end_session, saved to SQLite (session_store.py)
+def expire_session(session):
+    """Finalize a session the visitor walked away from, ending it at their last activity"""
+    ended_at = datetime.fromtimestamp(session.last_activity, ph_timezone)
+    print(f"⌛ Session {session.user_id} idle since {format_display_time(ended_at)}, finalizing")
+    finalize_session(session, ended_at, status="expired")
+
+sessions = SessionStore(os.environ.get("TREON_SESSION_DB", "sessions.db"), on_expire=expire_session)
+sessions.start()
+atexit.register(sessions.stop)
 
 @app.route('/')
 def index():
@@ -253,7 +285,81 @@ def index():
 
 @app.route('/video_feed')
 def video_feed():
-    return Response(generate_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    # Every client subscribes to the shared camera hub (one capture + process per frame);
+    # optional ?max_width=&max_height= cap the resolution, quality adapts to the link below that
+    caps = {}
+    for name in ('max_width', 'max_height'):
+        value = request.args.get(name)
+        if value is None:
+            continue
+        try:
+            caps[name] = int(value)
+        except ValueError:
+            return jsonify({"error": f"Invalid {name}"}), 400
+        if caps[name] < 16:
+            return jsonify({"error": f"{name} must be at least 16"}), 400
+    return Response(frame_hub.subscribe(**caps), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+# Pipeline metrics: Prometheus text by default, JSON with ?format=json or Accept: application/json
+@app.route('/metrics')
+def metrics():
+    wants_json = request.args.get('format') == 'json' or \
+        request.accept_mimetypes.best_match(['text/plain', 'application/json']) == 'application/json'
+    if wants_json:
+        return jsonify(pipeline_metrics.snapshot())
+    return Response(pipeline_metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+# WebRTC signaling: browser POSTs its offer {sdp, type}, gets the answer back
+@app.route('/webrtc/offer', methods=['POST'])
+def webrtc_offer():
+    if not webrtc.available:
+        return jsonify({"error": "WebRTC not available", "fallback": "video_feed"}), 501
+    data = request.get_json(silent=True) or {}
+    if not data.get('sdp'):
+        return jsonify({"error": "Missing sdp"}), 400
+    try:
+        return jsonify(webrtc.offer(data['sdp'], data.get('type', 'offer')))
+    except RuntimeError as e:
+        return jsonify({"error": str(e), "fallback": "video_feed"}), 503
+    except Exception as e:
+        print(f"❌ WebRTC offer failed: {e}")
+        return jsonify({"error": str(e), "fallback": "video_feed"}), 500
+
+# One binary geometry_stream message per processed frame (see geometry_stream.py)
+if sock is not None:
+    @sock.route('/geometry')
+    def geometry_feed(ws):
+        stream = frame_hub.subscribe_geometry()
+        try:
+            for message in stream:
+                ws.send(message)
+        except Exception as e:
+            # client went away (ConnectionClosed) or the socket broke
+            print(f"🔸 Geometry viewer left: {e}")
+        finally:
+            stream.close()
+else:
+    @app.route('/geometry')
+    def geometry_feed():
+        return jsonify({"error": "Client-side compositing not available (pip install flask-sock)",
+                        "fallback": "video_feed"}), 501
+
+# MJPEG vs WebRTC vs geometry side by side: GET the report, POST {transport, delay_ms, lower_bound} from the client
+@app.route('/stream_stats', methods=['GET', 'POST'])
+def stream_stats_route():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        transport = data.get('transport')
+        if transport not in ('mjpeg', 'webrtc', 'geometry'):
+            return jsonify({"error": "Invalid transport"}), 400
+        try:
+            delay_ms = float(data.get('delay_ms'))
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid delay_ms"}), 400
+        stream_stats.observe_latency(transport, delay_ms / 1000.0, side="client",
+                                     lower_bound=bool(data.get('lower_bound')))
+        return ('', 204)
+    return jsonify(stream_stats.report())
 
 @app.route('/set_color/<int:color_id>')
 def set_color_route(color_id):
@@ -273,66 +379,31 @@ def capture():
     if lipstick_path is None or mask_path is None:
         return jsonify({"status": "error", "message": "Capture failed"}), 500
 
-    # Upload images to Firebase Storage and save URLs to Firestore
-    lipstick_url = None
-    mask_url = None
+    # Uploads + metadata go through the outbox; the UI gets the local files right away
     capture_id = str(uuid.uuid4())
     timestamp = get_ph_time()
-    
+    jobs = []
+    if bucket is not None:
+        stamp = timestamp.strftime('%Y%m%d_%H%M%S')
+        jobs.append(("lipstick", "upload", {"local_path": lipstick_path,
+                                            "remote_path": f"captures/{user_id}_{stamp}_lipstick.png"}))
+        jobs.append(("mask", "upload", {"local_path": mask_path,
+                                        "remote_path": f"captures/{user_id}_{stamp}_mask.png"}))
     if firebase_initialized:
-        try:
-            # Generate unique filenames with PH time
-            lipstick_filename = f"captures/{user_id}_{timestamp.strftime('%Y%m%d_%H%M%S')}_lipstick.png"
-            mask_filename = f"captures/{user_id}_{timestamp.strftime('%Y%m%d_%H%M%S')}_mask.png"
-            
-            # Upload to Firebase Storage if available
-            if bucket:
-                try:
-                    # Upload lipstick image
-                    lipstick_blob = bucket.blob(lipstick_filename)
-                    lipstick_blob.upload_from_filename(lipstick_path)
-                    lipstick_url = lipstick_blob.public_url
-                    
-                    # Upload mask image
-                    mask_blob = bucket.blob(mask_filename)
-                    mask_blob.upload_from_filename(mask_path)
-                    mask_url = mask_blob.public_url
-                    
-                    print(f"📸 Images uploaded to Firebase Storage for user {user_id}")
-                except Exception as upload_error:
-                    print(f"⚠️ Storage upload failed: {upload_error}")
-                    # Continue without storage URLs
-            
-            # Save capture metadata to Firestore
-            capture_data = {
-                "capture_id": capture_id,
-                "user_id": user_id,
-                "brand": brand,  # Add brand to capture metadata
-                "timestamp": timestamp,
-                "lipstick_image_url": lipstick_url,
-                "mask_image_url": mask_url,
-                "local_paths": {
-                    "lipstick": lipstick_path,
-                    "mask": mask_path
-                },
-                "storage_available": bucket is not None,
-                "upload_successful": lipstick_url is not None and mask_url is not None
-            }
-            
-            # Add storage paths if upload was successful
-            if lipstick_url and mask_url:
-                capture_data["storage_paths"] = {
-                    "lipstick": lipstick_filename,
-                    "mask": mask_filename
-                }
-            
-            # Save to Firestore - this will automatically create the document
-            db.collection("captures").document(capture_id).set(capture_data)
-            print(f"💾 Capture metadata saved to Firestore for user {user_id}")
-            
-        except Exception as e:
-            print(f"❌ Failed to save capture data: {e}")
-            # Continue to return local paths even if Firebase fails
+        # stage 1: runs once both uploads are done (no storage: without URLs)
+        jobs.append(("metadata", "capture_metadata", {
+            "capture_id": capture_id,
+            "user_id": user_id,
+            "brand": brand,  # Add brand to capture metadata
+            "timestamp": timestamp.isoformat(),
+            "local_paths": {
+                "lipstick": lipstick_path,
+                "mask": mask_path
+            },
+            "storage_available": bucket is not None,
+        }, 1))
+    if jobs:
+        capture_outbox.enqueue(capture_id, jobs)
 
     # Save session snapshot after capture
     save_session_snapshot(user_id)
@@ -342,45 +413,65 @@ def capture():
         "capture_id": capture_id,
         "lipstick_path": f"/{lipstick_path}",
         "mask_path": f"/{mask_path}",
-        "lipstick_url": lipstick_url,
-        "mask_url": mask_url,
+        "upload_status": "queued" if jobs else "local_only",
+        "status_url": f"/captures/{capture_id}/status",
         "user_id": user_id,
         "timestamp": format_ph_time(timestamp)
     })
 
+# Outbox status of one capture's uploads / metadata write
+@app.route('/captures/<capture_id>/status')
+def capture_status(capture_id):
+    status = capture_outbox.status(capture_id)
+    if status is None:
+        return jsonify({"error": "Unknown capture"}), 404
+    return jsonify(status)
+
+# Put a capture's failed jobs back in the queue
+@app.route('/captures/<capture_id>/retry', methods=['POST'])
+def capture_retry(capture_id):
+    return jsonify({"requeued": capture_outbox.retry(capture_id)})
+
+# Whole outbox: job counts by status, oldest pending job age; plus the Firestore write queue
+@app.route('/outbox')
+def outbox_stats():
+    stats = capture_outbox.stats()
+    stats["firestore"] = firestore_writes.stats()
+    return jsonify(stats)
+
 def save_session_snapshot(user_id):
     """Save current session state to Firebase"""
-    if user_id not in sessions:
-        print(f"❌ No active session found for user {user_id}")
-        return
-    
-    if not firebase_initialized:
-        return
-    
-    try:
-        session = sessions[user_id]
+    # edit(): a capture is visitor activity, so it also pushes back the session's expiry
+    with sessions.edit(user_id) as session:
+        if session is None:
+            print(f"❌ No active session found for user {user_id}")
+            return
         now = get_ph_time()
         
         # Prepare session data for snapshot
         session_data = {
             "user_id": user_id,
-            "start_time": session["start_time"],
+            "start_time": session.start_time,
             "last_activity": now,
-            "current_shade_id": session["current_shade_id"],
-            "current_brand": session["current_brand"],
-            "shades_used": session["shades"],
-            "shade_ratings": session.get("shade_ratings", []),
+            "current_shade_id": session.current_shade_id,
+            "current_brand": session.current_brand,
+            "shades_used": list(session.shades),       # copies: the write is committed later
+            "shade_ratings": list(session.shade_ratings),
             "has_captures": True,
             "status": "active",
             "last_updated": firestore.SERVER_TIMESTAMP
         }
-        
-        # Save to active_sessions collection
-        db.collection("active_sessions").document(user_id).set(session_data)
-        print(f"📸 Session snapshot saved for user {user_id}")
+    
+    if not firebase_initialized:
+        return
+    
+    try:
+        # Save to active_sessions collection (queued; newer snapshots of this user replace it)
+        firestore_writes.set(f"active_sessions/{user_id}", session_data)
+        print(f"📸 Session snapshot queued for user {user_id}")
         
     except Exception as e:
-        print(f"⚠️ Failed to save session snapshot: {e}")
+        print(f"⚠️ Failed to queue session snapshot: {e}")
 
 # Test Firebase connection with better error reporting
 @app.route('/test_firebase')
@@ -441,9 +532,11 @@ def firebase_status():
         "project_id": "treondatabase",
         "current_time": format_ph_time(),
         "storage_available": bucket is not None,
-        "products_loaded": len(products_data["brands"]) > 0 or len(products_data["shades"]) > 0,
-        "brands_count": len(products_data["brands"]),
-        "shades_count": len(products_data["shades"])
+        "products_loaded": len(product_catalog) > 0,
+        "brands_count": len(product_catalog.docs_of_type("brand")),
+        "shades_count": len(product_catalog.docs_of_type("shade")),
+        "catalog_version": product_catalog.version,
+        "catalog_source": product_catalog.source
     }
     
     if firebase_initialized:
@@ -484,133 +577,77 @@ def get_user_captures(user_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-# Products API endpoints - UPDATED to return empty data when no products exist
+# Products API endpoints - served from the in-memory catalog, empty data when no products exist
 @app.route('/api/products')
 def get_products():
-    """Get current products data from Firebase"""
-    try:
-        if not firebase_initialized:
-            return jsonify({
-                "status": "success",
-                "message": "Firebase not initialized",
-                "data": []
-            }), 200
-        
-        # Get products from Firebase
-        products_ref = db.collection('products')
-        docs = products_ref.stream()
-        
-        products_data = []
-        for doc in docs:
-            product_data = doc.to_dict()
-            product_data["id"] = doc.id
-            products_data.append(product_data)
-        
-        # If no products, return empty array
-        if not products_data:
-            return jsonify({
-                "status": "success",
-                "data": [],
-                "timestamp": format_ph_time()
-            })
-        
-        # Organize by brand
-        organized_data = {}
-        color_counter = 1  # Start color IDs from 1
-        
-        for product in products_data:
-            brand = product.get("brand", "Unknown")
-            if brand not in organized_data:
-                organized_data[brand] = {
-                    "brand": brand,
-                    "colors": []
-                }
-            
-            # Add colors for this brand (only if colors exist)
-            colors = product.get("colors", [])
-            if colors:
-                for color in colors:
-                    # Ensure we have a valid hex color
-                    hex_color = color.get("hex") or color.get("colorHex") or "#cccccc"
-                    
-                    # Validate hex color format
-                    if not hex_color.startswith('#'):
-                        hex_color = f"#{hex_color}"
-                    
-                    # Ensure 6-digit hex (remove alpha if present)
-                    if len(hex_color) > 7:
-                        hex_color = hex_color[:7]
-                    
-                    organized_data[brand]["colors"].append({
-                        "name": color.get("name", f"Color {color_counter}"),
-                        "hex": hex_color,
-                        "colorHex": hex_color,  # Ensure both fields have the same value
-                        "id": color_counter  # Use sequential IDs
-                    })
-                    color_counter += 1
-        
-        # Filter out brands that have no colors
-        organized_data = {brand: data for brand, data in organized_data.items() if data["colors"]}
-        
-        # Debug output
-        print(f"📦 Sending {sum(len(data['colors']) for data in organized_data.values())} colors to user")
-        
-        return jsonify({
-            "status": "success",
-            "data": list(organized_data.values()),
-            "timestamp": format_ph_time()
-        })
-        
-    except Exception as e:
-        print(f"❌ Error fetching products: {e}")
-        return jsonify({
-            "status": "success",
-            "message": str(e),
-            "data": []
-        }), 200
+    """Current products by brand, with stable shade ids; 304 when the client's ETag is current"""
+    payload, etag = product_catalog.products_payload()
+    if etag and etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+    response = jsonify({
+        "status": "success",
+        "data": payload,
+        "version": product_catalog.version,
+        "timestamp": format_ph_time()
+    })
+    if etag:
+        response.set_etag(etag)
+        # revalidate every time: a shade change must show up on the next load
+        response.headers["Cache-Control"] = "no-cache"
+    return response
 
 @app.route('/api/products/brands')
 def get_brands():
     """Get only brands list"""
-    try:
-        if not firebase_initialized:
-            return jsonify({
-                "status": "success",
-                "brands": [],
-                "timestamp": format_ph_time()
-            }), 200
-            
-        products_ref = db.collection('products')
-        docs = products_ref.stream()
-        
-        brands = set()
-        for doc in docs:
-            product_data = doc.to_dict()
-            brand = product_data.get("brand")
-            if brand:
-                brands.add(brand)
-        
-        return jsonify({
-            "status": "success",
-            "brands": list(brands),
-            "timestamp": format_ph_time()
-        })
-        
-    except Exception as e:
-        return jsonify({
-            "status": "success",
-            "message": str(e),
-            "brands": []
-        }), 200
+    return jsonify({
+        "status": "success",
+        "brands": product_catalog.brand_names(),
+        "timestamp": format_ph_time()
+    })
 
 @app.route('/api/products/shades')
 def get_shades():
     """Get only shades"""
     return jsonify({
         "status": "success",
-        "shades": products_data.get("shades", []),
+        "shades": product_catalog.docs_of_type("shade"),
         "timestamp": format_ph_time()
     })
+
+def sse_event(event, event_id, data):
+    return f"event: {event}\nid: {event_id}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+# Live catalog for kiosks: SSE stream of shade deltas as the products listener fires
+@app.route('/api/products/events')
+def product_events():
+    """
+    'delta' events carry {version, ops} (add / update / remove shade); a 'reset' event carries the
+    whole catalog when the client's version is unknown or too old. The event id is the catalog
+    version, so a reconnecting EventSource resumes from Last-Event-ID (first connect: ?since=).
+    """
+    since = request.headers.get("Last-Event-ID") or request.args.get("since")
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        since = None
+
+    def stream(version):
+        yield "retry: 3000\n\n"
+        while True:
+            deltas = product_catalog.changes_since(version) if version is not None else None
+            if deltas is None:
+                version, payload = product_catalog.snapshot()
+                yield sse_event("reset", version, {"version": version, "data": payload})
+            else:
+                for version, ops in deltas:
+                    yield sse_event("delta", version, {"version": version, "ops": ops})
+            if product_catalog.wait_for_change(version, timeout=15.0) == version:
+                # keeps proxies from closing the idle stream, and notices gone clients
+                yield ": keep-alive\n\n"
+
+    return Response(stream(since), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
         
 # ⭐ Start session when Try-On screen loads - FIXED initialization
 @app.route('/start_session', methods=['POST'])
@@ -618,16 +655,8 @@ def start_session():
     user_id = str(uuid.uuid4())
     start_time = get_ph_time()
 
-    sessions[user_id] = {
-        "start_time": start_time,
-        "end_time": None,
-        "shades": [],
-        "current_shade_id": 1,   # Set default shade ID
-        "current_brand": "MAC",  # Set default brand
-        "current_shade_start": start_time,  # FIXED: Initialize with start time, not None
-        "shade_ratings": [],
-        "feedback": None
-    }
+    # defaults: shade 1, brand MAC, current shade started now
+    sessions.create(user_id, start_time, current_shade_id=1, current_brand="MAC")
 
     print(f"\n🎬 Session started for user {user_id} at {format_display_time(start_time)}")
     return jsonify({"user_id": user_id}), 200
@@ -640,27 +669,18 @@ def log_shade():
     shade_id = data.get("shade_id", 1)  # Default to 1 if no shade provided
     brand = data.get("brand", "MAC")    # Default to MAC if no brand provided
 
-    if user_id not in sessions:
-        return jsonify({"error": "Invalid session"}), 400
-
     now = get_ph_time()
-    session = sessions[user_id]
-
-    # Close previous shade if exists and has start time
-    if session["current_shade_id"] and session["current_shade_start"] is not None:
-        duration = (now - session["current_shade_start"]).total_seconds()
-        session["shades"].append({
-            "shade_id": session["current_shade_id"],
-            "brand": session["current_brand"],
-            "start": session["current_shade_start"],
-            "end": now,
-            "duration_sec": duration
-        })
+    with sessions.edit(user_id) as session:
+        if session is None:
+            return jsonify({"error": "Invalid session"}), 400
 
-    # Start new shade with proper defaults
-    session["current_shade_id"] = shade_id
-    session["current_brand"] = brand
-    session["current_shade_start"] = now
+        # Close previous shade if exists and has start time
+        close_current_shade(session, now)
+
+        # Start new shade with proper defaults
+        session.current_shade_id = shade_id
+        session.current_brand = brand
+        session.current_shade_start = now
 
     print(f"💄 User {user_id} switched to shade {shade_id} ({brand}) at {format_display_time(now)}")
     return jsonify({"message": "Shade logged"}), 200
@@ -671,7 +691,7 @@ def save_session_snapshot_route():
     data = request.get_json()
     user_id = data.get("user_id")
     
-    if user_id not in sessions:
+    if sessions.get(user_id) is None:
         return jsonify({"error": "Invalid session"}), 400
     
     save_session_snapshot(user_id)
@@ -690,25 +710,18 @@ def rate_shade():
     print(f"⭐ Rating received - User: {user_id}, Brand: {brand}, Shade ID: {shade_id}, Shade Name: {shade_name}, Rating: {rating}")
 
     # ✅ Attach rating into the active session
-    if user_id and user_id in sessions:
-        session = sessions[user_id]
-        if "shade_ratings" not in session:
-            session["shade_ratings"] = []
-        session["shade_ratings"].append({
-            "brand": brand,
-            "shade_id": shade_id,
-            "shade_name": shade_name,  # Store shade name
-            "rating": rating,
-            "time": get_ph_time()
-        })
+    with sessions.edit(user_id) as session:
+        if session is not None:
+            session.shade_ratings.append({
+                "brand": brand,
+                "shade_id": shade_id,
+                "shade_name": shade_name,  # Store shade name
+                "rating": rating,
+                "time": get_ph_time()
+            })
 
-    # ✅ Save ratings to CSV for backup
-    file_exists = os.path.isfile("shade_ratings.csv")
-    with open("shade_ratings.csv", mode="a", newline="", encoding="utf-8") as file:
-        writer = csv.writer(file)
-        if not file_exists:
-            writer.writerow(["timestamp", "user_id", "brand", "shade_id", "shade_name", "rating"])
-        writer.writerow([format_ph_time(), user_id, brand, shade_id, shade_name, rating])
+    # ✅ Save ratings to the event log (CSV backup)
+    event_log.append("shade_ratings", format_ph_time(), user_id, brand, shade_id, shade_name, rating)
 
     # ✅ Save rating to Firebase - with proper brand and shade tracking
     if firebase_initialized:
@@ -721,86 +734,54 @@ def rate_shade():
                 "user_id": user_id,
                 "timestamp": firestore.SERVER_TIMESTAMP
             }
-            db.collection("ratings").add(rating_data)
-            print(f"⭐ Rating saved to Firebase - Brand: {brand}, Shade: {shade_name}, Rating: {rating}")
+            firestore_writes.add("ratings", rating_data)
+            print(f"⭐ Rating queued for Firebase - Brand: {brand}, Shade: {shade_name}, Rating: {rating}")
         except Exception as e:
-            print(f"⚠️ Failed to save rating to Firebase: {e}")
+            print(f"⚠️ Failed to queue rating for Firebase: {e}")
 
     print(f"⭐ User {user_id} rated shade {shade_name} ({brand}) with {rating} stars at {format_display_time()}")
     return jsonify({"message": "Rating saved"}), 200
 
-# ⭐ End session at Privacy screen - UPDATED with proper brand and shade storage
-@app.route('/end_session', methods=['POST'])
-def end_session():
-    data = request.get_json()
-    user_id = data.get("user_id")
-    feedback = data.get("feedback")
-
-    if user_id not in sessions:
-        return jsonify({"error": "Invalid session"}), 400
-
-    now = get_ph_time()
-    session = sessions[user_id]
-
-    # Close last shade if active
-    if session["current_shade_id"] and session["current_shade_start"] is not None:
-        duration = (now - session["current_shade_start"]).total_seconds()
-        session["shades"].append({
-            "shade_id": session["current_shade_id"],
-            "brand": session["current_brand"],
-            "start": session["current_shade_start"],
+def close_current_shade(session, now):
+    """Append the shade being worn to the session's history"""
+    if session.current_shade_id and session.current_shade_start is not None:
+        duration = (now - session.current_shade_start).total_seconds()
+        session.shades.append({
+            "shade_id": session.current_shade_id,
+            "brand": session.current_brand,
+            "start": session.current_shade_start,
             "end": now,
             "duration_sec": duration
         })
 
+def finalize_session(session, now, status="completed"):
+    """
+    Close a session that left the store (ended by the visitor, or expired): history, feedback CSV,
+    local JSON file and the Firestore sessions document. Returns the JSON-safe session copy.
+    """
+    user_id = session.user_id
+
+    # Close last shade if active
+    close_current_shade(session, now)
+
     # Attach session end
-    session["end_time"] = now
-    total_duration = (session["end_time"] - session["start_time"]).total_seconds()
-    
-    # Store duration in session for easy access
-    session["duration_sec"] = total_duration
-    session["brand"] = session["current_brand"]  # Store final brand
-    session["shade_id"] = session["current_shade_id"]  # Store final shade ID
+    session.end_time = now
+    total_duration = (session.end_time - session.start_time).total_seconds()
 
-    # ✅ Attach feedback
-    if feedback and not session.get("feedback"):
-        session["feedback"] = {
-            "rating": feedback.get("rating"),
-            "comment": feedback.get("comment"),
-            "time": now
-        }
+    # ✅ Save feedback to the event log only once (keep ISO format for CSV)
+    if session.feedback and not session.feedback.get("saved"):
+        event_log.append("feedback", format_ph_time(), user_id,
+                         session.feedback["rating"], session.feedback["comment"])
+        session.feedback["saved"] = True
+        print(f"📝 Feedback from {user_id} - Rating: {session.feedback['rating']}, Comment: {session.feedback['comment']}")
 
-    # ✅ Save feedback to CSV only once (keep ISO format for CSV)
-    if session.get("feedback") and not session.get("feedback").get("saved"):
-        file_exists = os.path.isfile("feedback.csv")
-        with open("feedback.csv", mode="a", newline="", encoding="utf-8") as file:
-            writer = csv.writer(file)
-            if not file_exists:
-                writer.writerow(["timestamp", "user_id", "rating", "comment"])
-            writer.writerow([
-                format_ph_time(),
-                user_id,
-                session["feedback"]["rating"],
-                session["feedback"]["comment"]
-            ])
-        session["feedback"]["saved"] = True
-        print(f"📝 Feedback from {user_id} - Rating: {session['feedback']['rating']}, Comment: {session['feedback']['comment']}")
-
-    print(f"🛑 Session ended for user {user_id} at {format_display_time(now)} (Duration: {total_duration:.2f} sec)")
-
-    # 🔹 Prepare JSON-safe copy with duration
-    session_copy = session.copy()
-    session_copy["start_time"] = session_copy["start_time"]
-    session_copy["end_time"] = session_copy["end_time"]
-    session_copy["duration_sec"] = total_duration  # Ensure duration is included
-    session_copy["brand"] = session["current_brand"]  # Ensure brand is set
-    session_copy["shade_id"] = session["current_shade_id"]  # Ensure shade_id is set
-    
-    # Convert any datetime objects in shade_ratings
-    if "shade_ratings" in session_copy:
-        for rating in session_copy["shade_ratings"]:
-            if "time" in rating and isinstance(rating["time"], datetime):
-                rating["time"] = rating["time"]
+    print(f"🛑 Session {status} for user {user_id} at {format_display_time(now)} (Duration: {total_duration:.2f} sec)")
+
+    # 🔹 Prepare JSON-safe copy with duration, final brand and shade
+    session_copy = session.to_dict()
+    session_copy["duration_sec"] = total_duration
+    session_copy["brand"] = session.current_brand
+    session_copy["shade_id"] = session.current_shade_id
 
     # ✅ Save session JSON file
     os.makedirs("sessions", exist_ok=True)
@@ -814,38 +795,53 @@ def end_session():
         try:
             firebase_data = session_copy.copy()
             # Convert datetime objects to Firestore timestamps
-            if "start_time" in firebase_data and isinstance(firebase_data["start_time"], datetime):
+            if isinstance(firebase_data.get("start_time"), datetime):
                 firebase_data["start_time"] = firestore.SERVER_TIMESTAMP
-            if "end_time" in firebase_data and isinstance(firebase_data["end_time"], datetime):
+            if isinstance(firebase_data.get("end_time"), datetime):
                 firebase_data["end_time"] = firestore.SERVER_TIMESTAMP
-            
-            # Ensure duration, brand and shade_id are included
-            firebase_data["duration_sec"] = total_duration
-            firebase_data["brand"] = session["current_brand"]
-            firebase_data["shade_id"] = session["current_shade_id"]
-            firebase_data["status"] = "completed"
+            firebase_data["status"] = status
                 
-            # Add any additional processing needed for Firebase
-            db.collection("sessions").add(firebase_data)
-            print(f"🌐 Session sent to Firebase for user {user_id}")
-            
-            # Remove from active sessions
-            try:
-                db.collection("active_sessions").document(user_id).delete()
-                print(f"🗑️ Removed from active sessions: {user_id}")
-            except Exception as e:
-                print(f"⚠️ Could not remove from active sessions: {e}")
+            firestore_writes.add("sessions", firebase_data)
+            # Remove from active sessions (replaces any snapshot still queued)
+            firestore_writes.delete(f"active_sessions/{user_id}")
+            print(f"🌐 Session queued for Firebase for user {user_id}")
                 
         except Exception as e:
-            print("⚠️ Failed to send session to Firebase:", e)
+            print("⚠️ Failed to queue session for Firebase:", e)
+
+    return session_copy
+
+# ⭐ End session at Privacy screen - UPDATED with proper brand and shade storage
+@app.route('/end_session', methods=['POST'])
+def end_session():
+    data = request.get_json()
+    user_id = data.get("user_id")
+    feedback = data.get("feedback")
+
+    # taking it out of the store makes sure it is finalized once (not again by expiry)
+    session = sessions.pop(user_id)
+    if session is None:
+        return jsonify({"error": "Invalid session"}), 400
+
+    now = get_ph_time()
+
+    # ✅ Attach feedback
+    if feedback and not session.feedback:
+        session.feedback = {
+            "rating": feedback.get("rating"),
+            "comment": feedback.get("comment"),
+            "time": now
+        }
+
+    session_copy = finalize_session(session, now)
 
     return jsonify({
         "message": "Session ended",
         "user_id": user_id,
-        "total_duration_sec": total_duration,
+        "total_duration_sec": session_copy["duration_sec"],
         "shades": session_copy["shades"],
-        "shade_ratings": session_copy.get("shade_ratings", []),
-        "feedback": session_copy.get("feedback")
+        "shade_ratings": session_copy["shade_ratings"],
+        "feedback": session_copy["feedback"]
     }), 200
 
 # ⭐ App feedback → save to CSV
@@ -857,26 +853,32 @@ def feedback():
     feedback_text = data.get("feedback_text")
 
     # Track feedback inside session
-    if user_id and user_id in sessions:
-        sessions[user_id]["feedback"] = {
-            "rating": feedback_rating,
-            "comment": feedback_text,
-            "time": get_ph_time()
-        }
+    with sessions.edit(user_id) as session:
+        if session is not None:
+            session.feedback = {
+                "rating": feedback_rating,
+                "comment": feedback_text,
+                "time": get_ph_time()
+            }
 
-    # Save feedback to CSV (keep ISO format for CSV)
-    file_exists = os.path.isfile("feedback.csv")
-    with open("feedback.csv", mode="a", newline="", encoding="utf-8") as file:
-        writer = csv.writer(file)
-        if not file_exists:
-            writer.writerow(["timestamp", "user_id", "rating", "comment"])
-        writer.writerow([format_ph_time(), user_id, feedback_rating, feedback_text])
+    # Save feedback to the event log (keep ISO format for CSV)
+    event_log.append("feedback", format_ph_time(), user_id, feedback_rating, feedback_text)
 
     print(f"📝 Feedback from {user_id} at {format_display_time()} - Rating: {feedback_rating}, Comment: {feedback_text}")
     print("\n\n")
 
     return jsonify({"message": "Feedback saved"}), 200
 
+# Whole event log of one stream (all rotated segments) as a single CSV; ?since=YYYYMMDD
+@app.route('/export/<stream>.csv')
+def export_events(stream):
+    if stream not in ("shade_ratings", "feedback"):
+        return jsonify({"error": "Unknown event stream"}), 404
+    out = io.StringIO()
+    event_log.export_csv(stream, out, since=request.args.get("since"))
+    return Response(out.getvalue(), mimetype="text/csv",
+                    headers={"Content-Disposition": f"attachment; filename={stream}.csv"})
+
 @app.route('/<path:filename>')
 def static_files(filename):
     return send_from_directory('.', filename)
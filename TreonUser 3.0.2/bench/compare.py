@@ -0,0 +1,66 @@
+"""
+Compare two bench/run_bench.py JSON reports (e.g. last release vs this one)
+
+Prints fps and p95 latency side by side for every clip / resolution / segmentation
+combination present in both, and exits with status 1 if any run got slower than
+the allowed tolerance.
+
+Usage:
+    python bench/compare.py bench/results/3.0.1.json bench/results/3.0.2.json --tolerance 5
+"""
+
+import sys
+import json
+import argparse
+
+
+def load_results(path):
+    with open(path, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    keyed = {}
+    for r in report.get("results", []):
+        keyed[(r["clip"], r["resolution"], r["segmentation"])] = r
+    return report.get("meta", {}), keyed
+
+def pct_change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) / old * 100.0
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two TREON benchmark reports")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--tolerance", type=float, default=5.0,
+                        help="allowed fps drop / p95 increase in percent before flagging (default 5)")
+    args = parser.parse_args()
+
+    base_meta, base = load_results(args.baseline)
+    cand_meta, cand = load_results(args.candidate)
+    print(f"baseline:  {base_meta.get('release')} ({base_meta.get('commit')}) {base_meta.get('timestamp')}")
+    print(f"candidate: {cand_meta.get('release')} ({cand_meta.get('commit')}) {cand_meta.get('timestamp')}")
+    if base_meta.get("host", {}).get("platform") != cand_meta.get("host", {}).get("platform"):
+        print("⚠️ Reports come from different hosts — numbers are not directly comparable")
+
+    print(f"\n{'clip':<14}{'size':>11}{'seg':>5}{'fps':>16}{'Δ%':>8}{'p95 ms':>18}{'Δ%':>8}")
+    regressions = 0
+    for key in sorted(set(base) & set(cand)):
+        b, c = base[key], cand[key]
+        fps_delta = pct_change(b["fps"], c["fps"])
+        p95_delta = pct_change(b.get("p95_ms", 0), c.get("p95_ms", 0))
+        slower = fps_delta < -args.tolerance or p95_delta > args.tolerance
+        regressions += slower
+        clip, res, seg = key
+        print(f"{clip:<14}{res:>11}{'on' if seg else 'off':>5}"
+              f"{b['fps']:>8.1f}→{c['fps']:>7.1f}{fps_delta:>+8.1f}"
+              f"{b.get('p95_ms', 0):>9.2f}→{c.get('p95_ms', 0):>8.2f}{p95_delta:>+8.1f}"
+              f"{'  ❌' if slower else ''}")
+
+    missing = set(base) ^ set(cand)
+    if missing:
+        print(f"\n🔸 {len(missing)} run(s) only present in one report were skipped")
+    print(f"\n{'❌' if regressions else '✅'} {regressions} regression(s) beyond {args.tolerance:.1f}%")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Before/after benchmark for the lip-ROI mask path in lip.py
+
+- Runs FaceMesh (+ segmentation if loaded) once per frame of each recorded clip
+- Times the old full-frame post-landmark path (kept below as legacy_apply_lip_mask)
+  against lip.apply_lip_mask on identical inputs
+- Reports mean / p50 / p95 ms per frame and the max pixel difference between both outputs
+
+Usage (run from the TreonUser folder so models/ resolves):
+    python bench/roi_bench.py clips/frontal.mp4 clips/fast_motion.mp4 --size 800x800
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lip  # noqa: E402
+
+
+# -------------------------
+# Legacy full-frame path (as shipped before the ROI change, minus the mask EMA
+# that the landmark filter replaced, so both outputs stay comparable)
+# -------------------------
+def legacy_apply_lip_mask(state, out_frame, crop_mask, lip_box, desired_color):
+    h, w = out_frame.shape[:2]
+    fade_alpha = lip.fade_alpha
+    combined_mask = np.zeros((h, w), dtype=np.float32)
+    if crop_mask is not None:
+        x0, y0, x1, y1 = lip_box
+        combined_mask[y0:y1, x0:x1] = crop_mask
+
+    last_mask_full = state.get("mask")
+    combined_uint8 = (np.clip(combined_mask, 0.0, 1.0) * 255).astype(np.uint8)
+    combined_uint8 = cv2.morphologyEx(combined_uint8, cv2.MORPH_OPEN, lip.MORPH_KERNEL, iterations=1)
+    combined_uint8 = cv2.morphologyEx(combined_uint8, cv2.MORPH_CLOSE, lip.MORPH_KERNEL, iterations=1)
+    combined_blurred = cv2.GaussianBlur(combined_uint8, lip.GAUSSIAN_BLUR_KERNEL, 0).astype(np.float32) / 255.0
+
+    detected_area = (combined_blurred > 0.15).sum()
+    if detected_area > (h * w * 0.0025):
+        last_mask_full = combined_blurred
+    else:
+        if last_mask_full is None:
+            last_mask_full = combined_blurred
+        else:
+            last_mask_full = fade_alpha * last_mask_full + (1-fade_alpha) * combined_blurred
+        last_mask_full[last_mask_full < 0.02] = 0.0
+    state["mask"] = last_mask_full
+
+    if last_mask_full.sum() > 0:
+        overlay = np.zeros_like(out_frame, dtype=np.uint8)
+        overlay[:] = desired_color
+        mask_3ch = np.repeat(np.clip(last_mask_full[:, :, None], 0.0, 1.0), 3, axis=2)
+        feathered = (overlay.astype(np.float32) * mask_3ch + out_frame.astype(np.float32) * (1 - mask_3ch)).astype(np.uint8)
+        blended = cv2.addWeighted(out_frame, 0.7, feathered, 0.3, 0)
+        mask_bool = (mask_3ch > 0.02)
+        out_frame[mask_bool] = blended[mask_bool]
+
+
+
+# -------------------------
+# Benchmark
+# -------------------------
+def load_clip(path, size, max_frames):
+    """Read a clip, mirror + resize every frame to size=(w, h) and run detection once"""
+    cap = cv2.VideoCapture(path)
+    frames = []
+    face = lip.FaceState(0)  # keeps the segmentation cache across frames, like the live pipeline
+    while len(frames) < max_frames:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        frame = cv2.flip(frame, 1)
+        frames.append((frame, lip.detect_lip_mask(frame, face)))
+    cap.release()
+    return frames
+
+def percentile_ms(samples, q):
+    return float(np.percentile(np.array(samples) * 1000.0, q)) if samples else 0.0
+
+def bench_clip(frames, color):
+    legacy_t, roi_t = [], []
+    max_diff = 0
+    legacy_state = {}
+    face = lip.FaceState(0)
+    for frame, (crop_mask, lip_box) in frames:
+        a = frame.copy()
+        t0 = time.perf_counter()
+        legacy_apply_lip_mask(legacy_state, a, crop_mask, lip_box, color)
+        legacy_t.append(time.perf_counter() - t0)
+
+        b = frame.copy()
+        t0 = time.perf_counter()
+        lip.apply_lip_mask(b, face, crop_mask, lip_box, color)
+        roi_t.append(time.perf_counter() - t0)
+
+        max_diff = max(max_diff, int(np.abs(a.astype(np.int16) - b.astype(np.int16)).max()))
+    return legacy_t, roi_t, max_diff
+
+def main():
+    parser = argparse.ArgumentParser(description="Full-frame vs lip-ROI mask path benchmark")
+    parser.add_argument("clips", nargs="+", help="recorded clips (any format OpenCV can read)")
+    parser.add_argument("--size", default="800x800", help="frame size WxH (default 800x800)")
+    parser.add_argument("--frames", type=int, default=300, help="max frames per clip")
+    args = parser.parse_args()
+
+    size = tuple(int(v) for v in args.size.lower().split("x"))
+    lip.SHADE_ENGINE = "flat"  # the legacy path only knows the flat fill, keep outputs comparable
+    color = np.array(lip.rgb_to_bgr((179, 29, 39)), dtype=np.uint8)
+
+    print(f"{'clip':<28}{'frames':>7}{'full ms':>10}{'p95':>8}{'roi ms':>10}{'p95':>8}{'speedup':>9}{'maxdiff':>9}")
+    for path in args.clips:
+        frames = load_clip(path, size, args.frames)
+        if not frames:
+            print(f"⚠️ Could not read {path}")
+            continue
+        legacy_t, roi_t, max_diff = bench_clip(frames, color)
+        full_ms = float(np.mean(legacy_t) * 1000.0)
+        roi_ms = float(np.mean(roi_t) * 1000.0)
+        print(f"{os.path.basename(path):<28}{len(frames):>7}"
+              f"{full_ms:>10.3f}{percentile_ms(legacy_t, 95):>8.3f}"
+              f"{roi_ms:>10.3f}{percentile_ms(roi_t, 95):>8.3f}"
+              f"{full_ms / max(roi_ms, 1e-9):>8.1f}x{max_diff:>9}")
+
+if __name__ == "__main__":
+    main()
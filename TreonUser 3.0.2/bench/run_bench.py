@@ -0,0 +1,203 @@
+"""
+End-to-end benchmark for the TREON try-on pipeline (lip.process_frame + JPEG encode)
+
+- Plays every clip in bench/clips.json headlessly through a frame source (max speed, no loop)
+- Resizes each clip to every configured resolution (640x480, 800x800, 1280x720 by default)
+- Runs each combination with segmentation off and, if a model loads, on
+- Reports throughput (fps) and per-frame latency percentiles, and writes JSON so
+  releases can be compared with bench/compare.py
+
+Usage (run from the TreonUser folder so models/ resolves):
+    python bench/run_bench.py --out bench/results/3.0.2.json
+    python bench/run_bench.py --clips frontal no_face --resolutions 800x800 --no-seg
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+import numpy as np
+import cv2
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, APP_DIR)
+
+import lip  # noqa: E402
+import segmentation  # noqa: E402
+from frame_sources import VideoFileSource  # noqa: E402
+
+
+def load_manifest(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def parse_resolution(text):
+    w, h = text.lower().split("x")
+    return int(w), int(h)
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR,
+                             capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+def host_info():
+    info = {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+    }
+    try:
+        info["mediapipe"] = lip.mp.__version__
+    except Exception:
+        pass
+    if "torch" in sys.modules:
+        info["torch"] = sys.modules["torch"].__version__
+        info["torch_threads"] = sys.modules["torch"].get_num_threads()
+    if segmentation.ORT_AVAILABLE:
+        import onnxruntime
+        info["onnxruntime"] = onnxruntime.__version__
+    return info
+
+def latency_stats(samples):
+    """Summary of per-frame latencies (seconds in, ms out)"""
+    if not samples:
+        return {}
+    ms = np.array(samples) * 1000.0
+    return {
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p90_ms": round(float(np.percentile(ms, 90)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+
+def run_clip(path, size, warmup, max_frames):
+    """Run one clip at one resolution through the full pipeline, return the result dict"""
+    source = VideoFileSource(path, loop=False, realtime=False)
+    lip.reset_pipeline_state()
+    samples = []
+    faces = 0
+    frames = 0
+    try:
+        while frames < warmup + max_frames:
+            ok, frame = source.read()
+            if not ok:
+                break
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+            t0 = time.perf_counter()
+            out_frame = lip.process_frame(frame)
+            jpeg = lip.encode_frame(out_frame)
+            elapsed = time.perf_counter() - t0
+
+            frames += 1
+            if frames <= warmup:
+                continue
+            samples.append(elapsed)
+            if lip.faces_with_mask():
+                faces += 1
+            if jpeg is None:
+                print(f"⚠️ JPEG encode failed on frame {frames} of {path}")
+    finally:
+        source.release()
+
+    total = float(np.sum(samples)) if samples else 0.0
+    result = {
+        "frames": len(samples),
+        "fps": round(len(samples) / total, 2) if total > 0 else 0.0,
+        "mask_ratio": round(faces / len(samples), 3) if samples else 0.0,
+    }
+    result.update(latency_stats(samples))
+    return result
+
+def ensure_segmentation():
+    """Load the segmentation model (or start its worker) synchronously; returns True if it is usable"""
+    if lip.seg_model is None and lip.seg_worker is None:
+        lip.try_load_segmentation()
+    return lip.seg_model is not None or lip.seg_worker is not None
+
+def main():
+    parser = argparse.ArgumentParser(description="TREON try-on pipeline benchmark")
+    parser.add_argument("--manifest", default=os.path.join(BENCH_DIR, "clips.json"))
+    parser.add_argument("--clips", nargs="*", help="clip names to run (default: all in manifest)")
+    parser.add_argument("--resolutions", nargs="*", help="WxH list (default: manifest resolutions)")
+    parser.add_argument("--frames", type=int, help="max measured frames per run")
+    parser.add_argument("--no-seg", action="store_true", help="skip the segmentation-on runs")
+    parser.add_argument("--out", help="write JSON results here (default: bench/results/<timestamp>.json)")
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.manifest)
+    clips = manifest["clips"]
+    if args.clips:
+        clips = [c for c in clips if c["name"] in args.clips]
+    resolutions = [parse_resolution(r) for r in args.resolutions] if args.resolutions \
+        else [tuple(r) for r in manifest["resolutions"]]
+    warmup = manifest.get("warmup_frames", 10)
+    max_frames = args.frames or manifest.get("max_frames", 300)
+
+    seg_modes = [False]
+    if not args.no_seg:
+        if ensure_segmentation():
+            seg_modes.append(True)
+        else:
+            print("🔸 No segmentation model available — running landmark-only benchmarks")
+
+    lip.ADMIN_COLORS = {1: lip.rgb_to_bgr((179, 29, 39))}
+    lip.selected_color_key = 1
+
+    results = []
+    print(f"{'clip':<14}{'size':>11}{'seg':>5}{'frames':>8}{'fps':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for clip in clips:
+        path = os.path.join(BENCH_DIR, clip["file"])
+        if not os.path.exists(path):
+            print(f"⚠️ Missing clip {path} — skipped")
+            continue
+        for size in resolutions:
+            for seg in seg_modes:
+                lip.use_segmentation = seg
+                r = run_clip(path, size, warmup, max_frames)
+                r.update({"clip": clip["name"], "resolution": f"{size[0]}x{size[1]}", "segmentation": seg})
+                results.append(r)
+                print(f"{clip['name']:<14}{r['resolution']:>11}{'on' if seg else 'off':>5}{r['frames']:>8}"
+                      f"{r['fps']:>8.1f}{r.get('p50_ms', 0):>9.2f}{r.get('p95_ms', 0):>9.2f}{r.get('p99_ms', 0):>9.2f}")
+
+    report = {
+        "meta": {
+            "release": os.path.basename(APP_DIR),
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(),
+            "composite_engine": lip.composite_engine,
+            "max_faces": lip.MAX_FACES,
+            "landmark_filter": lip.LANDMARK_FILTER,
+            "seg_interval": lip.SEG_INTERVAL,
+            "seg_input_size": "auto" if lip.seg_input_size is None else "x".join(map(str, lip.seg_input_size)),
+            "seg_worker": lip.seg_worker is not None,
+            "seg_backend": lip.seg_worker.backend if lip.seg_worker is not None else getattr(lip.seg_model, "name", None),
+            "warmup_frames": warmup,
+            "max_frames": max_frames,
+            "host": host_info(),
+        },
+        "results": results,
+    }
+
+    out_path = args.out or os.path.join(BENCH_DIR, "results", datetime.now().strftime("%Y%m%d_%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
+    print(f"💾 Results saved to {out_path}")
+
+if __name__ == "__main__":
+    main()
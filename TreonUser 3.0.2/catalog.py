@@ -0,0 +1,268 @@
+"""
+In-process product catalog, fed by the Firestore products listener
+- One Catalog holds every products document and is updated from the on_snapshot `changes`
+  deltas (added / modified / removed documents), not by re-reading the whole collection
+- Each shade gets a stable integer id keyed by (document id, colour name / position; a name
+  repeated in one document also gets its position), so ids survive catalog edits and restarts;
+  lip.py and /set_color use these ids
+- O(1) lookups from shade id to hex, BGR, name, brand and finish, rebuilt once per version
+- Every content change bumps `version` and recomputes the /api/products payload and its ETag,
+  so requests are served from memory (304 on If-None-Match)
+- A warm-start copy is written to TREON_CATALOG_CACHE (JSON) after each change and loaded at
+  boot, so the kiosk has its shades before Firestore answers, or without it
+- subscribe(fn) calls fn(catalog) after every version change (lip.update_products)
+- Each version also records a compact delta (shade added / updated / removed); the last
+  TREON_CATALOG_HISTORY of them are kept so /api/products/events (SSE) can bring a reconnecting
+  kiosk up to date from its last version instead of sending the whole catalog again
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+CACHE_PATH = os.environ.get("TREON_CATALOG_CACHE", "catalog_cache.json")
+HISTORY = max(1, int(os.environ.get("TREON_CATALOG_HISTORY", "256")))   # deltas kept for resuming clients
+DEFAULT_HEX = "#cccccc"
+
+
+def normalize_hex(hex_color):
+    """'#RRGGBB' from the admin's hex / colorHex field ('#' added, alpha dropped)"""
+    hex_color = (hex_color or DEFAULT_HEX).strip()
+    if not hex_color.startswith('#'):
+        hex_color = f"#{hex_color}"
+    return hex_color[:7].lower()
+
+def hex_to_bgr(hex_color):
+    """'#RRGGBB' / '#RGB' -> (b, g, r), gray for anything else"""
+    digits = hex_color.lstrip('#')
+    if len(digits) == 3:
+        digits = "".join(c * 2 for c in digits)
+    try:
+        r, g, b = (int(digits[i:i + 2], 16) for i in (0, 2, 4))
+    except ValueError:
+        return (204, 204, 204)
+    return (b, g, r) if len(digits) == 6 else (204, 204, 204)
+
+def public_shade(shade):
+    """Shade record as sent to browsers (no BGR)"""
+    return {"id": shade["id"], "name": shade["name"], "hex": shade["hex"],
+            "finish": shade["finish"], "brand": shade["brand"]}
+
+def diff_shades(old, new):
+    """Delta ops turning shade map `old` into `new`"""
+    ops = [{"op": "remove", "id": i} for i in old if i not in new]
+    for i, shade in new.items():
+        if i not in old:
+            ops.append({"op": "add", "shade": public_shade(shade)})
+        elif public_shade(old[i]) != public_shade(shade):
+            ops.append({"op": "update", "shade": public_shade(shade)})
+    return ops
+
+def shade_key(doc_id, color, index, used=()):
+    """
+    Identity of a shade inside its products document: its name, or its position if unnamed.
+    A key already in `used` (same name twice in one document) gets the position appended.
+    """
+    name = (color.get("name") or "").strip().lower()
+    key = f"{doc_id}/{name}" if name else f"{doc_id}/#{index}"
+    while key in used:
+        key = f"{key}#{index}"
+    return key
+
+
+class Catalog:
+    """
+    Usage:
+        catalog = Catalog("catalog_cache.json")
+        catalog.load_warm_start()
+        catalog.replace(docs)                  # initial read: [(doc_id, dict), ...]
+        catalog.apply_changes(changes)         # on_snapshot deltas
+        catalog.shade(7)["name"], catalog.bgr[7]
+        payload, etag = catalog.products_payload()
+        catalog.changes_since(version)         # [(version, ops), ...] or None -> send a snapshot
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._history = deque(maxlen=HISTORY)   # (version, ops), oldest first
+        self._docs = {}             # document id -> products document
+        self._shade_ids = {}        # shade key -> stable id (kept for removed shades too)
+        self._next_id = 1
+        self._subscribers = []
+        self.version = 0
+        self.updated_at = None
+        self.source = "empty"       # "empty", "warm_start" or "firestore"
+        self._set_views({}, [])
+
+    # -------------------------
+    # Lookups (maps are replaced, never mutated, so readers need no lock)
+    # -------------------------
+    def shade(self, shade_id):
+        return self.shades.get(shade_id)
+
+    def docs_of_type(self, kind):
+        with self._lock:
+            return [dict(doc, id=doc_id) for doc_id, doc in sorted(self._docs.items()) if doc.get("type") == kind]
+
+    def brand_names(self):
+        with self._lock:
+            return sorted({doc["brand"] for doc in self._docs.values() if doc.get("brand")})
+
+    def products_payload(self):
+        """(brand list in the /api/products shape, ETag)"""
+        return self.payload, self.etag
+
+    def __len__(self):
+        return len(self.shades)
+
+    # -------------------------
+    # Change feed
+    # -------------------------
+    def snapshot(self):
+        """(version, payload) read together"""
+        with self._lock:
+            return self.version, self.payload
+
+    def changes_since(self, version):
+        """Deltas after `version`, oldest first; None when the history no longer reaches back that far"""
+        with self._lock:
+            if version == self.version:
+                return []
+            if version > self.version or not self._history or self._history[0][0] > version + 1:
+                return None
+            return [(v, ops) for v, ops in self._history if v > version]
+
+    def wait_for_change(self, version, timeout=None):
+        """Block until the catalog moves past `version` (or timeout); returns the current version"""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout=timeout)
+            return self.version
+
+    # -------------------------
+    # Updates
+    # -------------------------
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def replace(self, docs, source="firestore"):
+        """Whole collection: iterable of (doc_id, dict)"""
+        with self._lock:
+            self._docs = {doc_id: data for doc_id, data in docs}
+            return self._rebuild(source)
+
+    def apply_changes(self, changes):
+        """on_snapshot DocumentChange list (the first snapshot delivers every document as ADDED)"""
+        with self._lock:
+            for change in changes:
+                doc = change.document
+                if change.type.name == "REMOVED":
+                    self._docs.pop(doc.id, None)
+                else:
+                    self._docs[doc.id] = doc.to_dict() or {}
+            return self._rebuild("firestore")
+
+    def _rebuild(self, source):
+        """Recompute the views; bump the version and notify only if the payload changed"""
+        shades = {}
+        brands = {}
+        used = set()
+        for doc_id, product in sorted(self._docs.items()):
+            colors = product.get("colors") or []
+            brand = product.get("brand", "Unknown")
+            for index, color in enumerate(colors):
+                key = shade_key(doc_id, color, index, used)
+                used.add(key)
+                shade_id = self._shade_ids.get(key)
+                if shade_id is None:
+                    shade_id = self._shade_ids[key] = self._next_id
+                    self._next_id += 1
+                hex_color = normalize_hex(color.get("hex") or color.get("colorHex"))
+                shades[shade_id] = {
+                    "id": shade_id,
+                    "name": color.get("name", f"Color {shade_id}"),
+                    "hex": hex_color,
+                    "bgr": hex_to_bgr(hex_color),
+                    "brand": brand,
+                    "finish": color.get("finish") or product.get("finish"),  # matte / satin / gloss / sheer
+                }
+                brands.setdefault(brand, []).append(shade_id)
+
+        payload = [{"brand": brand, "colors": [
+            {"name": shades[i]["name"], "hex": shades[i]["hex"], "colorHex": shades[i]["hex"],
+             "finish": shades[i]["finish"], "id": i} for i in ids]} for brand, ids in brands.items()]
+        etag = hashlib.sha1(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        self.source = source
+        if etag == self.etag:
+            return False
+
+        ops = diff_shades(self.shades, shades)
+        self._set_views(shades, payload, etag)
+        self.version += 1
+        self.updated_at = time.time()
+        self._history.append((self.version, ops))
+        self._changed.notify_all()
+        if source != "warm_start":
+            self.save_warm_start()
+        for callback in list(self._subscribers):
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"⚠️ Catalog subscriber failed: {e}")
+        return True
+
+    def _set_views(self, shades, payload, etag=None):
+        self.shades = shades
+        self.hex = {i: s["hex"] for i, s in shades.items()}
+        self.bgr = {i: s["bgr"] for i, s in shades.items()}
+        self.names = {i: s["name"] for i, s in shades.items()}
+        self.brands = {i: s["brand"] for i, s in shades.items()}
+        self.finishes = {i: s["finish"] for i, s in shades.items()}
+        self.payload = payload
+        self.etag = etag
+
+    # -------------------------
+    # Warm start
+    # -------------------------
+    def save_warm_start(self):
+        if not self.path:
+            return
+        with self._lock:
+            state = {"version": self.version, "saved_at": time.time(), "next_id": self._next_id,
+                     "shade_ids": self._shade_ids, "docs": self._docs}
+            tmp = f"{self.path}.tmp"
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    # Firestore timestamps etc. are only kept as text
+                    json.dump(state, f, default=str)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                print(f"⚠️ Could not save catalog warm-start copy: {e}")
+
+    def load_warm_start(self):
+        """Load the last saved catalog (before Firestore is reachable); False if there is none"""
+        if not self.path or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Ignoring unreadable catalog warm-start copy: {e}")
+            return False
+        with self._lock:
+            self._shade_ids = {key: int(i) for key, i in state.get("shade_ids", {}).items()}
+            self._next_id = max([int(state.get("next_id", 1))] + [i + 1 for i in self._shade_ids.values()])
+            self.replace(state.get("docs", {}).items(), source="warm_start")
+            self.version = max(self.version, int(state.get("version", 0)))
+            # no deltas from before the restart: resuming clients get a snapshot
+            self._history.clear()
+        print(f"💾 Catalog warm start: {len(self.shades)} shades (version {self.version})")
+        return True
+
+
+# Process-wide catalog shared by app.py and lip.py
+product_catalog = Catalog()
@@ -0,0 +1,308 @@
+"""
+Append-only event log for ratings / feedback rows (replaces per-request CSV appends in app.py)
+- Request threads only enqueue a row (append()); one writer thread group-commits everything
+  queued every TREON_EVENT_FLUSH seconds: one write (and one fsync) per stream per batch, so
+  concurrent requests can no longer interleave partial rows
+- Each stream is written as CSV segments under TREON_EVENT_LOG/<stream>/<stream>-YYYYMMDD-NNN.<pid>.csv,
+  rotated at midnight and when a segment reaches TREON_EVENT_MAX_BYTES; closed segments are
+  gzip-compressed (.csv.gz), including ones left open by a crash on an earlier day
+- Several processes may log into the same folder (e.g. the Flask debug reloader's parent and the
+  serving child): each only appends to segments it created itself (exclusive create, its pid in the
+  name), and a segment is compressed through a link that never replaces an existing .gz
+- export_csv() stitches every segment back into one CSV with a single header row; the legacy flat
+  files (shade_ratings.csv, feedback.csv) are still appended by the writer thread so the existing
+  spreadsheets keep working (TREON_EVENT_CSV_MIRROR=0 turns that off)
+- Rows a failed segment write did not get to disk go back to the head of the queue and are retried
+  on the next flush; the segments are the record, so a failed mirror append is only counted
+"""
+
+import csv
+import gzip
+import io
+import os
+import re
+import shutil
+import threading
+import time
+from collections import deque
+
+LOG_ROOT = os.environ.get("TREON_EVENT_LOG", "event_log")
+FLUSH_INTERVAL = float(os.environ.get("TREON_EVENT_FLUSH", "1.0"))
+MAX_SEGMENT_BYTES = int(os.environ.get("TREON_EVENT_MAX_BYTES", str(8 * 1024 * 1024)))
+FSYNC = os.environ.get("TREON_EVENT_FSYNC", "1").strip().lower() in ("1", "true", "yes", "on")
+CSV_MIRROR = os.environ.get("TREON_EVENT_CSV_MIRROR", "1").strip().lower() in ("1", "true", "yes", "on")
+
+
+def csv_rows(rows):
+    """Rows -> CSV text (same dialect as csv.writer on a file)"""
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue()
+
+def compress_segment(path):
+    """
+    path.csv -> path.csv.gz, then remove the plain file. The .gz is built under a temporary name and
+    linked into place, so a finished .gz (another process got there first) is never overwritten.
+    """
+    gz_path = path + ".gz"
+    tmp = f"{gz_path}.{os.getpid()}.tmp"
+    try:
+        with open(path, "rb") as src, gzip.open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+    except FileNotFoundError:
+        return  # already compressed and removed by another process
+    try:
+        os.link(tmp, gz_path)
+    except FileExistsError:
+        pass    # same segment, compressed by another process
+    finally:
+        os.remove(tmp)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class EventStream:
+    """One event stream: its columns, current segment and optional legacy CSV mirror"""
+
+    __slots__ = ("name", "columns", "mirror_path", "folder", "day", "seq", "path", "size")
+
+    def __init__(self, name, columns, folder, mirror_path=None):
+        self.name = name
+        self.columns = list(columns)
+        self.mirror_path = mirror_path
+        self.folder = folder
+        self.day = None
+        self.seq = 0
+        self.path = None
+        self.size = 0
+
+
+class EventLog:
+    """
+    Usage:
+        events = EventLog("event_log")
+        events.register("feedback", ["timestamp", "user_id", "rating", "comment"], mirror_path="feedback.csv")
+        events.start()
+        events.append("feedback", ts, user_id, rating, comment)    # never blocks on disk
+        events.export_csv("feedback", fileobj)
+    """
+
+    # owner: pid of the process that created the segment (absent in logs written before it was added)
+    SEGMENT_RE = re.compile(r"^(?P<stream>.+)-(?P<day>\d{8})-(?P<seq>\d{3,})(?:\.(?P<owner>\d+))?\.csv(?P<gz>\.gz)?$")
+
+    def __init__(self, root=LOG_ROOT, flush_interval=FLUSH_INTERVAL, max_bytes=MAX_SEGMENT_BYTES,
+                 fsync=FSYNC, csv_mirror=CSV_MIRROR):
+        self.root = root
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.csv_mirror = csv_mirror
+        self.owner = str(os.getpid())
+        self._streams = {}
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()      # one batch on disk at a time (writer thread / flush())
+        self._thread = None
+        self._running = False
+        self.written = 0
+        self.batches = 0
+        self.errors = 0             # failed segment writes (rows kept for the next flush)
+        self.mirror_errors = 0      # failed legacy CSV mirror appends (those rows are in the segments)
+
+    def register(self, name, columns, mirror_path=None):
+        folder = os.path.join(self.root, name)
+        os.makedirs(folder, exist_ok=True)
+        stream = EventStream(name, columns, folder, mirror_path if self.csv_mirror else None)
+        self._streams[name] = stream
+        self._recover(stream)
+        return stream
+
+    # -------------------------
+    # Producer side
+    # -------------------------
+    def append(self, name, *values):
+        """Queue one row (in column order) for the next group commit"""
+        if name not in self._streams:
+            raise KeyError(f"Unknown event stream '{name}'")
+        with self._cond:
+            self._queue.append((name, values))
+            running = self._running
+        if not running:
+            # no writer thread (scripts / after shutdown): commit right away
+            self.flush()
+
+    def flush(self):
+        """Commit everything queued so far; returns the number of rows written"""
+        with self._write_lock:
+            with self._cond:
+                batch = list(self._queue)
+                self._queue.clear()
+            if not batch:
+                return 0
+            by_stream = {}
+            for name, values in batch:
+                by_stream.setdefault(name, []).append(values)
+            retry = []
+            for name, rows in by_stream.items():
+                stream = self._streams[name]
+                done = self._write(stream, rows)
+                if done < len(rows):
+                    retry.extend((name, values) for values in rows[done:])
+                if done and stream.mirror_path:
+                    self._write_mirror(stream, rows[:done])
+            if retry:
+                with self._cond:
+                    self._queue.extendleft(reversed(retry))   # ahead of rows queued meanwhile, in order
+            self.batches += 1
+            return len(batch) - len(retry)
+
+    # -------------------------
+    # Segments
+    # -------------------------
+    def _segment_path(self, stream, day, seq):
+        return os.path.join(stream.folder, f"{stream.name}-{day}-{seq:03d}.{self.owner}.csv")
+
+    def segments(self, name):
+        """(day, seq, path) of every segment of a stream, oldest first"""
+        stream = self._streams[name]
+        found = []
+        for filename in os.listdir(stream.folder):
+            match = self.SEGMENT_RE.match(filename)
+            if match and match.group("stream") == name:
+                found.append((match.group("day"), int(match.group("seq")), os.path.join(stream.folder, filename)))
+        return sorted(found)
+
+    def _recover(self, stream):
+        """
+        Number new segments after today's existing ones (which may belong to a live process, so they
+        are never reopened); compress open segments left from earlier days
+        """
+        today = time.strftime("%Y%m%d")
+        for day, seq, path in self.segments(stream.name):
+            if day == today:
+                stream.day, stream.seq = day, max(stream.seq, seq)
+            elif not path.endswith(".gz"):
+                compress_segment(path)
+
+    def _rotate(self, stream, day):
+        """Close (and compress) this process's current segment, create the next one"""
+        if stream.path is not None:
+            compress_segment(stream.path)
+            stream.path = None
+        stream.seq = stream.seq if stream.day == day else 0
+        stream.day = day
+        header = csv_rows([stream.columns]).encode("utf-8")
+        while True:
+            stream.seq += 1
+            path = self._segment_path(stream, day, stream.seq)
+            try:
+                f = open(path, "xb")    # never truncate a segment someone else created
+            except FileExistsError:
+                continue
+            with f:
+                f.write(header)
+            break
+        stream.path = path
+        stream.size = len(header)
+
+    def _write(self, stream, rows):
+        """Append rows to the stream's segments; returns how many made it (all unless an OSError)"""
+        day = time.strftime("%Y%m%d")
+        lines = [csv_rows([row]).encode("utf-8") for row in rows]
+        start = 0
+        try:
+            while start < len(lines):
+                if stream.path is None or stream.day != day or stream.size >= self.max_bytes:
+                    self._rotate(stream, day)
+                # as many rows as fit in the current segment (at least one)
+                end, size = start, stream.size
+                while end < len(lines) and (end == start or size + len(lines[end]) <= self.max_bytes):
+                    size += len(lines[end])
+                    end += 1
+                with open(stream.path, "ab") as f:
+                    f.write(b"".join(lines[start:end]))
+                    f.flush()
+                    if self.fsync:
+                        os.fsync(f.fileno())
+                stream.size = size
+                start = end
+        except OSError as e:
+            self.errors += 1
+            print(f"❌ Event log write failed for {stream.name} ({len(rows) - start} rows kept for retry): {e}")
+        self.written += start
+        return start
+
+    def _write_mirror(self, stream, rows):
+        try:
+            new_file = not os.path.isfile(stream.mirror_path)
+            with open(stream.mirror_path, "a", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                if new_file:
+                    writer.writerow(stream.columns)
+                writer.writerows(rows)
+        except OSError as e:
+            self.mirror_errors += 1
+            print(f"⚠️ CSV mirror {stream.mirror_path} not updated ({len(rows)} rows, still in the event log): {e}")
+
+    # -------------------------
+    # Export
+    # -------------------------
+    def export_csv(self, name, out, since=None):
+        """Write every row of a stream (segments from day `since`, "YYYYMMDD", on) as one CSV to `out`"""
+        self.flush()
+        stream = self._streams[name]
+        writer = csv.writer(out)
+        writer.writerow(stream.columns)
+        count = 0
+        for day, seq, path in self.segments(name):
+            if since and day < since:
+                continue
+            opener = gzip.open if path.endswith(".gz") else open
+            with opener(path, "rt", newline="", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                next(reader, None)     # segment header
+                for row in reader:
+                    writer.writerow(row)
+                    count += 1
+        return count
+
+    def stats(self):
+        with self._cond:
+            queued = len(self._queue)
+        return {"queued": queued, "written_total": self.written, "batches_total": self.batches,
+                "errors_total": self.errors, "mirror_errors_total": self.mirror_errors,
+                "flush_interval_sec": self.flush_interval}
+
+    # -------------------------
+    # Writer thread
+    # -------------------------
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="treon-event-log", daemon=True)
+        self._thread.start()
+        print(f"📝 Event log started ({self.root}, flush every {self.flush_interval}s)")
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+            self._thread = None
+        self.flush()
+        if self._queue:
+            print(f"❌ Event log stopped with {len(self._queue)} rows not written")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._running:
+                    self._cond.wait(timeout=self.flush_interval)
+                running = self._running
+            self.flush()
+            if not running:
+                return
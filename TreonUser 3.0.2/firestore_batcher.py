@@ -0,0 +1,255 @@
+"""
+Write-behind Firestore batcher for the request handlers in app.py
+- Handlers enqueue set / add / delete mutations and return; a background flusher commits them
+  through WriteBatch, at most 500 writes per batch (the Firestore limit), every TREON_FS_FLUSH seconds
+- Writes to the same document are coalesced while queued: repeated active_sessions snapshots of a
+  visitor collapse to the newest one, a delete replaces a queued set, a merge-set folds into it
+- Memory is bounded (TREON_FS_MAX_PENDING documents); beyond that the oldest queued write is dropped
+  and counted rather than blocking a request
+- A failed commit puts its writes back (unless newer ones for the same document arrived meanwhile)
+  and the flusher backs off exponentially with jitter; a write that failed max_attempts times is dropped
+- A batch Firestore rejects as invalid (InvalidArgument / FailedPrecondition: one bad document fails
+  the whole batch) is split in halves and recommitted until only the bad writes are left out, and
+  those are dropped rather than retried
+- Queue depth, commit latency and write / coalesce / retry / drop counters go to
+  metrics.pipeline_metrics (served at /metrics)
+"""
+
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import pipeline_metrics
+
+BATCH_LIMIT = 500
+FLUSH_INTERVAL = float(os.environ.get("TREON_FS_FLUSH", "1.0"))
+MAX_PENDING = max(BATCH_LIMIT, int(os.environ.get("TREON_FS_MAX_PENDING", "5000")))
+
+SET, DELETE = "set", "delete"
+# google.api_core.exceptions raised for a bad mutation: retrying the same write cannot succeed
+REJECTED_ERRORS = ("InvalidArgument", "FailedPrecondition")
+
+
+def is_rejected(error):
+    """True if the error means Firestore refused the batch's content (matched by class name, so
+    google.api_core is not needed here)"""
+    return any(cls.__name__ in REJECTED_ERRORS for cls in type(error).__mro__)
+
+
+class Mutation:
+    __slots__ = ("path", "op", "data", "merge", "attempts", "queued_at")
+
+    def __init__(self, path, op, data=None, merge=False):
+        self.path = path
+        self.op = op
+        self.data = data
+        self.merge = merge
+        self.attempts = 0
+        self.queued_at = time.time()
+
+
+class FirestoreBatcher:
+    """
+    Usage:
+        writes = FirestoreBatcher(db)
+        writes.start()
+        writes.set("active_sessions/<user_id>", data)
+        writes.add("ratings", data)                  # new document, id chosen client-side
+        writes.delete("active_sessions/<user_id>")
+    """
+
+    def __init__(self, db, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING,
+                 max_attempts=6, base_delay=1.0, max_delay=60.0):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._pending = OrderedDict()      # document path -> Mutation, oldest first
+        self._cond = threading.Condition()
+        self._commit_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._failures = 0                 # consecutive failed commits
+        self._retry_at = 0.0
+        self.last_error = None
+
+    # -------------------------
+    # Producer side
+    # -------------------------
+    def set(self, path, data, merge=False):
+        self._enqueue(Mutation(path, SET, data, merge))
+
+    def add(self, collection, data):
+        """Like CollectionReference.add, but queued; returns the new document id"""
+        doc_id = self.db.collection(collection).document().id
+        self._enqueue(Mutation(f"{collection}/{doc_id}", SET, data))
+        return doc_id
+
+    def delete(self, path):
+        self._enqueue(Mutation(path, DELETE))
+
+    def _enqueue(self, mutation):
+        with self._cond:
+            queued = self._pending.pop(mutation.path, None)
+            if queued is not None:
+                pipeline_metrics.inc("firestore_coalesced_total")
+                if mutation.op == SET and mutation.merge and queued.op == SET:
+                    # fold a merge into the queued write of the same document
+                    mutation = Mutation(mutation.path, SET, {**queued.data, **mutation.data}, queued.merge)
+                elif mutation.op == SET and queued.op == DELETE:
+                    # delete + merge-set leaves only the merged fields: a plain set
+                    mutation.merge = False
+                mutation.queued_at = queued.queued_at
+            self._pending[mutation.path] = mutation
+            while len(self._pending) > self.max_pending:
+                path, _ = self._pending.popitem(last=False)
+                pipeline_metrics.inc("firestore_dropped_total")
+                print(f"⚠️ Firestore queue full, dropped oldest write to {path}")
+            pipeline_metrics.set_gauge("firestore_queue_depth", len(self._pending))
+            if len(self._pending) >= BATCH_LIMIT:
+                self._cond.notify_all()
+
+    # -------------------------
+    # Commit
+    # -------------------------
+    def _take(self):
+        with self._cond:
+            batch = []
+            while self._pending and len(batch) < BATCH_LIMIT:
+                batch.append(self._pending.popitem(last=False)[1])
+            pipeline_metrics.set_gauge("firestore_queue_depth", len(self._pending))
+            return batch
+
+    def _requeue(self, batch):
+        """Put failed writes back at the front, unless a newer write to the same document is queued"""
+        with self._cond:
+            for mutation in reversed(batch):
+                if mutation.path in self._pending:
+                    continue
+                if mutation.attempts >= self.max_attempts:
+                    pipeline_metrics.inc("firestore_dropped_total")
+                    print(f"❌ Dropping write to {mutation.path} after {mutation.attempts} attempts")
+                    continue
+                self._pending[mutation.path] = mutation
+                self._pending.move_to_end(mutation.path, last=False)
+            pipeline_metrics.set_gauge("firestore_queue_depth", len(self._pending))
+
+    def flush(self):
+        """Commit queued writes in batches of up to 500; returns the number written, stops at a failure"""
+        written = 0
+        with self._commit_lock:
+            while True:
+                batch = self._take()
+                if not batch:
+                    return written
+                for mutation in batch:
+                    mutation.attempts += 1
+                settled = []    # committed or rejected: not to be retried
+                try:
+                    written += self._commit(batch, settled)
+                except Exception as e:
+                    pipeline_metrics.inc("firestore_commit_failures_total")
+                    self._failures += 1
+                    self._retry_at = time.time() + self.backoff(self._failures)
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    settled = {id(m) for m in settled}
+                    retry = [m for m in batch if id(m) not in settled]
+                    print(f"🔄 Firestore batch of {len(retry)} failed ({self.last_error}), retrying")
+                    self._requeue(retry)
+                    return written
+                self._failures = 0
+                self._retry_at = 0.0
+
+    def _commit(self, mutations, settled):
+        """
+        Commit mutations as one WriteBatch; returns the number written. A batch rejected as invalid
+        is bisected so only the offending writes are dropped; other errors propagate.
+        """
+        write_batch = self.db.batch()
+        for mutation in mutations:
+            ref = self.db.document(mutation.path)
+            if mutation.op == DELETE:
+                write_batch.delete(ref)
+            else:
+                write_batch.set(ref, mutation.data, merge=mutation.merge)
+        t0 = time.perf_counter()
+        try:
+            write_batch.commit()
+        except Exception as e:
+            if not is_rejected(e):
+                raise
+            if len(mutations) == 1:
+                pipeline_metrics.inc("firestore_rejected_total")
+                self.last_error = f"{type(e).__name__}: {e}"
+                print(f"❌ Firestore rejected the write to {mutations[0].path} ({self.last_error}), dropped")
+                settled.extend(mutations)
+                return 0
+            half = len(mutations) // 2
+            return self._commit(mutations[:half], settled) + self._commit(mutations[half:], settled)
+        pipeline_metrics.observe("firestore_commit", time.perf_counter() - t0)
+        pipeline_metrics.inc("firestore_writes_total", len(mutations))
+        pipeline_metrics.inc("firestore_batches_total")
+        settled.extend(mutations)
+        return len(mutations)
+
+    def backoff(self, failures):
+        """Exponential backoff with jitter: base * 2^(failures-1), capped, scaled by 0.5..1.0"""
+        delay = min(self.base_delay * (2 ** (failures - 1)), self.max_delay)
+        return delay * random.uniform(0.5, 1.0)
+
+    def stats(self):
+        with self._cond:
+            oldest = next(iter(self._pending.values())).queued_at if self._pending else None
+            return {
+                "queued": len(self._pending),
+                "oldest_queued_s": round(time.time() - oldest, 1) if oldest else 0.0,
+                "consecutive_failures": self._failures,
+                "retry_in_s": round(max(self._retry_at - time.time(), 0.0), 1),
+                "last_error": self.last_error,
+            }
+
+    # -------------------------
+    # Flusher thread
+    # -------------------------
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="treon-firestore-batcher", daemon=True)
+        self._thread.start()
+        print(f"📤 Firestore batcher started (flush every {self.flush_interval}s)")
+
+    def stop(self, timeout=10.0):
+        """Stop the flusher and make a last attempt at whatever is still queued"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"⚠️ Final Firestore flush failed: {e}")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._running:
+                    backoff = self._retry_at - time.time()
+                    if backoff > 0:
+                        self._cond.wait(timeout=backoff)
+                    elif len(self._pending) < BATCH_LIMIT:
+                        self._cond.wait(timeout=self.flush_interval)
+                if not self._running:
+                    return
+            if time.time() < self._retry_at:
+                continue
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️ Firestore flush error: {e}")
@@ -0,0 +1,224 @@
+"""
+Frame sources for the TREON try-on pipeline
+- CameraSource: live webcam (opened lazily, never at import time)
+- VideoFileSource: MP4 / MJPEG / any OpenCV-readable clip, optionally looped, real-time or max speed
+- ImageFolderSource: a directory of stills played as a clip
+- SyntheticSource: generated test pattern (no hardware, no files)
+
+Pick one with a spec string, from config or the TREON_SOURCE environment variable:
+    camera            camera:1?width=1280&height=720
+    file:clips/frontal.mp4?loop=1&realtime=0
+    images:captures/20250918?fps=15
+    synthetic?width=640&height=480&fps=30
+
+Every source has read() -> (ok, frame_bgr) and release(), same as cv2.VideoCapture.
+"""
+
+import os
+import time
+import cv2
+import numpy as np
+from urllib.parse import parse_qs
+
+DEFAULT_SOURCE = "camera:0"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def _truthy(value):
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+class FramePacer:
+    """Sleeps so consecutive frames come out at a fixed fps (no-op when fps is None)"""
+
+    def __init__(self, fps):
+        self.interval = 1.0 / fps if fps and fps > 0 else None
+        self.next_due = None
+
+    def wait(self):
+        if self.interval is None:
+            return
+        now = time.perf_counter()
+        if self.next_due is None or now - self.next_due > 1.0:
+            # first frame, or we fell far behind -> resync instead of bursting
+            self.next_due = now
+        elif self.next_due > now:
+            time.sleep(self.next_due - now)
+        self.next_due += self.interval
+
+
+# -------------------------
+# Sources
+# -------------------------
+class CameraSource:
+    """Live webcam through cv2.VideoCapture (kept at the previous 800x800 @ 60 fps request)"""
+
+    def __init__(self, index=0, width=800, height=800, fps=60):
+        self.index = index
+        self.cap = cv2.VideoCapture(index)
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self.cap.set(cv2.CAP_PROP_FPS, fps)
+        if not self.cap.isOpened():
+            print(f"❌ Could not open camera {index}")
+
+    def read(self):
+        return self.cap.read()
+
+    def release(self):
+        self.cap.release()
+
+    def __repr__(self):
+        return f"CameraSource({self.index})"
+
+
+class VideoFileSource:
+    """Recorded clip; loops by default, paced at the clip's own fps unless realtime=False"""
+
+    def __init__(self, path, loop=True, realtime=True, fps=None):
+        self.path = path
+        self.loop = loop
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            print(f"❌ Could not open video file {path}")
+        clip_fps = fps or self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        self.pacer = FramePacer(clip_fps if realtime else None)
+
+    def _rewind(self):
+        # MJPEG streams often refuse to seek, so reopen if rewinding fails
+        if not self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0):
+            self.cap.release()
+            self.cap = cv2.VideoCapture(self.path)
+
+    def read(self):
+        ok, frame = self.cap.read()
+        if not ok and self.loop:
+            self._rewind()
+            ok, frame = self.cap.read()
+        if ok:
+            self.pacer.wait()
+        return ok, frame
+
+    def release(self):
+        self.cap.release()
+
+    def __repr__(self):
+        return f"VideoFileSource({self.path!r})"
+
+
+class ImageFolderSource:
+    """Directory of stills played in name order, looped by default"""
+
+    def __init__(self, folder, loop=True, realtime=True, fps=30.0):
+        self.folder = folder
+        self.loop = loop
+        self.files = []
+        if os.path.isdir(folder):
+            self.files = sorted(
+                os.path.join(folder, f) for f in os.listdir(folder)
+                if f.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        if not self.files:
+            print(f"❌ No images found in {folder}")
+        self.pos = 0
+        self.pacer = FramePacer(fps if realtime else None)
+
+    def read(self):
+        if not self.files:
+            return False, None
+        if self.pos >= len(self.files):
+            if not self.loop:
+                return False, None
+            self.pos = 0
+        frame = cv2.imread(self.files[self.pos])
+        self.pos += 1
+        if frame is None:
+            return False, None
+        self.pacer.wait()
+        return True, frame
+
+    def release(self):
+        self.files = []
+
+    def __repr__(self):
+        return f"ImageFolderSource({self.folder!r})"
+
+
+class SyntheticSource:
+    """Moving test pattern: gradient background plus a lip-colored ellipse drifting around"""
+
+    def __init__(self, width=800, height=800, fps=30.0, realtime=True):
+        self.width = width
+        self.height = height
+        self.frame_index = 0
+        self.pacer = FramePacer(fps if realtime else None)
+        xs = np.linspace(40, 200, width, dtype=np.float32)
+        ys = np.linspace(60, 180, height, dtype=np.float32)
+        self.background = np.dstack([
+            np.tile(xs, (height, 1)),
+            np.tile(ys[:, None], (1, width)),
+            np.full((height, width), 150, dtype=np.float32),
+        ]).astype(np.uint8)
+
+    def read(self):
+        t = self.frame_index / 30.0
+        frame = self.background.copy()
+        cx = int(self.width * (0.5 + 0.2 * np.sin(t)))
+        cy = int(self.height * (0.6 + 0.1 * np.cos(t * 1.3)))
+        axes = (max(self.width // 10, 4), max(self.height // 25, 2))
+        cv2.ellipse(frame, (cx, cy), axes, 0, 0, 360, (80, 70, 170), -1)
+        cv2.putText(frame, f"TREON synthetic #{self.frame_index}", (10, 30),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+        self.frame_index += 1
+        self.pacer.wait()
+        return True, frame
+
+    def release(self):
+        pass
+
+    def __repr__(self):
+        return f"SyntheticSource({self.width}x{self.height})"
+
+
+# -------------------------
+# Spec parsing
+# -------------------------
+def parse_source_spec(spec):
+    """'kind:target?key=value&...' -> (kind, target, options dict)"""
+    spec = (spec or DEFAULT_SOURCE).strip()
+    query = ""
+    if "?" in spec:
+        spec, query = spec.split("?", 1)
+    kind, _, target = spec.partition(":")
+    options = {k: v[-1] for k, v in parse_qs(query).items()}
+    return kind.strip().lower(), target.strip(), options
+
+
+def open_frame_source(spec=None):
+    """Create a frame source from a spec string (defaults to TREON_SOURCE, then the camera)"""
+    if spec is None:
+        spec = os.environ.get("TREON_SOURCE", DEFAULT_SOURCE)
+    kind, target, opts = parse_source_spec(spec)
+    loop = _truthy(opts.get("loop", "1"))
+    realtime = _truthy(opts.get("realtime", "1"))
+    fps = float(opts["fps"]) if "fps" in opts else None
+
+    if kind in ("camera", "cam", "webcam"):
+        return CameraSource(
+            index=int(target or 0),
+            width=int(opts.get("width", 800)),
+            height=int(opts.get("height", 800)),
+            fps=fps or 60,
+        )
+    if kind in ("file", "video"):
+        return VideoFileSource(target, loop=loop, realtime=realtime, fps=fps)
+    if kind in ("images", "folder", "dir"):
+        return ImageFolderSource(target, loop=loop, realtime=realtime, fps=fps or 30.0)
+    if kind in ("synthetic", "test"):
+        return SyntheticSource(
+            width=int(opts.get("width", 800)),
+            height=int(opts.get("height", 800)),
+            fps=fps or 30.0,
+            realtime=realtime,
+        )
+    raise ValueError(f"Unknown frame source '{spec}'")
@@ -0,0 +1,138 @@
+"""
+Client-side compositing: per-frame lip geometry instead of video
+- The browser shows its own getUserMedia preview and blends the shade itself (script.js);
+  the server only runs landmarks + segmentation and sends, per face, the lip landmarks (int16),
+  the mask bbox, a low-res RLE mask of the feathered lip ROI, the lip velocity and the colour to
+  blend (lip.geometry_shade: with the LUT engine the shade as rendered onto that face's lips)
+- One message per processed frame, shared by every geometry client (FrameHub.subscribe_geometry)
+- Sent over a WebSocket at /geometry (app.py, optional flask-sock: pip install flask-sock)
+
+Message layout (little-endian):
+    header: b"TG", version u8, face count u8, frame width u16, frame height u16,
+            shade B G R u8 x3, opacity u8 (/255), age_ms u16 (capture -> message built)
+    face:   face_id u16, point count u16, bbox x0 y0 x1 y1 i16 x4, velocity vx vy i16 x2 (px/s),
+            mask width u16, mask height u16, rle byte length u32, face colour B G R u8 x3, pad u8,
+            points i16 x 2N, rle bytes as (run length u8, value u8) pairs
+The mask is quantized to MASK_LEVELS levels and scaled by MASK_SCALE; the client stretches it
+back over the bbox. The client blends the face colour flat with alpha opacity * mask: the flat
+engines' blend exactly, the LUT engine's up to the per-pixel texture (the opacity is the finish's).
+"""
+
+import os
+import struct
+import time
+
+import cv2
+import numpy as np
+
+from metrics import stream_stats
+
+GEOMETRY_VERSION = 2
+MASK_SCALE = min(max(float(os.environ.get("TREON_GEOMETRY_MASK_SCALE", "0.5")), 0.1), 1.0)
+MASK_LEVELS = 16                  # quantization of the feathered mask (4 bits)
+
+HEADER = struct.Struct("<2sBBHH3BBH")
+FACE = struct.Struct("<HH4h2hHHI3Bx")
+
+
+def rle_encode(values):
+    """uint8 array -> bytes of (run length u8, value u8) pairs, row-major"""
+    flat = np.ascontiguousarray(values, dtype=np.uint8).ravel()
+    if flat.size == 0:
+        return b""
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.append(starts, flat.size))
+    # runs longer than 255 become several pairs
+    pieces = (lengths + 254) // 255
+    run_values = np.repeat(flat[starts], pieces)
+    run_lengths = np.full(run_values.size, 255, dtype=np.int64)
+    run_lengths[np.cumsum(pieces) - 1] = lengths - 255 * (pieces - 1)
+    out = np.empty(run_values.size * 2, dtype=np.uint8)
+    out[0::2] = run_lengths
+    out[1::2] = run_values
+    return out.tobytes()
+
+def rle_decode(data, shape):
+    """Inverse of rle_encode (used to check messages; script.js has its own decoder)"""
+    pairs = np.frombuffer(data, dtype=np.uint8).reshape(-1, 2)
+    return np.repeat(pairs[:, 1], pairs[:, 0]).reshape(shape)
+
+def quantize_mask(mask_roi):
+    """Float 0..1 mask -> (MASK_SCALE-sized uint8 levels 0..MASK_LEVELS-1)"""
+    h, w = mask_roi.shape[:2]
+    size = (max(1, int(round(w * MASK_SCALE))), max(1, int(round(h * MASK_SCALE))))
+    if size != (w, h):
+        mask_roi = cv2.resize(mask_roi, size, interpolation=cv2.INTER_AREA)
+    return np.rint(np.clip(mask_roi, 0.0, 1.0) * (MASK_LEVELS - 1)).astype(np.uint8)
+
+def face_velocity(face):
+    """Mean lip velocity (px/s) from the face's landmark filter, zeros without one"""
+    lm_filter = face.lm_filter
+    if lm_filter is None:
+        return 0, 0
+    velocity = lm_filter.kalman.vel if lm_filter.kalman is not None else lm_filter.one_euro.dx
+    if velocity is None or velocity.size == 0:
+        return 0, 0
+    vx, vy = np.clip(velocity.mean(axis=0), -32767, 32767)
+    return int(vx), int(vy)
+
+def encode_geometry(face_jobs, frame_shape, color, captured_at, opacity):
+    """
+    One geometry message for a composited FrameJob: reads each face's lip points and colour
+    (FaceJob.shade, else `color`) from the FaceJob and its post-processed mask
+    (mask_roi / mask_box) from the FaceState. `opacity` is the blend weight at full mask.
+    """
+    t0 = time.perf_counter()
+    h, w = frame_shape[:2]
+    parts = []
+    count = 0
+    for fj in face_jobs:
+        face = fj.state
+        if face.mask_box is None and fj.lip_pts is None:
+            continue
+        pts = fj.lip_pts if fj.lip_pts is not None else np.zeros((0, 2), dtype=np.int16)
+        pts = np.clip(pts, -32768, 32767).astype("<i2")
+        if face.mask_box is not None:
+            box = face.mask_box
+            levels = quantize_mask(face.mask_roi)
+            rle = rle_encode(levels)
+            mask_h, mask_w = levels.shape
+        else:
+            box = (0, 0, 0, 0)
+            rle = b""
+            mask_w = mask_h = 0
+        vx, vy = face_velocity(face)
+        face_color = fj.shade[0] if fj.shade is not None else color
+        parts.append(FACE.pack(face.face_id & 0xFFFF, len(pts), *[int(v) for v in box], vx, vy,
+                               mask_w, mask_h, len(rle), *[int(c) for c in face_color]))
+        parts.append(pts.tobytes())
+        parts.append(rle)
+        count += 1
+
+    age_ms = min(int((time.perf_counter() - captured_at) * 1000.0), 0xFFFF)
+    header = HEADER.pack(b"TG", GEOMETRY_VERSION, min(count, 255), w, h,
+                         int(color[0]), int(color[1]), int(color[2]),
+                         int(round(min(max(opacity, 0.0), 1.0) * 255)), age_ms)
+    message = header + b"".join(parts)
+    stream_stats.observe_encode("geometry", time.perf_counter() - t0)
+    return message
+
+def decode_geometry(message):
+    """Parse a geometry message back into a dict (for tests / debugging)"""
+    magic, version, count, w, h, b, g, r, opacity, age_ms = HEADER.unpack_from(message, 0)
+    if magic != b"TG" or version != GEOMETRY_VERSION:
+        raise ValueError("Not a TREON geometry message")
+    offset = HEADER.size
+    result = {"width": w, "height": h, "color": (b, g, r), "opacity": opacity / 255.0,
+              "age_ms": age_ms, "faces": []}
+    for _ in range(count):
+        face_id, n, x0, y0, x1, y1, vx, vy, mask_w, mask_h, rle_len, fb, fg, fr = FACE.unpack_from(message, offset)
+        offset += FACE.size
+        pts = np.frombuffer(message, dtype="<i2", count=2 * n, offset=offset).reshape(n, 2)
+        offset += 4 * n
+        rle = message[offset:offset + rle_len]
+        offset += rle_len
+        mask = rle_decode(rle, (mask_h, mask_w)) if mask_w and mask_h else None
+        result["faces"].append({"face_id": face_id, "points": pts, "box": (x0, y0, x1, y1),
+                                "velocity": (vx, vy), "color": (fb, fg, fr), "mask": mask})
+    return result
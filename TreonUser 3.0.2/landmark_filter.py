@@ -0,0 +1,156 @@
+"""
+Temporal filtering of the lip landmark array
+- OneEuroFilter: adaptive low-pass on the whole (N, 2) array at once; each point's cutoff
+  rises with its own speed, so a still face stays steady and fast motion does not lag
+- VelocityKalman: constant-velocity Kalman filter over every coordinate, used as a cleaner
+  velocity estimate than One-Euro's filtered derivative (one shared 2x2 covariance, since
+  all coordinates see the same model and the same update times)
+- LandmarkFilter ties both together and extrapolates the smoothed points `lead` seconds ahead,
+  so geometry can be predicted for the moment it is displayed rather than when it was captured
+
+Times are perf_counter() seconds (FrameJob.captured_at), positions are pixels.
+"""
+
+import math
+import numpy as np
+
+
+def smoothing_factor(dt, cutoff):
+    """EMA weight of the new sample for a first-order low-pass at `cutoff` Hz (scalar or array)"""
+    tau = 1.0 / (2.0 * math.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
+
+
+class OneEuroFilter:
+    """
+    One-Euro filter (Casiez et al.) vectorized over an (N, 2) point array.
+    min_cutoff (Hz) sets jitter removal at rest, beta how fast the cutoff opens up with speed (px/s).
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=0.02, d_cutoff=1.0):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.reset()
+
+    def reset(self):
+        self.x = None      # (N, 2) filtered positions
+        self.dx = None     # (N, 2) filtered velocity, px/s
+        self.t = None
+
+    def update(self, points, t):
+        points = np.asarray(points, dtype=np.float32)
+        if self.x is None or self.x.shape != points.shape:
+            self.x = points.copy()
+            self.dx = np.zeros_like(points)
+            self.t = t
+            return self.x
+        dt = t - self.t
+        if dt <= 0:
+            return self.x
+        self.t = t
+
+        a_d = smoothing_factor(dt, self.d_cutoff)
+        self.dx += a_d * ((points - self.x) / dt - self.dx)
+
+        speed = np.sqrt((self.dx * self.dx).sum(axis=1, keepdims=True))  # (N, 1), one cutoff per point
+        a = smoothing_factor(dt, self.min_cutoff + self.beta * speed)
+        self.x += a * (points - self.x)
+        return self.x
+
+
+class VelocityKalman:
+    """
+    Constant-velocity Kalman filter on every coordinate of an (N, 2) array.
+    accel_noise is the white-noise acceleration (px/s^2), measurement_noise the landmark
+    jitter (px); the covariance/gain is computed once per frame and shared by all coordinates.
+    """
+
+    def __init__(self, accel_noise=800.0, measurement_noise=1.5):
+        self.q = accel_noise ** 2
+        self.r = measurement_noise ** 2
+        self.reset()
+
+    def reset(self):
+        self.pos = None
+        self.vel = None
+        self.P = None
+        self.t = None
+
+    def update(self, points, t):
+        z = np.asarray(points, dtype=np.float32)
+        if self.pos is None or self.pos.shape != z.shape:
+            self.pos = z.copy()
+            self.vel = np.zeros_like(z)
+            self.P = np.array([[self.r, 0.0], [0.0, 1e4]])
+            self.t = t
+            return self.pos, self.vel
+        dt = t - self.t
+        if dt <= 0:
+            return self.pos, self.vel
+        self.t = t
+
+        # predict
+        F = np.array([[1.0, dt], [0.0, 1.0]])
+        Q = self.q * np.array([[dt ** 4 / 4, dt ** 3 / 2], [dt ** 3 / 2, dt ** 2]])
+        self.pos += self.vel * dt
+        P = F @ self.P @ F.T + Q
+
+        # update (H = [1, 0])
+        s = P[0, 0] + self.r
+        k_pos, k_vel = P[0, 0] / s, P[1, 0] / s
+        innovation = z - self.pos
+        self.pos += k_pos * innovation
+        self.vel += k_vel * innovation
+        self.P = P - np.outer([k_pos, k_vel], P[0])
+        return self.pos, self.vel
+
+
+class LandmarkFilter:
+    """
+    Usage: pts = lm_filter.update(lip_pts, job.captured_at)
+    Returns (N, 2) int32 points smoothed by One-Euro and extrapolated by the current lead,
+    or None when lip_pts is None; state is dropped once the lips were gone for longer than max_gap.
+    predictor: "oneeuro" (velocity from the One-Euro derivative) or "kalman".
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=0.02, d_cutoff=1.0, predictor="oneeuro",
+                 lead=0.0, max_lead=0.15, max_gap=0.5):
+        self.one_euro = OneEuroFilter(min_cutoff, beta, d_cutoff)
+        self.kalman = VelocityKalman() if predictor == "kalman" else None
+        self.lead = lead              # seconds ahead of capture time to predict, or "auto"
+        self.max_lead = max_lead
+        self.max_gap = max_gap        # seconds without lips after which filter state is dropped
+        self.latency = 0.0            # measured capture -> output latency (for lead="auto"), set by lip.record_latency
+        self.reset()
+
+    def reset(self):
+        self.one_euro.reset()
+        if self.kalman is not None:
+            self.kalman.reset()
+        self.last_t = None
+
+    def current_lead(self):
+        lead = self.latency if self.lead == "auto" else self.lead
+        return min(max(float(lead), 0.0), self.max_lead)
+
+    def update(self, points, t):
+        if points is None:
+            return None
+        if self.last_t is not None and t - self.last_t > self.max_gap:
+            self.reset()
+        self.last_t = t
+
+        smoothed = self.one_euro.update(points, t)
+        if self.kalman is not None:
+            _, velocity = self.kalman.update(points, t)
+        else:
+            velocity = self.one_euro.dx
+        return self.predict(smoothed, velocity)
+
+    def predict(self, smoothed, velocity, lead=None):
+        """Smoothed points moved `lead` seconds (default: current_lead()) along their velocity"""
+        lead = self.current_lead() if lead is None else lead
+        if lead > 0:
+            smoothed = smoothed + velocity * lead
+        return np.rint(smoothed).astype(np.int32)
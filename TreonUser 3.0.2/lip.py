@@ -1,9 +1,32 @@
 """
 Hybrid landmark + segmentation lip overlay for TREON
-- Uses MediaPipe FaceMesh each frame to follow facial geometry (landmarks)
-- Uses an optional scripted BiSeNet-style segmentation model (if present in models/)
+- Uses MediaPipe FaceMesh to follow facial geometry (landmarks), every frame or every few frames
+  with Lucas-Kanade optical flow in between (TREON_TRACKING, see tracking.py)
+- Up to TREON_MAX_FACES faces at once, each with its own tracker / filter / mask state (FaceState);
+  all face crops of a frame go through the segmentation model as one batch
+- Uses an optional BiSeNet-style segmentation model (if present in models/, via ONNX Runtime or torch), run every few
+  frames and warped along with the lip landmarks in between (TREON_SEG_INTERVAL, see tracking.py)
+- The model runs in a separate worker process fed through shared memory (TREON_SEG_WORKER, see seg_worker.py),
+  so inference never blocks the render loop
 - Anchors segmentation output to landmark-derived lip bbox so overlay follows movement
-- Uses a translated previous-mask + EMA smoothing (in full-frame coords) to reduce jitter
+- Smooths the lip landmark array with a One-Euro filter (optionally a Kalman velocity predictor) instead
+  of smoothing masks, optionally predicted ahead to display time (TREON_LANDMARK_FILTER, see landmark_filter.py)
+- Mask cleanup, feathering and fade-out are computed only inside a padded lip ROI
+- Shades each product through a baked 3D LAB colour LUT per (shade, finish), kept in an LRU cache
+  (TREON_SHADE, see shade_lut.py); the flat-colour engines remain as TREON_SHADE=flat
+- Composites the flat shade with a fixed-point uint8 engine when it is faster on the host (TREON_COMPOSITE)
+- Frames come from a pluggable source (camera, video file, image folder, synthetic) chosen by TREON_SOURCE
+- Per-stage timings and counters go to metrics.pipeline_metrics (served at /metrics)
+- One FrameHub reads the camera and processes each frame once for all /video_feed clients,
+  optionally as a staged multi-threaded pipeline with drop-oldest queues (TREON_PIPELINE);
+  WebRTC viewers (webrtc_stream.py) take the same processed frames, JPEGs are only encoded for MJPEG viewers
+- Each MJPEG viewer steps its JPEG quality / scale with its own write backpressure, clients on the same
+  tier share one encode (see mjpeg_adapt.py)
+- Client-side compositing mode: /geometry WebSocket viewers get only lip landmarks, bbox and an RLE mask
+  per frame and blend over their own camera preview (see geometry_stream.py); the server skips
+  blending and encoding while no video viewer is connected
+- Shade colours, finishes and names come from the in-process product catalog (catalog.py), which the
+  Firestore listener in app.py keeps current; no HTTP calls back into our own server
 - Public functions kept: generate_frames(), set_color(), capture_frame(), update_products()
 """
 
@@ -11,37 +34,37 @@ import os
 import cv2
 import time
 import uuid
-import requests
 import numpy as np
 from datetime import datetime
 import threading
+from collections import deque
+from frame_sources import open_frame_source, DEFAULT_SOURCE
+from metrics import pipeline_metrics, stream_stats
+from tracking import MultiLipTracker, SegMaskCache
+from landmark_filter import LandmarkFilter
+from segmentation import (
+    MODELS_DIR, SEG_INPUT_SIZE, load_backend, run_segmentation_batch,
+)
+from seg_worker import SegWorkerClient, DEFAULT_SLOTS
+from mjpeg_adapt import JPEG_QUALITY, ClientRateController, VariantCache
+from geometry_stream import encode_geometry
+from shade_lut import FINISHES, ShadeLutCache, apply_shade_lut, normalize_finish, shade_pixel
+from catalog import product_catalog
 
 # MediaPipe (stable landmark detection)
 import mediapipe as mp
 
-# Optional PyTorch for segmentation model
-try:
-    import torch
-    TORCH_AVAILABLE = True
-except Exception:
-    TORCH_AVAILABLE = False
-
 # -------------------------
 # Config / Globals
 # -------------------------
-MODELS_DIR = "models"
-BISENET_CANDIDATES = [
-    os.path.join(MODELS_DIR, "bisenet.pth"),
-    os.path.join(MODELS_DIR, "bisenet.jit"),
-    os.path.join(MODELS_DIR, "bisenet_scripted.pth"),
-    os.path.join(MODELS_DIR, "bisenet_scripted.jit"),
-]
+# Faces tried on at once (friends at the kiosk); FaceMesh cost grows with it, so keep it small
+MAX_FACES = max(1, int(os.environ.get("TREON_MAX_FACES", "1")))
 
 # MediaPipe Face Mesh
 mp_face_mesh = mp.solutions.face_mesh
 face_mesh = mp_face_mesh.FaceMesh(
     static_image_mode=False,
-    max_num_faces=1,
+    max_num_faces=MAX_FACES,
     refine_landmarks=True,
     min_detection_confidence=0.35,
     min_tracking_confidence=0.35
@@ -57,32 +80,66 @@ LIPS = [
 
 # Colors and admin products
 ADMIN_COLORS = {}
+ADMIN_FINISHES = {}            # color id -> finish ("matte", "satin", "gloss", "sheer"), see shade_lut.py
 ADMIN_COLORS_LOADED = False
 selected_color_key = 1
 
-# Video capture (keep your previous settings)
-cap = cv2.VideoCapture(0)
-cap.set(cv2.CAP_PROP_FRAME_WIDTH, 800)
-cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 800)
-cap.set(cv2.CAP_PROP_FPS, 60)
+# Frame source spec (camera / file / images / synthetic, see frame_sources.py).
+# Nothing is opened at import time; the FrameHub opens it when the first viewer connects.
+FRAME_SOURCE = os.environ.get("TREON_SOURCE", DEFAULT_SOURCE)
+
+# Pipeline threading: "staged" (one thread per stage), "serial" (one thread) or "auto" (staged on 4+ cores)
+PIPELINE_MODE = os.environ.get("TREON_PIPELINE", "auto").lower()
+PIPELINE_QUEUE_SIZE = 1        # frames allowed to wait in front of each stage (oldest dropped beyond this)
+
+# Landmark tracking: run FaceMesh every few frames and follow the lips with optical flow in between
+LIP_TRACKING = os.environ.get("TREON_TRACKING", "1").strip().lower() in ("1", "true", "yes", "on")
+lip_tracker = MultiLipTracker(max_faces=MAX_FACES, min_interval=1, max_interval=6 if LIP_TRACKING else 1)
+
+# Landmark smoothing: "oneeuro" (default), "kalman" (One-Euro + constant-velocity Kalman predictor) or "off".
+# TREON_PREDICT_MS extrapolates the landmarks that many ms past capture ("auto" = measured pipeline latency);
+# 0 for frames composited server-side, where the overlay must match the captured frame.
+LANDMARK_FILTER = os.environ.get("TREON_LANDMARK_FILTER", "oneeuro").strip().lower()
+PREDICT_MS = os.environ.get("TREON_PREDICT_MS", "0").strip().lower()
+FILTER_MIN_CUTOFF = float(os.environ.get("TREON_FILTER_MIN_CUTOFF", "1.0"))
+FILTER_BETA = float(os.environ.get("TREON_FILTER_BETA", "0.02"))
+pipeline_latency = 0.0         # EMA of capture -> output latency, seconds (lead for TREON_PREDICT_MS=auto)
 
-# Smoothing / state
-previous_lip_points = None
-smoothing_factor = 0.4  # landmark smoothing (0..1, higher = keep prev)
+# Per-face state, keyed by the tracker's face id
+faces = {}
 last_processed_frame = None
-last_mask_full = None          # last full-frame float mask in [0,1]
-last_mask_center = None        # (cx, cy) center of bbox used to translate prev mask
-ema_alpha = 0.6                # EMA coefficient (higher -> slower changes)
+last_mask_ready = False        # False until the first frame has been processed
+last_frame_blended = True      # False when only geometry viewers were connected (shade not drawn in)
+fade_alpha = 0.6               # per-frame decay of the last mask once lips are lost
+FADE_FRAMES = 10               # frames a lost face is kept for its mask to fade out (0.6 ** 10 < 0.02)
 
 # Segmentation model related
-seg_model = None
-seg_device = torch.device("cpu") if TORCH_AVAILABLE else None
-seg_input_size = (512, 512)  # model input size (H, W)
+seg_model = None               # in-process inference backend (segmentation.TorchBackend / OnnxBackend)
+seg_input_size = SEG_INPUT_SIZE  # model input size (H, W), None = letterboxed per-crop size buckets
 use_segmentation = False
+# Out-of-process inference (seg_worker.py) by default; TREON_SEG_WORKER=0 runs the model in this process
+SEG_WORKER = os.environ.get("TREON_SEG_WORKER", "1").strip().lower() in ("1", "true", "yes", "on")
+SEG_WORKER_THREADS = max(1, int(os.environ.get("TREON_SEG_THREADS", "2")))
+seg_worker = None
+seg_loader = None              # model loader thread, started with the frame pipeline (FrameHub)
+# Segmentation cadence: run the model at most every N frames (sooner if the lips move / deform a lot),
+# piecewise-affine warp the last model mask onto the landmarks in between. 1 = every frame.
+SEG_INTERVAL = max(1, int(os.environ.get("TREON_SEG_INTERVAL", "4")))
 
 # Morphology and feathering
 MORPH_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
 GAUSSIAN_BLUR_KERNEL = (9, 9)
+# Border kept around the lip bbox so morphology/blur near the ROI edge match full-frame results
+ROI_MARGIN = 16
+
+# Overlay compositing engine: "int" (fixed-point uint8), "float" (original) or "auto" (fastest on this host)
+COMPOSITE_MODE = os.environ.get("TREON_COMPOSITE", "auto").lower()
+composite_engine = None        # resolved engine name once calibrated
+# Shade rendering: "lut" (per-shade LAB colour LUT, luminance preserving) or "flat" (fill + 0.7/0.3 blend)
+SHADE_ENGINE = os.environ.get("TREON_SHADE", "lut").strip().lower()
+shade_luts = ShadeLutCache()
+FLAT_OPACITY = 0.3             # flat engines: out = src + 0.3 * mask * (shade - src)
+_premult_tables = {}           # shade BGR -> (256, 1, 3) uint16 premultiplied color table
 
 # -------------------------
 # Helpers: color conversions
@@ -90,138 +147,51 @@ GAUSSIAN_BLUR_KERNEL = (9, 9)
 def rgb_to_bgr(rgb):
     return (rgb[2], rgb[1], rgb[0])
 
-def hex_to_bgr(hex_color):
-    """Convert hex color string to BGR tuple"""
-    if not hex_color or hex_color == '#cccccc':
-        return (204, 204, 204)  # Default gray
-    hex_color = hex_color.lstrip('#')
-    if len(hex_color) == 6:
-        r = int(hex_color[0:2], 16)
-        g = int(hex_color[2:4], 16)
-        b = int(hex_color[4:6], 16)
-    elif len(hex_color) == 3:
-        r = int(hex_color[0]*2, 16)
-        g = int(hex_color[1]*2, 16)
-        b = int(hex_color[2]*2, 16)
-    else:
-        return (204, 204, 204)
-    return (b, g, r)
-
 # -------------------------
 # Attempt to load segmentation model (non-blocking thread)
 # -------------------------
 def try_load_segmentation():
-    global seg_model, seg_device, use_segmentation, seg_input_size
-    if not TORCH_AVAILABLE:
-        print("🔸 PyTorch not available — skipping segmentation model load.")
-        use_segmentation = False
-        return
-
-    # Prefer CUDA if available
-    if torch.cuda.is_available():
-        seg_device = torch.device("cuda")
-    else:
-        seg_device = torch.device("cpu")
-
-    # Check if models directory exists and has any .pth files
-    if not os.path.exists(MODELS_DIR):
-        print(f"❌ Models directory '{MODELS_DIR}' not found")
-        use_segmentation = False
-        return
-
-    # Find all .pth files in models directory
-    pth_files = [f for f in os.listdir(MODELS_DIR) if f.endswith('.pth')]
-    
-    if not pth_files:
-        print("❌ No .pth files found in models directory")
-        use_segmentation = False
-        return
-
-    print(f"🔍 Found {len(pth_files)} model files: {pth_files}")
-
-    # Try loading each .pth file
-    for model_file in pth_files:
-        model_path = os.path.join(MODELS_DIR, model_file)
-        try:
-            print(f"🔄 Attempting to load {model_file}...")
-            
-            # Try to load as a traced/scripted model first
-            try:
-                model = torch.jit.load(model_path, map_location=seg_device)
-                model_type = "scripted"
-            except:
-                # If that fails, try loading as a regular PyTorch model
-                try:
-                    checkpoint = torch.load(model_path, map_location=seg_device)
-                    
-                    # Handle different checkpoint formats
-                    if isinstance(checkpoint, torch.nn.Module):
-                        model = checkpoint
-                    elif 'state_dict' in checkpoint:
-                        # This is likely a BiSeNet model
-                        from models import BiSeNet  # You might need to import your model class
-                        model = BiSeNet(n_classes=19)  # Adjust based on your model
-                        model.load_state_dict(checkpoint['state_dict'])
-                    else:
-                        # Try to use the checkpoint directly as state_dict
-                        model = BiSeNet(n_classes=19)  # Adjust based on your model
-                        model.load_state_dict(checkpoint)
-                    
-                    model_type = "regular"
-                except Exception as e:
-                    print(f"⚠️ Failed to load {model_file} as regular model: {e}")
-                    continue
-            
-            model.to(seg_device)
-            model.eval()
-            seg_model = model
-            use_segmentation = True
-            print(f"✅ Successfully loaded {model_type} model from {model_file}")
+    global seg_model, use_segmentation, seg_worker
+    if SEG_WORKER:
+        if not os.path.exists(MODELS_DIR):
+            print(f"❌ Models directory '{MODELS_DIR}' not found")
+            use_segmentation = False
             return
-            
-        except Exception as e:
-            print(f"❌ Failed to load {model_file}: {e}")
-            continue
+        worker = SegWorkerClient(slots=DEFAULT_SLOTS * MAX_FACES, threads=SEG_WORKER_THREADS,
+                                 input_size=seg_input_size, models_dir=MODELS_DIR)
+        worker.start()
+        if worker.wait_ready():
+            seg_worker = worker
+            use_segmentation = True
+        else:
+            worker.stop()
+            use_segmentation = False
+        return
 
-    print("❌ No usable segmentation model found from any .pth file")
-    use_segmentation = False
+    seg_model = load_backend(MODELS_DIR, input_size=seg_input_size)
+    use_segmentation = seg_model is not None
 
-# Launch model loader in background so app starts quickly
-threading.Thread(target=try_load_segmentation, daemon=True).start()
+def start_segmentation_loader():
+    """
+    Load the model in the background, once, when the frame pipeline first starts: not at import,
+    so a process that never serves frames (the Flask debug reloader's parent) never loads a model
+    or spawns a worker
+    """
+    global seg_loader
+    if seg_loader is None and seg_model is None and seg_worker is None:
+        seg_loader = threading.Thread(target=try_load_segmentation, daemon=True)
+        seg_loader.start()
 
 # -------------------------
-# Admin color loading (kept from your app)
+# Admin colors: views of the product catalog (catalog.py)
 # -------------------------
 def load_admin_colors():
-    """Load colors from admin API"""
-    global ADMIN_COLORS, ADMIN_COLORS_LOADED
-    try:
-        response = requests.get('http://localhost:5000/api/products', timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('status') == 'success':
-                products = data.get('data', [])
-                ADMIN_COLORS = {}
-                color_id = 1
-                for brand in products:
-                    colors = brand.get('colors', [])
-                    for color in colors:
-                        hex_color = color.get('hex') or color.get('colorHex')
-                        if hex_color:
-                            bgr_color = hex_to_bgr(hex_color)
-                            ADMIN_COLORS[color_id] = bgr_color
-                            print(f"🎨 Loaded color {color_id}: {color.get('name')} -> {hex_color} -> BGR{bgr_color}")
-                            color_id += 1
-                ADMIN_COLORS_LOADED = True
-                print(f"✅ Loaded {len(ADMIN_COLORS)} colors from admin")
-                if not ADMIN_COLORS:
-                    setup_fallback_colors()
-            else:
-                setup_fallback_colors()
-        else:
-            setup_fallback_colors()
-    except Exception as e:
-        print(f"❌ Failed to load admin colors: {e}")
+    """Load colors from the product catalog (its warm-start copy if Firestore has not answered yet)"""
+    if not len(product_catalog):
+        product_catalog.load_warm_start()
+    if len(product_catalog):
+        update_products(product_catalog)
+    else:
         setup_fallback_colors()
 
 def setup_fallback_colors():
@@ -233,60 +203,50 @@ def setup_fallback_colors():
         3: rgb_to_bgr((144, 93, 85)),     # Brown
     }
     ADMIN_COLORS = fallback_colors
+    ADMIN_FINISHES.clear()
     ADMIN_COLORS_LOADED = False
+    warm_shade_luts()
 
-def update_products(products_data):
-    """Update colors when admin changes products"""
-    global ADMIN_COLORS
-    try:
-        ADMIN_COLORS = {}
-        color_id = 1
-        for brand in products_data:
-            colors = brand.get('colors', [])
-            for color in colors:
-                hex_color = color.get('hex') or color.get('colorHex')
-                if hex_color:
-                    bgr_color = hex_to_bgr(hex_color)
-                    ADMIN_COLORS[color_id] = bgr_color
-                    color_id += 1
-        print(f"🔄 Updated {len(ADMIN_COLORS)} colors from admin")
-    except Exception as e:
-        print(f"❌ Failed to update colors: {e}")
+def update_products(catalog=product_catalog):
+    """Update colors when admin changes products (catalog subscriber, called once per catalog version)"""
+    global ADMIN_COLORS, ADMIN_FINISHES, ADMIN_COLORS_LOADED
+    if not catalog.bgr:
+        setup_fallback_colors()
+        return
+    ADMIN_COLORS = dict(catalog.bgr)
+    ADMIN_FINISHES = {i: normalize_finish(finish) for i, finish in catalog.finishes.items()}
+    ADMIN_COLORS_LOADED = True
+    print(f"🔄 Updated {len(ADMIN_COLORS)} colors from catalog version {catalog.version}")
+    warm_shade_luts()
+
+product_catalog.subscribe(update_products)
+
+def warm_shade_luts():
+    """Bake the selected shade first, then the catalog in order, as far as the LUT cache holds"""
+    if SHADE_ENGINE != "lut":
+        return
+    ids = [selected_color_key] + [i for i in ADMIN_COLORS if i != selected_color_key]
+    shade_luts.warm([(ADMIN_COLORS[i], ADMIN_FINISHES.get(i)) for i in ids if i in ADMIN_COLORS])
 
 # -------------------------
-# set_color kept as before
+# set_color
 # -------------------------
 def set_color(color_id):
     global selected_color_key
     selected_color_key = color_id
+    if SHADE_ENGINE == "lut" and color_id in ADMIN_COLORS:
+        # bake off the render path if this shade fell out of the LUT cache
+        shade_luts.prefetch(ADMIN_COLORS[color_id], ADMIN_FINISHES.get(color_id))
 
-    # Get color name for logging (best-effort)
-    color_name = "Unknown"
-    try:
-        response = requests.get('http://localhost:5000/api/products', timeout=2)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('status') == 'success':
-                products = data.get('data', [])
-                current_id = 1
-                for brand in products:
-                    colors = brand.get('colors', [])
-                    for color in colors:
-                        if current_id == color_id:
-                            color_name = color.get('name', 'Unknown')
-                            break
-                        current_id += 1
-    except:
-        pass
-
+    color_name = product_catalog.names.get(color_id, "Unknown")
     print(f"🎨 Set color to ID {color_id} ({color_name})")
 
 # -------------------------
 # Capture function (kept behavior)
 # -------------------------
 def capture_frame(user_id=None):
-    global last_processed_frame, last_mask_full
-    if last_processed_frame is None or last_mask_full is None:
+    global last_processed_frame
+    if last_processed_frame is None or not last_mask_ready:
         return None, None
 
     if user_id is None:
@@ -300,263 +260,918 @@ def capture_frame(user_id=None):
     lipstick_path = os.path.join(save_dir, f"{user_id}_lipstick_{timestamp}.jpg")
     mask_path = os.path.join(save_dir, f"{user_id}_mask_{timestamp}.png")
 
-    # Save lipstick-applied frame
-    cv2.imwrite(lipstick_path, last_processed_frame)
+    # Save lipstick-applied frame (geometry-only viewers: blend the kept masks in now)
+    frame = last_processed_frame if last_frame_blended else blend_saved_masks(last_processed_frame.copy())
+    cv2.imwrite(lipstick_path, frame)
 
     # Save mask as single-channel PNG (0..255)
-    mask_to_save = (np.clip(last_mask_full, 0.0, 1.0) * 255).astype(np.uint8) if last_mask_full is not None else None
-    if mask_to_save is not None:
-        cv2.imwrite(mask_path, mask_to_save)
-    else:
-        h, w, _ = last_processed_frame.shape
-        cv2.imwrite(mask_path, np.zeros((h, w), dtype=np.uint8))
+    h, w, _ = last_processed_frame.shape
+    mask_to_save = (np.clip(get_last_mask_full(h, w), 0.0, 1.0) * 255).astype(np.uint8)
+    cv2.imwrite(mask_path, mask_to_save)
 
     return lipstick_path, mask_path
 
 # -------------------------
-# Model preprocessing / postprocessing helpers
+# Lip ROI helpers (all mask work happens inside a padded lip bbox)
 # -------------------------
-def preprocess_for_model(img_bgr, size):
-    """Resize and normalize to 0..1, CHW, return torch tensor if available"""
-    img = cv2.resize(img_bgr, (size[1], size[0]), interpolation=cv2.INTER_LINEAR)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    img = img.astype(np.float32) / 255.0
-    img = np.transpose(img, (2, 0, 1))  # CHW
-    img = np.expand_dims(img, 0).copy()  # 1,C,H,W
-    if TORCH_AVAILABLE:
-        tensor = torch.from_numpy(img).to(seg_device)
-        return tensor
-    return img
-
-def postprocess_mask(mask_pred, target_size):
+def paste_into(dst, src, x0, y0):
+    """Copy src into dst with its top-left at (x0, y0), clipping to dst bounds"""
+    if src is None or src.size == 0:
+        return
+    dh, dw = dst.shape[:2]
+    sh, sw = src.shape[:2]
+    dx0, dy0 = max(x0, 0), max(y0, 0)
+    dx1, dy1 = min(x0 + sw, dw), min(y0 + sh, dh)
+    if dx1 <= dx0 or dy1 <= dy0:
+        return
+    dst[dy0:dy1, dx0:dx1] = src[dy0 - y0:dy1 - y0, dx0 - x0:dx1 - x0]
+
+def trim_mask(mask, x0, y0):
+    """Crop a ROI mask to its non-zero bbox. Returns (crop, box) or (None, None) if empty"""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None, None
+    cols = np.flatnonzero(mask.any(axis=0))
+    r0, r1 = rows[0], rows[-1] + 1
+    c0, c1 = cols[0], cols[-1] + 1
+    return mask[r0:r1, c0:c1].copy(), (x0 + c0, y0 + r0, x0 + c1, y0 + r1)
+
+def get_last_mask_full(h, w):
+    """Rebuild the last masks of every face as one full-frame float array (used by capture)"""
+    mask_full = np.zeros((h, w), dtype=np.float32)
+    for face in list(faces.values()):
+        box, roi = face.mask_box, face.mask_roi
+        if box is None:
+            continue
+        x0, y0, x1, y1 = box
+        # faces never overlap much, but keep the stronger mask where they do
+        np.maximum(mask_full[y0:y1, x0:x1], roi, out=mask_full[y0:y1, x0:x1])
+    return mask_full
+
+def blend_saved_masks(frame):
+    """Blend the current shade into frame with every face's last mask, in place"""
+    color = get_desired_color()
+    finish = get_desired_finish()
+    for face in list(faces.values()):
+        if face.mask_box is not None:
+            x0, y0, x1, y1 = face.mask_box
+            blend_color(frame[y0:y1, x0:x1], face.mask_roi, color, finish)
+    return frame
+
+def faces_with_mask():
+    """Number of faces currently showing a mask"""
+    return sum(1 for face in list(faces.values()) if face.mask_box is not None)
+
+# -------------------------
+# Per-face state
+# -------------------------
+class FaceState:
+    """Everything kept between frames for one tracked face"""
+    __slots__ = ("face_id", "lm_filter", "seg_cache", "mask_roi", "mask_box", "missed")
+
+    def __init__(self, face_id):
+        self.face_id = face_id
+        self.lm_filter = make_landmark_filter()
+        self.seg_cache = SegMaskCache(interval=SEG_INTERVAL, move_thresh=12.0, deform_thresh=0.06)
+        self.mask_roi = None       # last mask in [0,1], cropped to its non-zero bbox
+        self.mask_box = None       # (x0, y0, x1, y1) of mask_roi in full-frame coords
+        self.missed = 0            # frames since the tracker last reported this face
+
+def make_landmark_filter():
+    if LANDMARK_FILTER not in ("oneeuro", "kalman"):
+        return None
+    lm_filter = LandmarkFilter(
+        min_cutoff=FILTER_MIN_CUTOFF,
+        beta=FILTER_BETA,
+        predictor=LANDMARK_FILTER,
+        lead="auto" if PREDICT_MS == "auto" else float(PREDICT_MS) / 1000.0,
+    )
+    lm_filter.latency = pipeline_latency
+    return lm_filter
+
+def record_latency(seconds):
+    """End-to-end latency of one frame: metrics, plus the lead used for landmark prediction"""
+    global pipeline_latency
+    pipeline_metrics.observe("total", seconds)
+    pipeline_latency = 0.9 * pipeline_latency + 0.1 * seconds if pipeline_latency else seconds
+    for face in list(faces.values()):
+        if face.lm_filter is not None:
+            face.lm_filter.latency = pipeline_latency
+
+# -------------------------
+# Frame source selection
+# -------------------------
+def set_frame_source(spec):
+    """Switch the frame source (takes effect the next time the hub starts)"""
+    global FRAME_SOURCE
+    FRAME_SOURCE = spec
+    print(f"📷 Frame source set to {spec}")
+
+def reset_pipeline_state():
+    """Forget every face (masks, filters, tracking) and the last frame (new clip / new source)"""
+    global last_processed_frame, last_mask_ready
+    last_processed_frame = None
+    last_mask_ready = False
+    lip_tracker.reset()
+    faces.clear()
+
+# -------------------------
+# Core pipeline: process_frame
+# -------------------------
+def get_desired_color():
+    """Return the currently selected shade as a BGR uint8 array"""
+    if selected_color_key in ADMIN_COLORS:
+        return np.array(ADMIN_COLORS[selected_color_key], dtype=np.uint8)
+    if ADMIN_COLORS:
+        return np.array(list(ADMIN_COLORS.values())[0], dtype=np.uint8)
+    return np.array([179, 29, 39], dtype=np.uint8)
+
+def get_desired_finish():
+    """Finish of the currently selected shade (shade_lut.DEFAULT_FINISH if the product has none)"""
+    key = selected_color_key if selected_color_key in ADMIN_COLORS else next(iter(ADMIN_COLORS), None)
+    return normalize_finish(ADMIN_FINISHES.get(key))
+
+def process_frame(frame):
     """
-    Convert a model output into a single-channel normalized mask resized to target_size (H,W).
-    Accepts torch.Tensor or numpy arrays. If multi-channel, tries argmax to pick class.
+    Run the full try-on pipeline on one raw camera frame.
+    Returns the processed (mirrored, lipstick-applied) BGR frame.
     """
-    if TORCH_AVAILABLE and isinstance(mask_pred, torch.Tensor):
-        arr = mask_pred.detach().cpu().numpy()
-    else:
-        arr = np.array(mask_pred)
-
-    # Normalize shape possibilities
-    # If arr shape is (1, C, H, W) or (C, H, W) -> choose class index
-    if arr.ndim == 4 and arr.shape[0] == 1:
-        arr = arr[0]
-    if arr.ndim == 3:
-        # arr: (C, H, W) -> pick argmax along C if C>1 else squeeze
-        if arr.shape[0] > 1:
-            mask = np.argmax(arr, axis=0).astype(np.float32)
+    return process_job(FrameJob(frame)).frame
+
+def process_job(job, blend=True):
+    """All stages but encoding on one FrameJob, back to back; blend=False only updates the masks"""
+    global last_processed_frame, last_frame_blended
+
+    # the mask is fully built before compositing, so blending in place on the mirrored frame is safe
+    run_landmark_stage(job)
+    run_mask_stage(job)
+    run_composite_stage(job, blend)
+
+    # Save last processed frame for capture endpoint
+    last_processed_frame = job.frame.copy()
+    last_frame_blended = blend
+    return job
+
+# -------------------------
+# Pipeline stages (run back to back by process_frame, or on separate threads by the hub)
+# -------------------------
+class FrameJob:
+    """One camera frame travelling through the pipeline stages"""
+    __slots__ = ("frame", "captured_at", "faces", "jpeg", "geometry")
+
+    def __init__(self, frame, captured_at=None):
+        self.frame = frame
+        self.captured_at = captured_at if captured_at is not None else time.perf_counter()
+        self.faces = []            # FaceJob per tracked (or fading) face
+        self.jpeg = None
+        self.geometry = None       # geometry_stream message, while geometry viewers exist
+
+class FaceJob:
+    """One face of a FrameJob: its state plus this frame's lip points and mask"""
+    __slots__ = ("state", "lip_pts", "crop_mask", "lip_box", "lip_crop", "shade")
+
+    def __init__(self, state, lip_pts=None):
+        self.state = state
+        self.lip_pts = lip_pts
+        self.crop_mask = None
+        self.lip_box = None
+        self.lip_crop = None
+        self.shade = None          # (BGR, opacity) for geometry clients, see geometry_shade()
+
+def run_landmark_stage(job):
+    """Mirror the frame and find every lip polygon (FaceMesh, or optical flow between detections), then smooth them"""
+    job.frame = cv2.flip(job.frame, 1)  # mirror
+    tracked = lip_tracker.update(job.frame, detect_all_lip_points)
+
+    seen = set()
+    for face_id, pts in tracked:
+        face = faces.get(face_id)
+        if face is None:
+            face = faces[face_id] = FaceState(face_id)
+        face.missed = 0
+        if face.lm_filter is not None:
+            pts = face.lm_filter.update(pts, job.captured_at)
+        job.faces.append(FaceJob(face, pts))
+        seen.add(face_id)
+
+    # faces that just left keep compositing (without lips) until their mask faded out
+    for face_id, face in list(faces.items()):
+        if face_id in seen:
+            continue
+        face.missed += 1
+        if face.missed > FADE_FRAMES:
+            del faces[face_id]
         else:
-            mask = arr[0].astype(np.float32)
-    else:
-        mask = arr.astype(np.float32)
+            job.faces.append(FaceJob(face))
+    return job
+
+def run_mask_stage(job):
+    """Segmentation (batched over faces, or fillPoly fallback) -> lip mask in crop coords per face"""
+    build_lip_masks(job.frame, job.faces)
+    pipeline_metrics.inc("frames_total")
+    if any(fj.lip_box is not None for fj in job.faces):
+        pipeline_metrics.inc("frames_with_face_total")
+    return job
+
+def run_composite_stage(job, blend=True):
+    """Cleanup, feathering and blending, one lip ROI pass per face (stateful: frames must arrive in order)"""
+    global last_mask_ready
+    color = get_desired_color()
+    finish = get_desired_finish()
+    for fj in job.faces:
+        if fj.crop_mask is not None and frame_hub.wants_geometry:
+            # from the unshaded pixels, before this face is blended
+            x0, y0, x1, y1 = fj.lip_box
+            fj.shade = geometry_shade(job.frame[y0:y1, x0:x1], fj.crop_mask, color, finish)
+        apply_lip_mask(job.frame, fj.state, fj.crop_mask, fj.lip_box, color, blend, finish)
+    last_mask_ready = True
+    return job
+
+def run_geometry_stage(job):
+    job.geometry = encode_geometry(job.faces, job.frame.shape, get_desired_color(), job.captured_at,
+                                   shade_opacity(get_desired_finish()))
+    return job
+
+def run_encode_stage(job):
+    job.jpeg = encode_frame(job.frame)
+    return job if job.jpeg is not None else None
+
+def detect_lip_mask(frame, face=None):
+    """
+    Run FaceMesh (and the segmentation model if loaded) on a mirrored frame, first face only.
+    Returns (crop_mask, lip_box); crop_mask is float 0..1 sized to
+    lip_box = (x0, y0, x1, y1). Both are None when no lips are found.
+    face (a FaceState) carries the segmentation cache between calls.
+    """
+    fj = FaceJob(face if face is not None else FaceState(0), detect_lip_points(frame))
+    build_lip_masks(frame, [fj])
+    return fj.crop_mask, fj.lip_box
+
+def detect_all_lip_points(frame):
+    """Run FaceMesh on a mirrored frame, return the LIPS polygon of every face as a list of (N, 2) int32"""
+    h, w, _ = frame.shape
+
+    # Run MediaPipe to get face landmarks (always)
+    t0 = time.perf_counter()
+    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    mp_results = face_mesh.process(rgb)
+    pipeline_metrics.observe("landmarks", time.perf_counter() - t0)
+
+    if not mp_results.multi_face_landmarks:
+        return []
+    size = np.array([w, h], dtype=np.float32)
+    all_pts = []
+    for face_lms in mp_results.multi_face_landmarks:
+        # Lip polygon points in full-frame coords
+        lms = face_lms.landmark
+        idx = [i for i in LIPS if i < len(lms)]
+        # If too few points, ignore
+        if len(idx) < 3:
+            continue
+        xy = np.array([(lms[i].x, lms[i].y) for i in idx], dtype=np.float32)
+        all_pts.append((xy * size).astype(np.int32))
+    return all_pts
+
+def detect_lip_points(frame):
+    """Run FaceMesh on a mirrored frame, return the first face's LIPS polygon as (N, 2) int32 or None"""
+    all_pts = detect_all_lip_points(frame)
+    return all_pts[0] if all_pts else None
 
-    # Normalize mask to 0..1
-    if mask.max() > 1.0:
-        mask = (mask - mask.min()) / (mask.max() - mask.min() + 1e-8)
+def warp_cached_mask(face, lip_pts_arr, lip_box):
+    """Last segmentation mask of this face warped onto its current landmarks, or None"""
+    if face.seg_cache.mask is None:
+        return None
+    t0 = time.perf_counter()
+    try:
+        crop_mask = face.seg_cache.warp_to(lip_pts_arr, lip_box)
+    except Exception:
+        crop_mask = None
+    pipeline_metrics.observe("seg_warp", time.perf_counter() - t0)
+    if crop_mask is not None:
+        pipeline_metrics.inc("segmentation_warped_total")
+    return crop_mask
+
+def inline_lip_masks(face_jobs):
+    """
+    In-process model (TREON_SEG_WORKER=0): faces due for a refresh go through the model as one
+    batch, every other face gets its last mask warped onto the current landmarks
+    """
+    due = []
+    for fj in face_jobs:
+        cache = fj.state.seg_cache
+        if not cache.needs_refresh(fj.lip_pts):
+            fj.crop_mask = warp_cached_mask(fj.state, fj.lip_pts, fj.lip_box)
+        if fj.crop_mask is None:
+            due.append(fj)
+    if not due:
+        return
+
+    t0 = time.perf_counter()
+    try:
+        masks = run_segmentation_batch(seg_model, [fj.lip_crop for fj in due], seg_input_size)
+    except Exception as e:
+        # segmentation failed for this frame; keep None and fallback to landmarks
+        masks = [None] * len(due)
+    pipeline_metrics.observe("segmentation", time.perf_counter() - t0)
+    pipeline_metrics.inc("segmentation_batches_total")
+    for fj, crop_mask in zip(due, masks):
+        pipeline_metrics.inc("segmentation_runs_total")
+        if crop_mask is None:
+            pipeline_metrics.inc("segmentation_fallbacks_total")
+            fj.state.seg_cache.clear()
+        else:
+            fj.state.seg_cache.store(crop_mask, fj.lip_box, fj.lip_pts)
+        fj.crop_mask = crop_mask
+
+def worker_lip_masks(face_jobs):
+    """
+    Worker process path: pick up the newest finished masks, hand the worker one batch with every
+    face whose cached mask is due for a refresh and that has no crop in the worker yet (submit()
+    skips those, so a face is not resubmitted every frame while its mask is computed), and warp
+    whatever we have onto this frame. Never waits on inference.
+    """
+    results = seg_worker.poll()
+    for fj in face_jobs:
+        result = results.get(fj.state.face_id)
+        if result is not None:
+            fj.state.seg_cache.store(*result)
+    due = [(fj.state.face_id, fj.lip_crop, fj.lip_box, fj.lip_pts)
+           for fj in face_jobs if fj.state.seg_cache.needs_refresh(fj.lip_pts)]
+    if due:
+        seg_worker.submit(due)
+    for fj in face_jobs:
+        fj.crop_mask = warp_cached_mask(fj.state, fj.lip_pts, fj.lip_box)
+
+def build_lip_masks(frame, face_jobs):
+    """
+    Lip mask for every face with a lip polygon: segmentation model inside each padded lip bbox
+    if available (all due faces in one batch; between model runs the face's last mask warped
+    onto its current landmarks), fillPoly of the landmarks otherwise.
+    Sets crop_mask / lip_box on each FaceJob; both stay None for faces without lips this frame.
+    """
+    h, w, _ = frame.shape
+    visible = [fj for fj in face_jobs if fj.lip_pts is not None]
+    for fj in visible:
+        # Compute bounding box for the lips polygon and add padding
+        xs = fj.lip_pts[:, 0]
+        ys = fj.lip_pts[:, 1]
+        min_x = max(int(xs.min()) - 8, 0)
+        max_x = min(int(xs.max()) + 8, w - 1)
+        min_y = max(int(ys.min()) - 6, 0)
+        max_y = min(int(ys.max()) + 6, h - 1)
+
+        # Crop the lip bbox region for segmentation inference (if possible)
+        fj.lip_crop = frame[min_y:max_y+1, min_x:max_x+1]
+        if fj.lip_crop.size == 0:
+            fj.lip_crop = frame.copy()
+        # remember where crop_mask sits in full-frame coords
+        fj.lip_box = (min_x, min_y, max_x + 1, max_y + 1)
+
+    # Segmentation path (if model available): worker process, or in-process model
+    if visible and use_segmentation and seg_worker is not None and not seg_worker.gave_up:
+        worker_lip_masks(visible)
+    elif visible and use_segmentation and seg_model is not None:
+        inline_lip_masks(visible)
+
+    # Landmark-only fallback mask inside bbox
+    for fj in visible:
+        fj.lip_crop = None  # view into the frame; not needed past this stage
+        if fj.crop_mask is not None:
+            continue
+        min_x, min_y, x1, y1 = fj.lip_box
+        bbox_w, bbox_h = x1 - min_x, y1 - min_y
+        # Build polygon relative coordinates for crop
+        rel_pts = fj.lip_pts - np.array([min_x, min_y])
+        poly_mask_crop = np.zeros((bbox_h, bbox_w), dtype=np.uint8)
+        if rel_pts.shape[0] >= 3:
+            cv2.fillPoly(poly_mask_crop, [rel_pts.astype(np.int32)], 255)
+            fj.crop_mask = (poly_mask_crop.astype(np.float32) / 255.0)
+        else:
+            fj.crop_mask = np.zeros((bbox_h, bbox_w), dtype=np.float32)
+
+def apply_lip_mask(out_frame, face, crop_mask, lip_box, desired_color, blend=True, finish=None):
+    """
+    Post-landmark path for one face: morphology, feathering and color blend of its current
+    mask (temporal stability comes from the landmark filter), with a short fade-out once
+    the lips are lost. Works on a padded ROI around the current lip bbox and the face's
+    previous mask only; out_frame is modified in place inside it (unless blend=False,
+    which only updates face.mask_roi / mask_box for client-side compositing).
+    """
+    t0 = time.perf_counter()
+    h, w = out_frame.shape[:2]
+
+    # Working ROI: union of current lip bbox and previous mask
+    boxes = []
+    if lip_box is not None:
+        boxes.append(lip_box)
+    if face.mask_box is not None:
+        boxes.append(face.mask_box)
+    if not boxes:
+        # nothing detected and nothing left to fade out
+        pipeline_metrics.observe("mask", time.perf_counter() - t0)
+        return
+
+    rx0 = max(min(b[0] for b in boxes) - ROI_MARGIN, 0)
+    ry0 = max(min(b[1] for b in boxes) - ROI_MARGIN, 0)
+    rx1 = min(max(b[2] for b in boxes) + ROI_MARGIN, w)
+    ry1 = min(max(b[3] for b in boxes) + ROI_MARGIN, h)
+    roi_h, roi_w = ry1 - ry0, rx1 - rx0
+
+    combined_mask = np.zeros((roi_h, roi_w), dtype=np.float32)
+    if crop_mask is not None:
+        paste_into(combined_mask, crop_mask, lip_box[0] - rx0, lip_box[1] - ry0)
+
+    # Postprocess combined_mask: morphology + blur + thresholding
+    combined_uint8 = (np.clip(combined_mask, 0.0, 1.0) * 255).astype(np.uint8)
+    # remove noise small speckles
+    combined_uint8 = cv2.morphologyEx(combined_uint8, cv2.MORPH_OPEN, MORPH_KERNEL, iterations=1)
+    combined_uint8 = cv2.morphologyEx(combined_uint8, cv2.MORPH_CLOSE, MORPH_KERNEL, iterations=1)
+    # feather edges
+    combined_blurred = cv2.GaussianBlur(combined_uint8, GAUSSIAN_BLUR_KERNEL, 0).astype(np.float32) / 255.0
+
+    # small area check to avoid ghosting when no lips present
+    area_thresh = 0.0025  # fraction of frame area
+    detected_area = (combined_blurred > 0.15).sum()
+    if detected_area > (h * w * area_thresh):
+        mask_roi = combined_blurred  # keep mask for capture
     else:
-        mask = np.clip(mask, 0.0, 1.0)
+        # no confident detection -> fade the previous mask out smoothly
+        mask_roi = combined_blurred
+        if face.mask_box is not None:
+            prev_mask = np.zeros((roi_h, roi_w), dtype=np.float32)
+            paste_into(prev_mask, face.mask_roi, face.mask_box[0] - rx0, face.mask_box[1] - ry0)
+            mask_roi = fade_alpha * prev_mask + (1 - fade_alpha) * combined_blurred
+        # zero small values
+        mask_roi[mask_roi < 0.02] = 0.0
 
-    # Resize to target
-    mask_resized = cv2.resize(mask, (target_size[1], target_size[0]), interpolation=cv2.INTER_LINEAR)
-    return mask_resized
+    face.mask_roi, face.mask_box = trim_mask(mask_roi, rx0, ry0)
+    pipeline_metrics.observe("mask", time.perf_counter() - t0)
+
+    # -------------------------
+    # Apply color overlay inside the ROI only
+    # -------------------------
+    if blend and face.mask_box is not None:
+        t0 = time.perf_counter()
+        # writes through the out_frame view
+        blend_color(out_frame[ry0:ry1, rx0:rx1], mask_roi, desired_color, finish)
+        pipeline_metrics.observe("blend", time.perf_counter() - t0)
 
 # -------------------------
-# Utility to translate previous mask by dx,dy using warpAffine
+# Overlay compositing engines
 # -------------------------
-def translate_mask(mask, dx, dy):
-    """Translate single-channel mask (float) by dx,dy using warpAffine and border=0"""
-    if mask is None:
+def blend_color_float(out_roi, mask, color):
+    """Original float blend: feather toward color by mask, then 0.7/0.3 addWeighted, in place"""
+    overlay = np.empty_like(out_roi)
+    overlay[:] = color  # BGR
+    mask_3ch = np.repeat(np.clip(mask[:, :, None], 0.0, 1.0), 3, axis=2)
+    feathered = (overlay.astype(np.float32) * mask_3ch + out_roi.astype(np.float32) * (1 - mask_3ch)).astype(np.uint8)
+    # subtle addWeighted to preserve texture
+    blended = cv2.addWeighted(out_roi, 0.7, feathered, 0.3, 0)
+    # apply only to masked area
+    mask_bool = (mask_3ch > 0.02)
+    out_roi[mask_bool] = blended[mask_bool]
+
+def get_premult_table(color):
+    """(256, 1, 3) uint16 LUT of color * alpha for every 8-bit alpha, cached per shade"""
+    key = (int(color[0]), int(color[1]), int(color[2]))
+    table = _premult_tables.get(key)
+    if table is None:
+        alpha = np.arange(256, dtype=np.uint16)
+        table = np.stack([alpha * c for c in key], axis=1).reshape(256, 1, 3).astype(np.uint16)
+        _premult_tables[key] = table
+    return table
+
+def blend_color_int(out_roi, mask, color):
+    """
+    Fixed-point version of blend_color_float (within +-1 LSB of it), in place.
+    feathered = (F * (255 - A) + C * A) / 255 in exact uint16, with C * A read from
+    the per-shade premultiplied table; only uint8/uint16 OpenCV ops, no float temporaries.
+    """
+    # uint8 alpha, zero wherever the float path would skip the pixel (mask <= 0.02)
+    alpha = cv2.convertScaleAbs(cv2.threshold(mask, 0.02, 0, cv2.THRESH_TOZERO)[1], alpha=255)
+    alpha_3ch = cv2.merge([alpha, alpha, alpha])
+    weighted = cv2.multiply(out_roi, cv2.bitwise_not(alpha_3ch), dtype=cv2.CV_16U)
+    weighted = cv2.add(weighted, cv2.LUT(alpha_3ch, get_premult_table(color)))
+    # divide by 255 with truncation (matches the float path's astype(uint8))
+    feathered = cv2.convertScaleAbs(weighted, alpha=1.0 / 255.0, beta=-127.0 / 255.0)
+    blended = cv2.addWeighted(out_roi, 0.7, feathered, 0.3, 0)
+    cv2.copyTo(blended, alpha, out_roi)
+
+def calibrate_composite_engine(iterations=30):
+    """Time both engines on a lip-sized ROI and return the faster one's name"""
+    rng = np.random.default_rng(0)
+    roi = rng.integers(0, 256, (140, 220, 3), dtype=np.uint8)
+    mask = np.zeros((140, 220), dtype=np.float32)
+    cv2.ellipse(mask, (110, 70), (90, 40), 0, 0, 360, 1.0, -1)
+    mask = cv2.GaussianBlur(mask, GAUSSIAN_BLUR_KERNEL, 0)
+    color = (39, 29, 179)
+
+    timings = {}
+    for name, fn in (("float", blend_color_float), ("int", blend_color_int)):
+        fn(roi.copy(), mask, color)  # warm-up
+        t0 = time.perf_counter()
+        for _ in range(iterations):
+            fn(roi.copy(), mask, color)
+        timings[name] = time.perf_counter() - t0
+    best = min(timings, key=timings.get)
+    print(f"🧮 Compositing engine: {best} (int {timings['int']*1000/iterations:.3f} ms, "
+          f"float {timings['float']*1000/iterations:.3f} ms per ROI)")
+    return best
+
+def shade_opacity(finish=None):
+    """Largest blend weight of the active shade engine (the finish's, for the LUT engine)"""
+    return FINISHES[normalize_finish(finish)]["opacity"] if SHADE_ENGINE == "lut" else FLAT_OPACITY
+
+def geometry_shade(roi, mask, color, finish=None):
+    """
+    (BGR, opacity) a geometry client blends flat over one face so it looks like blend_color():
+    the flat engines' colour and 0.3, or the LUT's output for the face's mask-weighted mean lip
+    colour with the finish's opacity (the per-pixel texture the LUT keeps is all that differs)
+    """
+    opacity = shade_opacity(finish)
+    if SHADE_ENGINE != "lut" or roi.shape[:2] != mask.shape[:2]:
+        return color, opacity
+    weights = cv2.threshold(mask.astype(np.float32), 0.02, 0, cv2.THRESH_TOZERO)[1]
+    total = float(weights.sum())
+    if total <= 0.0:
+        return color, opacity
+    mean = np.tensordot(weights, roi.astype(np.float32), axes=([0, 1], [0, 1])) / total
+    lut, opacity = shade_luts.get(color, finish)
+    return shade_pixel(lut, mean), opacity
+
+def blend_color(out_roi, mask, color, finish=None):
+    """Blend the shade into out_roi by mask: its colour LUT, or the configured/fastest flat engine"""
+    global composite_engine
+    if SHADE_ENGINE == "lut":
+        lut, opacity = shade_luts.get(color, finish)
+        apply_shade_lut(out_roi, mask, lut, opacity)
+        return
+    if composite_engine is None:
+        if COMPOSITE_MODE in ("int", "float"):
+            composite_engine = COMPOSITE_MODE
+        else:
+            composite_engine = calibrate_composite_engine()
+    if composite_engine == "int":
+        blend_color_int(out_roi, mask, color)
+    else:
+        blend_color_float(out_roi, mask, color)
+
+def encode_frame(out_frame, quality=JPEG_QUALITY, size=None):
+    """JPEG-encode a processed frame (optionally downscaled to size=(w, h)), returns bytes or None on failure"""
+    t0 = time.perf_counter()
+    if size is not None and size != (out_frame.shape[1], out_frame.shape[0]):
+        out_frame = cv2.resize(out_frame, size, interpolation=cv2.INTER_AREA)
+    ret, buffer = cv2.imencode('.jpg', out_frame, [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)])
+    elapsed = time.perf_counter() - t0
+    pipeline_metrics.observe("encode", elapsed)
+    stream_stats.observe_encode("mjpeg", elapsed)
+    if not ret:
         return None
-    h, w = mask.shape[:2]
-    M = np.float32([[1, 0, dx], [0, 1, dy]])
-    shifted = cv2.warpAffine((mask*255).astype(np.uint8), M, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
-    return (shifted.astype(np.float32) / 255.0)
+    return buffer.tobytes()
 
 # -------------------------
-# Core pipeline: generate_frames
+# Bounded drop-oldest queue between pipeline stages
 # -------------------------
-def generate_frames():
+class LatestQueue:
     """
-    Generator that yields MJPEG frames (bytes).
-    This is the function used by Flask /video_feed endpoint.
+    Bounded FIFO that never blocks the producer: when full, the oldest item is
+    dropped (and counted) so consumers always work on the freshest frames and
+    end-to-end latency cannot build up.
     """
-    global previous_lip_points, last_processed_frame, last_mask_full, last_mask_center, use_segmentation
 
-    # Ensure admin colors loaded
-    if not ADMIN_COLORS:
-        load_admin_colors()
+    def __init__(self, name, maxsize=1):
+        self.name = name
+        self.maxsize = maxsize
+        self._items = deque()
+        self._cond = threading.Condition()
 
-    while True:
-        success, frame = cap.read()
+    def put(self, item):
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                pipeline_metrics.inc(f"queue_{self.name}_dropped_total")
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=0.1):
+        """Oldest waiting item, or None after timeout"""
+        with self._cond:
+            if not self._items:
+                self._cond.wait(timeout)
+                if not self._items:
+                    return None
+            return self._items.popleft()
+
+def use_staged_pipeline():
+    if PIPELINE_MODE in ("staged", "serial"):
+        return PIPELINE_MODE == "staged"
+    return (os.cpu_count() or 1) >= 4
+
+# -------------------------
+# Camera hub: one reader thread fanned out to every /video_feed client
+# -------------------------
+class FrameHub:
+    """
+    Reads the camera on a single background thread, runs the pipeline once
+    per camera frame and publishes the newest processed frame (and its JPEG, while
+    MJPEG subscribers exist, and its geometry message, while geometry subscribers exist)
+    to any number of subscribers. A slow subscriber always gets the latest frame (never
+    a backlog). The threads start with the first subscriber (MJPEG, WebRTC or geometry,
+    see attach()) and stop after the last one leaves.
+
+    In staged mode capture, landmarks, mask, compositing and encoding each run
+    on their own thread connected by LatestQueues, so frame N+1 is captured and
+    detected while frame N is composited and encoded.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._subscribers = 0
+        self._mjpeg = 0        # subscribers that need JPEGs
+        self._geometry = 0     # subscribers that only need geometry (they composite themselves)
+        self._seq = 0          # increments once per published frame
+        self._frame = None     # latest JPEG bytes (None while only WebRTC viewers are connected)
+        self._raw = None       # latest processed BGR frame (read-only for subscribers)
+        self._captured_at = 0.0
+        self._geometry_msg = None  # latest geometry_stream message
+        self._variants = VariantCache(encode_frame)  # per-tier JPEGs of the latest frame
+
+    @property
+    def subscriber_count(self):
+        with self._cond:
+            return self._subscribers
+
+    @property
+    def wants_jpeg(self):
+        return self._mjpeg > 0
+
+    @property
+    def wants_pixels(self):
+        """False while every viewer composites client-side: blending can be skipped"""
+        return self._subscribers > self._geometry
+
+    @property
+    def wants_geometry(self):
+        return self._geometry > 0
+
+    def _ensure_running_locked(self):
+        self._running = True
+        start_segmentation_loader()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def attach(self, mjpeg=False, geometry=False):
+        """Register a viewer (starts the hub if needed)"""
+        with self._cond:
+            self._subscribers += 1
+            if mjpeg:
+                self._mjpeg += 1
+            if geometry:
+                self._geometry += 1
+            self._ensure_running_locked()
+            self._update_viewer_gauges_locked()
+
+    def detach(self, mjpeg=False, geometry=False):
+        """Unregister a viewer; the hub stops after the last one"""
+        with self._cond:
+            self._subscribers = max(self._subscribers - 1, 0)
+            if mjpeg:
+                self._mjpeg = max(self._mjpeg - 1, 0)
+            if geometry:
+                self._geometry = max(self._geometry - 1, 0)
+            if self._subscribers == 0:
+                self._running = False
+            self._update_viewer_gauges_locked()
+
+    def _update_viewer_gauges_locked(self):
+        pipeline_metrics.set_gauge("viewers", self._subscribers)
+        stream_stats.set_viewers("mjpeg", self._mjpeg)
+        stream_stats.set_viewers("geometry", self._geometry)
+
+    def wait_frame(self, last_seq, timeout=1.0):
+        """(seq, BGR frame, captured_at) newer than last_seq, or None after timeout (used by WebRTC tracks)"""
+        with self._cond:
+            deadline = time.time() + timeout
+            while self._raw is None or self._seq == last_seq:
+                if self._thread is None and self._subscribers:
+                    self._ensure_running_locked()
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(timeout=remaining)
+            return self._seq, self._raw, self._captured_at
+
+    def _publish(self, frame_bytes, frame, captured_at, geometry=None):
+        with self._cond:
+            self._seq += 1
+            self._frame = frame_bytes
+            self._geometry_msg = geometry
+            self._raw = frame
+            self._captured_at = captured_at
+            if frame_bytes is not None:
+                self._variants.put(self._seq, (JPEG_QUALITY, frame.shape[1], frame.shape[0]), frame_bytes)
+            self._cond.notify_all()
+
+    def _read(self, source):
+        """Read one frame, timing the capture stage; None on failure"""
+        t0 = time.perf_counter()
+        success, frame = source.read()
         if not success:
+            pipeline_metrics.inc("capture_failures_total")
             time.sleep(0.01)
-            continue
+            return None
+        pipeline_metrics.observe("capture", time.perf_counter() - t0)
+        return frame
 
-        frame = cv2.flip(frame, 1)  # mirror
-        h, w, _ = frame.shape
-        out_frame = frame.copy()
+    def _run(self):
+        source = open_frame_source(FRAME_SOURCE)
+        staged = use_staged_pipeline()
+        print(f"📷 Frame hub started ({source!r}, {'staged' if staged else 'serial'} pipeline)")
+        if not ADMIN_COLORS:
+            load_admin_colors()
 
-        # pick desired color
-        if selected_color_key in ADMIN_COLORS:
-            desired_color = np.array(ADMIN_COLORS[selected_color_key], dtype=np.uint8)
-        else:
-            if ADMIN_COLORS:
-                desired_color = np.array(list(ADMIN_COLORS.values())[0], dtype=np.uint8)
-            else:
-                desired_color = np.array([179, 29, 39], dtype=np.uint8)
-
-        # Default per-frame mask (full-frame) in float 0..1
-        current_mask_full = np.zeros((h, w), dtype=np.float32)
-        current_bbox_center = None
-
-        # Run MediaPipe to get face landmarks (always)
-        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        mp_results = face_mesh.process(rgb)
-
-        if mp_results.multi_face_landmarks and len(mp_results.multi_face_landmarks) > 0:
-            face_lms = mp_results.multi_face_landmarks[0]
-
-            # Compute lip polygon points in full-frame coords
-            lip_pts = []
-            for idx in LIPS:
-                if idx < len(face_lms.landmark):
-                    lm = face_lms.landmark[idx]
-                    lip_pts.append([int(lm.x * w), int(lm.y * h)])
-            # If too few points, ignore
-            if len(lip_pts) >= 3:
-                lip_pts_arr = np.array(lip_pts, dtype=np.int32)
-
-                # Compute bounding box for the lips polygon and add padding
-                xs = lip_pts_arr[:, 0]
-                ys = lip_pts_arr[:, 1]
-                min_x = max(int(xs.min()) - 8, 0)
-                max_x = min(int(xs.max()) + 8, w - 1)
-                min_y = max(int(ys.min()) - 6, 0)
-                max_y = min(int(ys.max()) + 6, h - 1)
-
-                bbox_w = max_x - min_x + 1
-                bbox_h = max_y - min_y + 1
-                current_bbox_center = ( (min_x + max_x) // 2, (min_y + max_y) // 2 )
-
-                # Crop the lip bbox region for segmentation inference (if possible)
-                lip_crop = frame[min_y:max_y+1, min_x:max_x+1]
-                if lip_crop.size == 0:
-                    lip_crop = frame.copy()
-
-                crop_mask = None
-
-                # Segmentation path (if model available)
-                if use_segmentation and seg_model is not None:
-                    try:
-                        inp = preprocess_for_model(lip_crop, seg_input_size)
-                        with torch.no_grad():
-                            out = seg_model(inp)
-                        # Try to interpret out and convert to single-channel mask
-                        # postprocess_mask will attempt to pick channel/class
-                        if isinstance(out, (list, tuple)):
-                            out_candidate = out[0]
-                        elif isinstance(out, dict):
-                            # common keys
-                            for k in ('out', 'mask', 'pred'):
-                                if k in out:
-                                    out_candidate = out[k]
-                                    break
-                            else:
-                                # fallback: use first value
-                                out_candidate = list(out.values())[0]
-                        else:
-                            out_candidate = out
-                        crop_mask = postprocess_mask(out_candidate, (lip_crop.shape[0], lip_crop.shape[1]))
-                        # Optional: if this mask appears empty, set to None to fallback
-                        if crop_mask.sum() < 1e-5:
-                            crop_mask = None
-                    except Exception as e:
-                        # segmentation failed for this frame; keep None and fallback to landmarks
-                        crop_mask = None
-                # Landmark-only fallback mask inside bbox
-                if crop_mask is None:
-                    # Build polygon relative coordinates for crop
-                    rel_pts = lip_pts_arr - np.array([min_x, min_y])
-                    poly_mask_crop = np.zeros((bbox_h, bbox_w), dtype=np.uint8)
-                    if rel_pts.shape[0] >= 3:
-                        cv2.fillPoly(poly_mask_crop, [rel_pts.astype(np.int32)], 255)
-                        crop_mask = (poly_mask_crop.astype(np.float32) / 255.0)
-                    else:
-                        crop_mask = np.zeros((bbox_h, bbox_w), dtype=np.float32)
-
-                # place crop_mask into full-frame coords
-                current_mask_full[min_y:max_y+1, min_x:max_x+1] = crop_mask
-
-        # -------------------------
-        # Translate previous mask to current center and EMA smoothing
-        # -------------------------
-        if last_mask_full is None:
-            # first frame: use current directly
-            combined_mask = current_mask_full
-        else:
-            # compute translation dx,dy from previous center to current center
-            if current_bbox_center is None or last_mask_center is None:
-                # no reliable center -> fallback to simple EMA without translation
-                combined_mask = ema_alpha * last_mask_full + (1.0 - ema_alpha) * current_mask_full
+        try:
+            if staged:
+                self._run_staged(source)
             else:
-                dx = current_bbox_center[0] - last_mask_center[0]
-                dy = current_bbox_center[1] - last_mask_center[1]
-                # Shift previous mask by dx,dy
-                shifted_prev = translate_mask(last_mask_full, dx, dy)
-                # EMA between shifted previous and current
-                combined_mask = ema_alpha * shifted_prev + (1.0 - ema_alpha) * current_mask_full
-
-        # Postprocess combined_mask: morphology + blur + thresholding
-        combined_uint8 = (np.clip(combined_mask, 0.0, 1.0) * 255).astype(np.uint8)
-        # remove noise small speckles
-        combined_uint8 = cv2.morphologyEx(combined_uint8, cv2.MORPH_OPEN, MORPH_KERNEL, iterations=1)
-        combined_uint8 = cv2.morphologyEx(combined_uint8, cv2.MORPH_CLOSE, MORPH_KERNEL, iterations=1)
-        # feather edges
-        combined_blurred = cv2.GaussianBlur(combined_uint8, GAUSSIAN_BLUR_KERNEL, 0).astype(np.float32) / 255.0
-
-        # small area check to avoid ghosting when no lips present
-        area_thresh = 0.0025  # fraction of frame area
-        detected_area = (combined_blurred > 0.15).sum()
-        if detected_area > (h * w * area_thresh):
-            last_mask_full = combined_blurred  # keep mask for capture
-            last_mask_center = current_bbox_center
-        else:
-            # no confident detection -> fade mask out smoothly
-            last_mask_full = ema_alpha * last_mask_full + (1-ema_alpha) * combined_blurred
-            # zero small values
-            last_mask_full[last_mask_full < 0.02] = 0.0
-            # keep center as previous to allow translational smoothing next frame
-            # (do not update last_mask_center in this branch)
-
-        # If no mask at all, ensure last_mask_full is defined
-        if last_mask_full is None:
-            last_mask_full = np.zeros((h, w), dtype=np.float32)
-
-        # -------------------------
-        # Apply color overlay using last_mask_full
-        # -------------------------
-        if last_mask_full.sum() > 0:
-            overlay = np.zeros_like(out_frame, dtype=np.uint8)
-            overlay[:] = desired_color  # BGR
-            mask_3ch = np.repeat(np.clip(last_mask_full[:, :, None], 0.0, 1.0), 3, axis=2)
-            feathered = (overlay.astype(np.float32) * mask_3ch + out_frame.astype(np.float32) * (1 - mask_3ch)).astype(np.uint8)
-            # subtle addWeighted to preserve texture
-            blended = cv2.addWeighted(out_frame, 0.7, feathered, 0.3, 0)
-            # apply only to masked area
-            mask_bool = (mask_3ch > 0.02)
-            out_frame[mask_bool] = blended[mask_bool]
-
-        # Save last processed frame for capture endpoint
-        last_processed_frame = out_frame.copy()
-
-        # Encode and yield for MJPEG stream
-        ret, buffer = cv2.imencode('.jpg', out_frame, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
-        if not ret:
-            continue
-        frame_bytes = buffer.tobytes()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+                self._run_serial(source)
+        finally:
+            source.release()
+            with self._cond:
+                self._thread = None
+                self._frame = None
+                self._raw = None
+                self._geometry_msg = None
+                self._variants.clear()
+                if self._running:
+                    # a viewer arrived while we were shutting down -> start over
+                    self._ensure_running_locked()
+                else:
+                    print("📷 Frame hub stopped (no viewers)")
+                self._cond.notify_all()
+
+    def _run_serial(self, source):
+        while self._running:
+            frame = self._read(source)
+            if frame is None:
+                continue
+            t1 = time.perf_counter()
+            try:
+                job = process_job(FrameJob(frame, t1), blend=self.wants_pixels)
+                if self.wants_geometry:
+                    run_geometry_stage(job)
+                frame_bytes = encode_frame(job.frame) if self.wants_jpeg else None
+            except Exception as e:
+                pipeline_metrics.inc("processing_errors_total")
+                print(f"⚠️ Frame processing error: {e}")
+                continue
+            if frame_bytes is None and self.wants_jpeg:
+                continue
+            record_latency(time.perf_counter() - t1)
+            self._publish(frame_bytes, job.frame, t1, job.geometry)
+
+    def _stage_loop(self, name, stage_fn, inbox, outbox):
+        while self._running:
+            job = inbox.get()
+            if job is None:
+                continue
+            try:
+                job = stage_fn(job)
+            except Exception as e:
+                pipeline_metrics.inc("processing_errors_total")
+                print(f"⚠️ Frame processing error in {name} stage: {e}")
+                continue
+            if job is None:
+                continue
+            if outbox is not None:
+                outbox.put(job)
+                continue
+            # last stage: publish and record end-to-end latency
+            record_latency(time.perf_counter() - job.captured_at)
+            self._publish(job.jpeg, job.frame, job.captured_at, job.geometry)
+
+    def _run_staged(self, source):
+        def composite(job):
+            global last_processed_frame, last_frame_blended
+            blend = self.wants_pixels
+            run_composite_stage(job, blend)
+            # geometry reads the face masks, which the next frame's composite overwrites
+            if self.wants_geometry:
+                run_geometry_stage(job)
+            # nothing writes to job.frame after this stage, so no copy is needed
+            last_processed_frame = job.frame
+            last_frame_blended = blend
+            return job
+
+        def encode(job):
+            # WebRTC-only viewers encode on their own; skip the JPEG
+            return run_encode_stage(job) if self.wants_jpeg else job
+
+        stages = [
+            ("landmarks", run_landmark_stage),
+            ("mask", run_mask_stage),
+            ("composite", composite),
+            ("encode", encode),
+        ]
+        queues = [LatestQueue(name, PIPELINE_QUEUE_SIZE) for name, _ in stages]
+        workers = []
+        for i, (name, fn) in enumerate(stages):
+            outbox = queues[i + 1] if i + 1 < len(queues) else None
+            t = threading.Thread(target=self._stage_loop, args=(name, fn, queues[i], outbox),
+                                 name=f"treon-{name}", daemon=True)
+            t.start()
+            workers.append(t)
+
+        # this thread is the capture stage
+        while self._running:
+            frame = self._read(source)
+            if frame is not None:
+                queues[0].put(FrameJob(frame))
+
+        for t in workers:
+            t.join(timeout=2.0)
+
+    def subscribe(self, max_width=None, max_height=None):
+        """
+        Generator that yields MJPEG parts (bytes) for one client.
+        This is what the Flask /video_feed endpoint streams. JPEG quality and scale
+        follow this client's write backpressure, capped at max_width x max_height.
+        """
+        self.attach(mjpeg=True)
+        rate = ClientRateController(max_width=max_width, max_height=max_height)
+        last_seq = 0
+        tier = rate.tier
+        try:
+            while True:
+                with self._cond:
+                    while self._raw is None or self._seq == last_seq:
+                        if self._thread is None:
+                            # hub thread exited between viewers -> bring it back
+                            self._ensure_running_locked()
+                        self._cond.wait(timeout=1.0)
+                    skipped = self._seq - last_seq - 1 if last_seq else 0
+                    if skipped > 0:
+                        # this client was too slow for some frames -> they were skipped
+                        pipeline_metrics.inc("frames_dropped_total", skipped)
+                    last_seq = seq = self._seq
+                    frame = self._raw
+                    captured_at = self._captured_at
+                # full-size tier: the pipeline's own encode; otherwise shared with same-tier clients
+                frame_bytes = self._variants.get(seq, frame, rate.variant(frame.shape))
+                if frame_bytes is None:
+                    continue
+                part = (b'--frame\r\n'
+                        b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+                t0 = time.perf_counter()
+                yield part
+                # resumed once the server wrote the part to the socket (blocks while the link is backed up)
+                now = time.perf_counter()
+                rate.observe(len(part), now - t0, skipped, now)
+                if rate.tier != tier:
+                    quality, width, height = rate.variant(frame.shape)
+                    print(f"🔸 MJPEG client tier {tier} -> {rate.tier} (q{quality}, {width}x{height})")
+                    tier = rate.tier
+                stream_stats.add_bytes("mjpeg", len(part))
+                stream_stats.observe_latency("mjpeg", now - captured_at)
+        finally:
+            self.detach(mjpeg=True)
+
+    def subscribe_geometry(self):
+        """
+        Generator that yields one geometry_stream message (bytes) per processed frame
+        for one client-side compositing viewer (the /geometry WebSocket).
+        """
+        self.attach(geometry=True)
+        last_seq = 0
+        try:
+            while True:
+                with self._cond:
+                    while self._geometry_msg is None or self._seq == last_seq:
+                        if self._thread is None:
+                            self._ensure_running_locked()
+                        self._cond.wait(timeout=1.0)
+                    if last_seq and self._seq - last_seq > 1:
+                        pipeline_metrics.inc("geometry_frames_dropped_total", self._seq - last_seq - 1)
+                    last_seq = self._seq
+                    message = self._geometry_msg
+                    captured_at = self._captured_at
+                yield message
+                stream_stats.add_bytes("geometry", len(message))
+                stream_stats.observe_latency("geometry", time.perf_counter() - captured_at)
+        finally:
+            self.detach(geometry=True)
+
+frame_hub = FrameHub()
+
+def generate_frames():
+    """
+    Generator that yields MJPEG frames (bytes).
+    Kept for compatibility; every caller shares the single frame_hub reader.
+    """
+    yield from frame_hub.subscribe()
 
 # -------------------------
 # Load admin colors in background
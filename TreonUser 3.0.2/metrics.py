@@ -0,0 +1,246 @@
+"""
+Low-overhead metrics for the TREON try-on pipeline
+- StageHistogram: cumulative Prometheus-style buckets + a rolling window of recent samples
+  (for p50/p95/p99 without keeping every sample)
+- PipelineMetrics: one histogram per pipeline stage plus plain counters
+- Rendered as Prometheus text exposition format or as a JSON snapshot (see /metrics in app.py)
+- StreamStats: bandwidth, encode time and latency per streaming transport (MJPEG / WebRTC),
+  side by side (see /stream_stats in app.py)
+
+Timing is plain time.perf_counter() deltas handed to observe(); no context managers
+or allocations on the hot path beyond a lock and a couple of array writes.
+"""
+
+import time
+import threading
+from collections import deque
+import numpy as np
+
+# Bucket upper bounds in seconds (roughly 1 ms .. 1 s, with 60/30/15 fps frame budgets in between)
+DEFAULT_BUCKETS = (0.001, 0.002, 0.005, 0.010, 0.0167, 0.025, 0.0333, 0.050, 0.0667, 0.100, 0.250, 0.500, 1.0)
+WINDOW_SIZE = 512  # recent samples kept per stage for rolling percentiles
+
+# Stage names in pipeline order (used for stable output ordering)
+STAGES = ("capture", "landmarks", "tracking", "segmentation", "seg_roundtrip", "seg_warp", "mask", "blend", "encode", "total")
+
+
+class StageHistogram:
+    """Cumulative bucket counts and sum (for Prometheus) plus a ring buffer of recent samples"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=WINDOW_SIZE):
+        self.buckets = np.array(buckets, dtype=np.float64)
+        self.bucket_counts = np.zeros(len(buckets) + 1, dtype=np.int64)  # last slot is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.window = np.zeros(window, dtype=np.float64)
+        self.window_pos = 0
+
+    def observe(self, seconds):
+        self.bucket_counts[np.searchsorted(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.window[self.window_pos % len(self.window)] = seconds
+        self.window_pos += 1
+
+    def recent(self):
+        n = min(self.window_pos, len(self.window))
+        return self.window[:n]
+
+    def summary(self):
+        recent = self.recent()
+        if recent.size == 0:
+            return {"count": self.count}
+        p50, p95, p99 = np.percentile(recent, (50, 95, 99)) * 1000.0
+        return {
+            "count": self.count,
+            "mean_ms": round(float(recent.mean() * 1000.0), 3),
+            "p50_ms": round(float(p50), 3),
+            "p95_ms": round(float(p95), 3),
+            "p99_ms": round(float(p99), 3),
+            "max_ms": round(float(recent.max() * 1000.0), 3),
+        }
+
+
+class PipelineMetrics:
+    """Thread-safe registry of stage histograms and counters"""
+
+    def __init__(self, prefix="treon"):
+        self.prefix = prefix
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+        self._gauges = {}
+
+    # -------------------------
+    # Recording
+    # -------------------------
+    def observe(self, stage, seconds):
+        with self._lock:
+            hist = self._stages.get(stage)
+            if hist is None:
+                hist = self._stages[stage] = StageHistogram()
+            hist.observe(seconds)
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+            self._gauges.clear()
+            self.started_at = time.time()
+
+    # -------------------------
+    # Export
+    # -------------------------
+    def _ordered_stages(self):
+        known = [s for s in STAGES if s in self._stages]
+        return known + sorted(s for s in self._stages if s not in STAGES)
+
+    def snapshot(self):
+        """JSON-friendly dict of everything recorded so far"""
+        with self._lock:
+            counters = dict(self._counters)
+            frames = counters.get("frames_total", 0)
+            data = {
+                "uptime_sec": round(time.time() - self.started_at, 1),
+                "stages": {s: self._stages[s].summary() for s in self._ordered_stages()},
+                "counters": counters,
+                "gauges": dict(self._gauges),
+                "face_found_ratio": round(counters.get("frames_with_face_total", 0) / frames, 4) if frames else 0.0,
+            }
+        return data
+
+    def render_prometheus(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        p = self.prefix
+        lines = []
+        with self._lock:
+            lines.append(f"# HELP {p}_stage_seconds Time spent in each try-on pipeline stage per frame")
+            lines.append(f"# TYPE {p}_stage_seconds histogram")
+            for stage in self._ordered_stages():
+                hist = self._stages[stage]
+                cumulative = np.cumsum(hist.bucket_counts)
+                for bound, count in zip(hist.buckets, cumulative[:-1]):
+                    lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {int(count)}')
+                lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {int(cumulative[-1])}')
+                lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {hist.total:.6f}')
+                lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+
+            for name in sorted(self._counters):
+                lines.append(f"# TYPE {p}_{name} counter")
+                lines.append(f"{p}_{name} {self._counters[name]}")
+
+            frames = self._counters.get("frames_total", 0)
+            ratio = self._counters.get("frames_with_face_total", 0) / frames if frames else 0.0
+            lines.append(f"# HELP {p}_face_found_ratio Fraction of processed frames with lips detected")
+            lines.append(f"# TYPE {p}_face_found_ratio gauge")
+            lines.append(f"{p}_face_found_ratio {ratio:.4f}")
+
+            for name in sorted(self._gauges):
+                lines.append(f"# TYPE {p}_{name} gauge")
+                lines.append(f"{p}_{name} {self._gauges[name]}")
+        return "\n".join(lines) + "\n"
+
+
+# -------------------------
+# Streaming transports
+# -------------------------
+class TransportStats:
+    """Rolling bytes / encode time over the last `window` seconds plus latency histograms, for one transport"""
+
+    def __init__(self, window=5.0):
+        self.window = window
+        self.sent = deque()            # (time, bytes)
+        self.encodes = deque()         # (time, seconds)
+        self.server = StageHistogram() # capture -> handed to the network
+        self.client = StageHistogram() # network + buffering + decode, as reported by the browser
+        self.client_lower_bound = False # browser can only estimate the client half (MJPEG: RTT / 2)
+        self.viewers = 0
+
+    def _trim(self, now):
+        for q in (self.sent, self.encodes):
+            while q and now - q[0][0] > self.window:
+                q.popleft()
+
+    def add_bytes(self, now, count):
+        self.sent.append((now, count))
+        self._trim(now)  # bounded even when nobody polls /stream_stats
+
+    def add_encode(self, now, seconds):
+        self.encodes.append((now, seconds))
+        self._trim(now)
+
+    def summary(self, now):
+        self._trim(now)
+        sent = sum(n for _, n in self.sent)
+        enc = [s for _, s in self.encodes]
+        server = self.server.summary().get("p50_ms")
+        client = self.client.summary().get("p50_ms")
+        kbps = sent * 8 / 1000.0 / self.window
+        return {
+            "viewers": self.viewers,
+            "kbps": round(kbps, 1),
+            "kbps_per_viewer": round(kbps / self.viewers, 1) if self.viewers else 0.0,
+            "encodes_per_sec": round(len(enc) / self.window, 1),
+            "encode_ms": round(float(np.mean(enc)) * 1000.0, 3) if enc else None,
+            "encode_busy_pct": round(sum(enc) / self.window * 100.0, 1),
+            "server_latency_ms": server,
+            "client_latency_ms": client,
+            "glass_to_glass_ms": round(server + client, 3) if server is not None and client is not None else None,
+            # true: client_latency_ms / glass_to_glass_ms are lower bounds, not per-frame measurements
+            "client_latency_is_lower_bound": self.client_lower_bound,
+        }
+
+
+class StreamStats:
+    """Thread-safe per-transport stats; MJPEG is fed by lip.FrameHub, WebRTC by webrtc_stream.py"""
+
+    def __init__(self, window=5.0):
+        self.window = window
+        self._lock = threading.Lock()
+        self._transports = {}
+
+    def _get(self, transport):
+        stats = self._transports.get(transport)
+        if stats is None:
+            stats = self._transports[transport] = TransportStats(self.window)
+        return stats
+
+    def add_bytes(self, transport, count):
+        with self._lock:
+            self._get(transport).add_bytes(time.time(), count)
+
+    def observe_encode(self, transport, seconds):
+        with self._lock:
+            self._get(transport).add_encode(time.time(), seconds)
+
+    def observe_latency(self, transport, seconds, side="server", lower_bound=False):
+        with self._lock:
+            stats = self._get(transport)
+            if side == "client":
+                stats.client.observe(seconds)
+                stats.client_lower_bound = lower_bound
+            else:
+                stats.server.observe(seconds)
+
+    def set_viewers(self, transport, count):
+        with self._lock:
+            self._get(transport).viewers = count
+
+    def report(self):
+        now = time.time()
+        with self._lock:
+            return {name: stats.summary(now) for name, stats in sorted(self._transports.items())}
+
+
+# Process-wide instances shared by lip.py, webrtc_stream.py and app.py
+pipeline_metrics = PipelineMetrics()
+stream_stats = StreamStats()
@@ -0,0 +1,174 @@
+"""
+Per-client adaptive MJPEG for /video_feed
+- Each subscriber gets a ClientRateController that times how long the server blocks writing each part
+  (a full socket buffer = the link cannot keep up) and how many frames the client skipped, and steps
+  its (JPEG quality, scale) tier down under backpressure and back up once the link has stayed idle
+- Tiers come from TREON_MJPEG_TIERS ("quality:scale,..." best first); a client may cap its resolution
+  with /video_feed?max_width=..&max_height=..
+- VariantCache keeps the encodes of the newest frame keyed by (quality, width, height), so clients on
+  the same tier share one encode (the first one to ask encodes, the others wait for it)
+"""
+
+import os
+import time
+import threading
+
+from metrics import pipeline_metrics
+
+DEFAULT_TIERS = "85:1.0,75:1.0,65:0.75,55:0.6,45:0.5"
+MJPEG_ADAPTIVE = os.environ.get("TREON_MJPEG_ADAPTIVE", "1").strip().lower() in ("1", "true", "yes", "on")
+
+def parse_tiers(spec):
+    """'85:1.0,65:0.75' -> [(85, 1.0), (65, 0.75)]"""
+    tiers = []
+    for item in spec.split(","):
+        quality, _, scale = item.strip().partition(":")
+        tiers.append((min(max(int(quality), 10), 100), min(max(float(scale or 1.0), 0.1), 1.0)))
+    if not tiers:
+        raise ValueError(f"No MJPEG tiers in {spec!r}")
+    return tiers
+
+MJPEG_TIERS = parse_tiers(os.environ.get("TREON_MJPEG_TIERS", DEFAULT_TIERS))
+JPEG_QUALITY = MJPEG_TIERS[0][0]   # quality of the full-size encode done by the pipeline itself
+
+
+def scaled_size(width, height, scale, max_width=None, max_height=None):
+    """Output (w, h) for a frame scaled by `scale` and capped to max_width/max_height, aspect kept"""
+    if max_width:
+        scale = min(scale, max_width / width)
+    if max_height:
+        scale = min(scale, max_height / height)
+    if scale >= 1.0:
+        return width, height
+    # even sizes keep chroma subsampling clean
+    return max(16, int(width * scale) // 2 * 2), max(16, int(height * scale) // 2 * 2)
+
+
+class ClientRateController:
+    """
+    Usage (one per MJPEG subscriber):
+        key = rate.variant(frame.shape)            # (quality, w, h)
+        ... yield part ...
+        rate.observe(len(part), write_seconds, skipped_frames)
+    """
+
+    DOWN_BUSY = 0.6        # fraction of the frame interval spent blocked on writes -> step down
+    UP_BUSY = 0.2          # ... below this for UP_HOLD seconds -> step up
+    DOWN_SKIP = 0.3        # fraction of published frames this client missed -> step down
+    DOWN_HOLD = 1.0        # seconds between changes, so one change can take effect first
+    UP_HOLD = 4.0
+
+    def __init__(self, tiers=MJPEG_TIERS, max_width=None, max_height=None, adaptive=MJPEG_ADAPTIVE, tier=0):
+        self.tiers = tiers
+        self.max_width = max_width
+        self.max_height = max_height
+        self.adaptive = adaptive
+        self.tier = min(max(tier, 0), len(tiers) - 1)
+        self.write_time = 0.0     # EMA of seconds blocked per part
+        self.interval = 0.0       # EMA of seconds between parts
+        self.skip_rate = 0.0      # EMA of skipped / published frames
+        self.throughput = 0.0     # EMA of bytes per second actually written
+        self.last_sent = None
+        self.last_change = time.perf_counter()
+
+    def variant(self, shape):
+        quality, scale = self.tiers[self.tier]
+        height, width = shape[:2]
+        return (quality,) + scaled_size(width, height, scale, self.max_width, self.max_height)
+
+    @property
+    def busy(self):
+        return self.write_time / self.interval if self.interval else 0.0
+
+    def observe(self, nbytes, write_seconds, skipped=0, now=None):
+        now = time.perf_counter() if now is None else now
+        if self.last_sent is not None:
+            self.interval = 0.8 * self.interval + 0.2 * (now - self.last_sent) if self.interval else now - self.last_sent
+        self.last_sent = now
+        self.write_time = 0.8 * self.write_time + 0.2 * write_seconds
+        self.skip_rate = 0.8 * self.skip_rate + 0.2 * (skipped / (skipped + 1.0))
+        if write_seconds > 0:
+            self.throughput = 0.8 * self.throughput + 0.2 * (nbytes / write_seconds)
+        if not self.adaptive or not self.interval:
+            return
+
+        held = now - self.last_change
+        if (self.busy > self.DOWN_BUSY or self.skip_rate > self.DOWN_SKIP) and held >= self.DOWN_HOLD:
+            self._step(+1, now)
+        elif self.busy < self.UP_BUSY and self.skip_rate < self.DOWN_SKIP / 3 and held >= self.UP_HOLD:
+            self._step(-1, now)
+
+    def _step(self, direction, now):
+        tier = min(max(self.tier + direction, 0), len(self.tiers) - 1)
+        self.last_change = now
+        if tier == self.tier:
+            return
+        self.tier = tier
+        # the new tier starts from a clean slate
+        self.write_time = 0.0
+        self.skip_rate = 0.0
+        pipeline_metrics.inc("mjpeg_tier_down_total" if direction > 0 else "mjpeg_tier_up_total")
+
+
+class VariantCache:
+    """Encoded JPEG variants of the newest frame only: {(quality, w, h): bytes} for one seq"""
+
+    def __init__(self, encode_fn):
+        self.encode_fn = encode_fn      # encode_fn(frame, quality, size) -> bytes or None
+        self._lock = threading.Lock()
+        self._seq = None
+        self._variants = {}
+        self._pending = {}              # key -> Event while some client is encoding it
+
+    def put(self, seq, key, data):
+        """Seed an encode made elsewhere (the pipeline's full-size JPEG)"""
+        with self._lock:
+            self._reset_locked(seq)
+            self._variants[key] = data
+
+    def _reset_locked(self, seq):
+        if self._seq != seq:
+            self._seq = seq
+            self._variants = {}
+            # wake clients waiting on encodes of the old frame
+            for event in self._pending.values():
+                event.set()
+            self._pending = {}
+
+    def get(self, seq, frame, key):
+        while True:
+            with self._lock:
+                if seq != self._seq:
+                    if self._seq is not None and seq < self._seq:
+                        # a newer frame was published meanwhile: encode privately, do not cache
+                        break
+                    self._reset_locked(seq)
+                data = self._variants.get(key)
+                if data is not None:
+                    pipeline_metrics.inc("mjpeg_variant_hits_total")
+                    return data
+                event = self._pending.get(key)
+                if event is None:
+                    event = self._pending[key] = threading.Event()
+                    break
+            # another client is encoding this variant right now
+            event.wait(timeout=1.0)
+
+        quality, width, height = key
+        data = None
+        try:
+            data = self.encode_fn(frame, quality, (width, height))
+            pipeline_metrics.inc("mjpeg_variant_encodes_total")
+        finally:
+            with self._lock:
+                if self._seq == seq:
+                    if data is not None:
+                        self._variants[key] = data
+                    pending = self._pending.pop(key, None)
+                    if pending is not None:
+                        pending.set()
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._reset_locked(None)
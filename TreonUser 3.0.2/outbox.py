@@ -0,0 +1,322 @@
+"""
+Durable outbox for work that must not run inside an HTTP request (capture uploads, Firestore writes)
+- Jobs are rows in a local SQLite database (WAL), so queued uploads survive a crash, a restart
+  or a network outage
+- A running job is leased to its process (owner + lease_until, renewed by a heartbeat thread);
+  only a job whose lease expired (its process died) is picked up again, so several processes on
+  one file (e.g. the debug reloader's parent and child) never run the same job twice
+- A pool of worker threads runs jobs in parallel; a failed job is retried with exponential
+  backoff (with jitter), then every max_delay seconds for as long as it keeps failing; with
+  max_attempts set it is marked failed instead and kept for inspection / retry()
+- Jobs belong to a group (e.g. one capture) and have a stage: a job only runs once every job of
+  an earlier stage in its group is done, and gets their results (upload URLs -> metadata)
+- status(group) / stats() report progress for the status API in app.py
+
+Handlers are plain functions registered per kind:
+    outbox.register("upload", lambda payload, deps: {...})
+    outbox.enqueue("capture-id", [("lipstick", "upload", {...}, 0), ("metadata", "capture_metadata", {...}, 1)])
+Payloads and results must be JSON-serializable.
+"""
+
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    grp TEXT NOT NULL,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    stage INTEGER NOT NULL DEFAULT 0,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    result TEXT,
+    owner TEXT,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS jobs_grp ON jobs (grp);
+"""
+
+# a job is runnable when it is due (or its lease ran out) and every earlier stage of its group is done
+READY_SQL = """
+SELECT id, grp, name, kind, stage, payload, attempts FROM jobs AS j
+WHERE ((status = 'pending' AND next_attempt_at <= :now) OR (status = 'running' AND lease_until < :now))
+  AND NOT EXISTS (SELECT 1 FROM jobs AS d
+                  WHERE d.grp = j.grp AND d.stage < j.stage AND d.status != 'done')
+ORDER BY next_attempt_at, id LIMIT 1
+"""
+
+LEASE_SECONDS = 60.0       # a running job is given up after this long without a heartbeat
+
+
+class Outbox:
+    """
+    Usage:
+        outbox = Outbox("outbox.db", workers=3)
+        outbox.register("upload", upload_fn)
+        outbox.start()
+        outbox.enqueue(capture_id, [(name, kind, payload, stage), ...])
+        outbox.status(capture_id)
+    """
+
+    def __init__(self, path="outbox.db", workers=3, max_attempts=None, base_delay=2.0, max_delay=300.0,
+                 lease=LEASE_SECONDS):
+        self.path = path
+        self.workers = max(1, workers)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._handlers = {}
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._claim_lock = threading.Lock()
+        self._threads = []
+        self._running = False
+
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                # databases created before leases; their running jobs count as expired
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        conn.execute("UPDATE jobs SET lease_until = 0 WHERE status = ? AND lease_until IS NULL", (RUNNING,))
+        conn.commit()
+
+    def _conn(self):
+        """One SQLite connection per thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def register(self, kind, handler):
+        """handler(payload, deps) -> JSON-serializable result; deps maps earlier-stage job names to their results"""
+        self._handlers[kind] = handler
+
+    # -------------------------
+    # Producer side
+    # -------------------------
+    def enqueue(self, group, jobs):
+        """Queue (name, kind, payload[, stage]) jobs for one group atomically; returns their ids"""
+        now = time.time()
+        conn = self._conn()
+        ids = []
+        with conn:
+            for job in jobs:
+                name, kind, payload = job[:3]
+                stage = job[3] if len(job) > 3 else 0
+                cur = conn.execute(
+                    "INSERT INTO jobs (grp, name, kind, stage, payload, status, next_attempt_at, created_at, updated_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (group, name, kind, stage, json.dumps(payload), PENDING, now, now, now))
+                ids.append(cur.lastrowid)
+        with self._cond:
+            self._cond.notify_all()
+        return ids
+
+    def retry(self, group):
+        """Put the failed jobs of a group back in the queue with a fresh attempt budget (later stages still wait)"""
+        conn = self._conn()
+        with conn:
+            count = conn.execute(
+                "UPDATE jobs SET status = ?, attempts = 0, next_attempt_at = ?, updated_at = ? WHERE grp = ? AND status = ?",
+                (PENDING, time.time(), time.time(), group, FAILED)).rowcount
+        with self._cond:
+            self._cond.notify_all()
+        return count
+
+    # -------------------------
+    # Status
+    # -------------------------
+    def status(self, group):
+        """Per-job status of a group plus an overall state, or None for an unknown group"""
+        rows = self._conn().execute(
+            "SELECT name, kind, stage, status, attempts, next_attempt_at, last_error, result, updated_at"
+            " FROM jobs WHERE grp = ? ORDER BY stage, id", (group,)).fetchall()
+        if not rows:
+            return None
+        jobs = []
+        for row in rows:
+            job = {
+                "name": row["name"],
+                "kind": row["kind"],
+                "status": row["status"],
+                "attempts": row["attempts"],
+                "last_error": row["last_error"],
+                "result": json.loads(row["result"]) if row["result"] else None,
+                "updated_at": row["updated_at"],
+            }
+            if row["status"] == PENDING and row["attempts"]:
+                job["retry_in"] = round(max(row["next_attempt_at"] - time.time(), 0.0), 1)
+            jobs.append(job)
+        states = {job["status"] for job in jobs}
+        if states == {DONE}:
+            state = DONE
+        elif FAILED in states:
+            # later stages stay pending behind a failed job until retry()
+            retrying = RUNNING in states or any(job["status"] == PENDING and job["attempts"] for job in jobs)
+            state = "retrying" if retrying else FAILED
+        elif RUNNING in states or any(job["attempts"] for job in jobs):
+            state = RUNNING
+        else:
+            state = PENDING
+        return {"group": group, "state": state, "jobs": jobs}
+
+    def stats(self):
+        """Job counts by status, plus the oldest pending job's age in seconds"""
+        conn = self._conn()
+        counts = {status: 0 for status in (PENDING, RUNNING, DONE, FAILED)}
+        for status, count in conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+            counts[status] = count
+        oldest = conn.execute("SELECT MIN(created_at) FROM jobs WHERE status = ?", (PENDING,)).fetchone()[0]
+        counts["oldest_pending_s"] = round(time.time() - oldest, 1) if oldest else 0.0
+        counts["workers"] = self.workers if self._running else 0
+        return counts
+
+    def purge(self, older_than=7 * 24 * 3600):
+        """Delete finished groups older than older_than seconds"""
+        conn = self._conn()
+        with conn:
+            return conn.execute(
+                "DELETE FROM jobs WHERE grp IN (SELECT grp FROM jobs GROUP BY grp"
+                " HAVING SUM(status != 'done') = 0 AND MAX(updated_at) < ?)",
+                (time.time() - older_than,)).rowcount
+
+    # -------------------------
+    # Workers
+    # -------------------------
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"treon-outbox-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._heartbeat, name="treon-outbox-lease", daemon=True)
+        t.start()
+        self._threads.append(t)
+        print(f"📤 Outbox started ({self.workers} workers, {self.path})")
+
+    def stop(self, timeout=5.0):
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout=timeout)
+        self._threads = []
+
+    def _claim(self):
+        """Mark the next runnable job as running and return it (or None)"""
+        conn = self._conn()
+        # one claimer at a time inside this process; BEGIN IMMEDIATE guards against other processes
+        with self._claim_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = conn.execute(READY_SQL, {"now": now}).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, owner = ?, lease_until = ?,"
+                                 " updated_at = ? WHERE id = ?",
+                                 (RUNNING, self.owner, now + self.lease, now, row["id"]))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return row
+
+    def _heartbeat(self):
+        """Keep extending the lease of the jobs this process is running"""
+        while self._running:
+            try:
+                conn = self._conn()
+                with conn:
+                    conn.execute("UPDATE jobs SET lease_until = ? WHERE status = ? AND owner = ?",
+                                 (time.time() + self.lease, RUNNING, self.owner))
+            except sqlite3.Error as e:
+                print(f"⚠️ Outbox lease renewal failed: {e}")
+            with self._cond:
+                self._cond.wait(timeout=self.lease / 3)
+
+    def _next_due_in(self):
+        """Seconds until the earliest pending job is due or running lease expires (capped), for the idle wait"""
+        due = self._conn().execute(
+            "SELECT MIN(CASE WHEN status = ? THEN next_attempt_at ELSE lease_until END) FROM jobs"
+            " WHERE status IN (?, ?)", (PENDING, PENDING, RUNNING)).fetchone()[0]
+        if due is None:
+            return 5.0
+        return min(max(due - time.time(), 0.05), 5.0)
+
+    def _deps(self, group, stage):
+        rows = self._conn().execute(
+            "SELECT name, status, result FROM jobs WHERE grp = ? AND stage < ?", (group, stage)).fetchall()
+        return {row["name"]: json.loads(row["result"]) if row["status"] == DONE and row["result"] else None
+                for row in rows}
+
+    def _worker(self):
+        while self._running:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                print(f"⚠️ Outbox claim failed: {e}")
+                job = None
+            if job is None:
+                wait = self._next_due_in()
+                with self._cond:
+                    self._cond.wait(timeout=wait)
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        conn = self._conn()
+        handler = self._handlers.get(job["kind"])
+        attempts = job["attempts"] + 1
+        try:
+            if handler is None:
+                raise RuntimeError(f"No handler for job kind '{job['kind']}'")
+            result = handler(json.loads(job["payload"]), self._deps(job["grp"], job["stage"]))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if self.max_attempts and attempts >= self.max_attempts:
+                status, due = FAILED, time.time()
+                print(f"❌ Outbox job {job['grp']}/{job['name']} failed after {attempts} attempts: {error}")
+            else:
+                status, due = PENDING, time.time() + self.backoff(attempts)
+                print(f"🔄 Outbox job {job['grp']}/{job['name']} attempt {attempts} failed, retrying: {error}")
+            with conn:
+                conn.execute("UPDATE jobs SET status = ?, next_attempt_at = ?, last_error = ?, owner = NULL,"
+                             " updated_at = ? WHERE id = ? AND owner = ?",
+                             (status, due, error, time.time(), job["id"], self.owner))
+        else:
+            with conn:
+                conn.execute("UPDATE jobs SET status = ?, result = ?, last_error = NULL, owner = NULL,"
+                             " updated_at = ? WHERE id = ? AND owner = ?",
+                             (DONE, json.dumps(result), time.time(), job["id"], self.owner))
+        # a finished job may unblock the next stage of its group
+        with self._cond:
+            self._cond.notify_all()
+
+    def backoff(self, attempts):
+        """Exponential backoff with jitter: base * 2^(attempts-1), capped at max_delay, scaled by 0.5..1.0"""
+        delay = min(self.base_delay * (2 ** min(attempts - 1, 30)), self.max_delay)
+        return delay * random.uniform(0.5, 1.0)
@@ -136,6 +136,8 @@ let currentUserId = null;
 let sessionEnded = false;
 let modalInitialized = false;
 let productsAvailable = false;
+let catalogVersion = null;   // catalog version of dynamicProducts, for resuming the SSE feed
+let catalogEvents = null;
 
 // Update getCurrentBrand function to ensure valid brand - IMPROVED
 function getCurrentBrand() {
@@ -177,42 +179,9 @@ async function loadProductsFromAPI() {
     const data = await response.json();
     
     if (data.status === "success") {
-      dynamicProducts = {};
-      
-      // Check if we have products with colors
-      const hasProducts = data.data && data.data.length > 0;
-      const hasColors = hasProducts && data.data.some(brand => brand.colors && brand.colors.length > 0);
-      
-      productsAvailable = hasProducts && hasColors;
-      
-      if (productsAvailable) {
-        // Organize products by brand name (lowercase for consistency)
-        data.data.forEach(brandData => {
-          if (brandData.colors && brandData.colors.length > 0) {
-            const brandName = brandData.brand.toLowerCase();
-            dynamicProducts[brandName] = {
-              brand: brandData.brand,
-              colors: brandData.colors.map((color, index) => ({
-                name: color.name,
-                id: color.id || index + 1,
-                hex: color.hex || color.colorHex || '#cccccc',
-                colorHex: color.colorHex || color.hex || '#cccccc'
-              }))
-            };
-          }
-        });
-        
-        console.log("✅ Loaded products:", Object.keys(dynamicProducts));
-        showProductSelectors();
-        populateBrandButtons();
-        
-        // Debug: Log color values for verification
-        debugColorValues();
-      } else {
-        showNoProductsMessage();
-        hideProductSelectors();
-      }
-      
+      setProductsData(data.data);
+      if (data.version !== undefined) catalogVersion = data.version;
+      startCatalogEvents();
       return true;
     } else {
       throw new Error(data.message || "Failed to load products");
@@ -225,6 +194,125 @@ async function loadProductsFromAPI() {
   }
 }
 
+// Replace the whole product list (brand list in the /api/products shape)
+function setProductsData(brands, activeBrand, activeShadeId) {
+  dynamicProducts = {};
+  
+  // Check if we have products with colors
+  const hasProducts = brands && brands.length > 0;
+  const hasColors = hasProducts && brands.some(brand => brand.colors && brand.colors.length > 0);
+  
+  productsAvailable = hasProducts && hasColors;
+  
+  if (productsAvailable) {
+    // Organize products by brand name (lowercase for consistency)
+    brands.forEach(brandData => {
+      if (brandData.colors && brandData.colors.length > 0) {
+        const brandName = brandData.brand.toLowerCase();
+        dynamicProducts[brandName] = {
+          brand: brandData.brand,
+          colors: brandData.colors.map((color, index) => ({
+            name: color.name,
+            id: color.id || index + 1,
+            hex: color.hex || color.colorHex || '#cccccc',
+            colorHex: color.colorHex || color.hex || '#cccccc'
+          }))
+        };
+      }
+    });
+    
+    console.log("✅ Loaded products:", Object.keys(dynamicProducts));
+    removeNoProductsMessage();
+    showProductSelectors();
+    populateBrandButtons(activeBrand, activeShadeId);
+    
+    // Debug: Log color values for verification
+    debugColorValues();
+  } else {
+    showNoProductsMessage();
+    hideProductSelectors();
+  }
+}
+
+// 📡 Live catalog: the server pushes shade deltas over SSE; the browser resumes from its last version
+function startCatalogEvents() {
+  if (!window.EventSource || catalogEvents) return;
+  const since = catalogVersion !== null ? `?since=${catalogVersion}` : '';
+  catalogEvents = new EventSource(`/api/products/events${since}`);
+
+  catalogEvents.addEventListener('delta', evt => {
+    const delta = JSON.parse(evt.data);
+    catalogVersion = delta.version;
+    if (delta.ops.length > 0) {
+      console.log(`🔄 Catalog v${delta.version}:`, delta.ops);
+      applyCatalogOps(delta.ops);
+    }
+  });
+
+  // our version was unknown to the server (restart, too old): full catalog
+  catalogEvents.addEventListener('reset', evt => {
+    const snapshot = JSON.parse(evt.data);
+    catalogVersion = snapshot.version;
+    console.log(`🔄 Catalog reset to v${snapshot.version}`);
+    const activeBrand = document.querySelector('.brand-btn.active');
+    const activeShade = document.querySelector('.color-btn.active');
+    setProductsData(snapshot.data, activeBrand && activeBrand.textContent.trim(),
+                    activeShade && Number(activeShade.dataset.color));
+  });
+}
+
+// Patch dynamicProducts in place with add / update / remove shade ops
+function applyCatalogOps(ops) {
+  ops.forEach(op => {
+    const shade = op.shade;
+    const id = shade ? shade.id : op.id;
+    const entry = shade && { name: shade.name, id: shade.id, hex: shade.hex, colorHex: shade.hex };
+    const brandKey = shade && shade.brand.toLowerCase();
+    let replaced = false;
+
+    // update in place when the brand is unchanged; otherwise drop the old entry
+    Object.keys(dynamicProducts).forEach(key => {
+      const colors = dynamicProducts[key].colors;
+      const index = colors.findIndex(color => color.id === id);
+      if (index < 0) return;
+      if (entry && key === brandKey) {
+        colors[index] = entry;
+        replaced = true;
+      } else {
+        colors.splice(index, 1);
+        if (colors.length === 0) delete dynamicProducts[key];
+      }
+    });
+
+    if (entry && !replaced) {
+      if (!dynamicProducts[brandKey]) dynamicProducts[brandKey] = { brand: shade.brand, colors: [] };
+      dynamicProducts[brandKey].colors.push(entry);
+    }
+  });
+  refreshProductSelectors();
+}
+
+// Re-render brands / shades after a catalog change, keeping the shopper's current selection
+function refreshProductSelectors() {
+  const hadProducts = productsAvailable;
+  productsAvailable = Object.keys(dynamicProducts).length > 0;
+
+  if (!productsAvailable) {
+    setupNoProducts();
+    return;
+  }
+  if (!hadProducts) {
+    removeNoProductsMessage();
+    showProductSelectors();
+    populateBrandButtons();
+    return;
+  }
+
+  const activeBrand = document.querySelector('.brand-btn.active');
+  const activeShade = document.querySelector('.color-btn.active');
+  populateBrandButtons(activeBrand && activeBrand.textContent.trim(), activeShade && Number(activeShade.dataset.color));
+}
+
 // Debug function to check color values
 function debugColorValues() {
   console.log("=== COLOR DEBUG ===");
@@ -320,8 +408,8 @@ function setupNoProducts() {
   showNoProductsMessage();
 }
 
-// Populate brand buttons dynamically
-function populateBrandButtons() {
+// Populate brand buttons dynamically (keeping activeBrand / activeShadeId selected if they still exist)
+function populateBrandButtons(activeBrand, activeShadeId) {
   const brandScroll = document.querySelector('.brand-scroll .scroll-row');
   if (!brandScroll) return;
   
@@ -335,6 +423,11 @@ function populateBrandButtons() {
     brandScroll.appendChild(brandBtn);
   });
   
+  if (activeBrand && dynamicProducts[activeBrand.toLowerCase()]) {
+    selectBrand(activeBrand, activeShadeId);
+    return;
+  }
+
   // Select first brand by default if available
   const firstBrand = Object.values(dynamicProducts)[0];
   if (firstBrand) {
@@ -343,7 +436,7 @@ function populateBrandButtons() {
 }
 
 // Select brand and load its shades
-function selectBrand(brandName) {
+function selectBrand(brandName, activeShadeId) {
   if (!productsAvailable) return;
   
   const brandKey = brandName.toLowerCase();
@@ -359,18 +452,19 @@ function selectBrand(brandName) {
     }
   });
   
-  loadShadesForBrand(brandData);
+  loadShadesForBrand(brandData, activeShadeId);
 }
 
 // Load shades for selected brand - UPDATED for proper color display
-function loadShadesForBrand(brandData) {
+function loadShadesForBrand(brandData, activeShadeId) {
   if (!productsAvailable) return;
   
   const scrollRow = document.querySelector('.color-scroll .scroll-row');
   if (!scrollRow) return;
 
   scrollRow.innerHTML = '';
-  resetStars();
+  const keepShade = activeShadeId && brandData.colors.some(shade => shade.id === activeShadeId);
+  if (!keepShade) resetStars();
 
   brandData.colors.forEach(shade => {
     const item = document.createElement('div');
@@ -407,6 +501,13 @@ function loadShadesForBrand(brandData) {
     scrollRow.appendChild(item);
   });
   
+  // Catalog refresh: keep the shade being tried on selected, without re-applying / logging it
+  if (keepShade) {
+    const current = scrollRow.querySelector(`.color-btn[data-color="${activeShadeId}"]`);
+    if (current) current.classList.add('active');
+    return;
+  }
+
   // Auto-select first shade
   if (brandData.colors.length > 0) {
     const firstShade = scrollRow.querySelector('.color-btn');
@@ -684,6 +785,273 @@ document.addEventListener('DOMContentLoaded', () => {
   loadProductsFromAPI();
 });
 
+// 📡 Video transport: WebRTC (H.264/VP8) when the server supports it, MJPEG <img> otherwise
+// Force MJPEG with ?transport=mjpeg; ?transport=geometry composites in the browser over its own camera
+let streamTransport = 'mjpeg';
+let rtcPeer = null;
+
+document.addEventListener('DOMContentLoaded', () => {
+  startStreaming();
+  setInterval(reportStreamDelay, 5000);
+});
+
+function startStreaming() {
+  const params = new URLSearchParams(window.location.search);
+  if (params.get('transport') === 'geometry' && window.WebSocket && navigator.mediaDevices) {
+    startGeometry().catch(err => {
+      console.warn("⚠️ Client-side compositing unavailable, staying on MJPEG:", err);
+      fallbackToMJPEG();
+    });
+    return;
+  }
+  if (params.get('transport') === 'mjpeg' || !window.RTCPeerConnection) {
+    console.log("📡 Streaming over MJPEG");
+    return;
+  }
+  startWebRTC().catch(err => {
+    console.warn("⚠️ WebRTC unavailable, staying on MJPEG:", err);
+    fallbackToMJPEG();
+  });
+}
+
+async function startWebRTC() {
+  const img = document.getElementById('video');
+  const rtcVideo = document.getElementById('rtc-video');
+  const pc = new RTCPeerConnection();
+  rtcPeer = pc;
+  pc.addTransceiver('video', { direction: 'recvonly' });
+  pc.ontrack = event => { rtcVideo.srcObject = event.streams[0] || new MediaStream([event.track]); };
+  pc.onconnectionstatechange = () => {
+    if (pc.connectionState === 'failed' || pc.connectionState === 'closed') fallbackToMJPEG();
+  };
+
+  await pc.setLocalDescription(await pc.createOffer());
+  const res = await fetch('/webrtc/offer', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ sdp: pc.localDescription.sdp, type: pc.localDescription.type })
+  });
+  if (!res.ok) throw new Error(`Offer rejected (${res.status})`);
+  await pc.setRemoteDescription(await res.json());
+
+  // Keep MJPEG on screen until the first WebRTC frame actually plays
+  const timeout = setTimeout(() => {
+    if (streamTransport !== 'webrtc') fallbackToMJPEG();
+  }, 8000);
+  rtcVideo.addEventListener('playing', () => {
+    clearTimeout(timeout);
+    if (rtcPeer !== pc) return;
+    streamTransport = 'webrtc';
+    rtcVideo.style.display = '';
+    img.style.display = 'none';
+    img.removeAttribute('src'); // closes the MJPEG connection
+    console.log("📡 Streaming over WebRTC");
+  }, { once: true });
+}
+
+function fallbackToMJPEG() {
+  const img = document.getElementById('video');
+  const rtcVideo = document.getElementById('rtc-video');
+  if (rtcPeer) {
+    const pc = rtcPeer;
+    rtcPeer = null;
+    pc.close();
+  }
+  if (geometrySocket) {
+    const ws = geometrySocket;
+    geometrySocket = null;
+    ws.close();
+  }
+  if (rtcVideo.srcObject && streamTransport === 'geometry') {
+    rtcVideo.srcObject.getTracks().forEach(track => track.stop()); // our own camera preview
+  }
+  streamTransport = 'mjpeg';
+  document.getElementById('lip-canvas').style.display = 'none';
+  rtcVideo.style.display = 'none';
+  rtcVideo.style.transform = '';
+  rtcVideo.srcObject = null;
+  img.style.display = '';
+  if (!img.getAttribute('src')) img.src = 'video_feed';
+}
+
+// 🎨 Client-side compositing: the browser shows its own camera and blends the shade over it,
+// the server only sends lip geometry (binary layout documented in geometry_stream.py)
+const GEOMETRY_MASK_LEVELS = 16;
+const GEOMETRY_VERSION = 2;
+const GEOMETRY_MAX_LEAD = 0.15;     // seconds the lips are moved ahead along their velocity, at most
+let geometrySocket = null;
+
+async function startGeometry() {
+  const img = document.getElementById('video');
+  const preview = document.getElementById('rtc-video');
+  const canvas = document.getElementById('lip-canvas');
+  const ctx = canvas.getContext('2d');
+  const maskCanvas = document.createElement('canvas');
+  const maskCtx = maskCanvas.getContext('2d');
+
+  const ws = new WebSocket(`${location.protocol === 'https:' ? 'wss' : 'ws'}://${location.host}/geometry`);
+  ws.binaryType = 'arraybuffer';
+  geometrySocket = ws;
+
+  // the first message tells us the server's frame size, so the preview can match it
+  let latest = await new Promise((resolve, reject) => {
+    setTimeout(() => reject(new Error("No geometry received")), 8000);
+    ws.onmessage = event => resolve(parseGeometry(event.data));
+    ws.onerror = () => reject(new Error("Geometry socket failed"));
+    ws.onclose = () => reject(new Error("Geometry socket closed"));
+  });
+  let receivedAt = performance.now();
+
+  preview.srcObject = await navigator.mediaDevices.getUserMedia({
+    video: { width: { ideal: latest.width }, height: { ideal: latest.height } },
+    audio: false
+  });
+  if (geometrySocket !== ws) return;
+  preview.style.transform = 'scaleX(-1)'; // server geometry is in mirrored frame coordinates
+  preview.style.display = '';
+  canvas.width = latest.width;
+  canvas.height = latest.height;
+  canvas.style.display = '';
+  img.style.display = 'none';
+  img.removeAttribute('src'); // closes the MJPEG connection
+  streamTransport = 'geometry';
+  console.log("🎨 Compositing lip geometry in the browser");
+
+  ws.onmessage = event => {
+    latest = parseGeometry(event.data);
+    receivedAt = performance.now();
+  };
+  ws.onerror = ws.onclose = () => {
+    if (geometrySocket === ws) fallbackToMJPEG();
+  };
+
+  const draw = () => {
+    if (geometrySocket !== ws) return;
+    const ageSec = (latest.ageMs + performance.now() - receivedAt) / 1000;
+    drawGeometry(ctx, maskCanvas, maskCtx, latest, Math.min(ageSec, GEOMETRY_MAX_LEAD));
+    requestAnimationFrame(draw);
+  };
+  requestAnimationFrame(draw);
+}
+
+function parseGeometry(buffer) {
+  const view = new DataView(buffer);
+  if (view.getUint8(0) !== 0x54 || view.getUint8(1) !== 0x47) throw new Error("Bad geometry message");
+  if (view.getUint8(2) !== GEOMETRY_VERSION) throw new Error("Unsupported geometry version");
+  const count = view.getUint8(3);
+  const geometry = {
+    width: view.getUint16(4, true),
+    height: view.getUint16(6, true),
+    color: [view.getUint8(8), view.getUint8(9), view.getUint8(10)], // B, G, R
+    opacity: view.getUint8(11) / 255, // the server's blend weight at full mask (shade engine / finish)
+    ageMs: view.getUint16(12, true),
+    faces: []
+  };
+  // same blend as the server: src + opacity * mask * (face colour - src)
+  const alphaScale = 255 * geometry.opacity / (GEOMETRY_MASK_LEVELS - 1);
+  let offset = 14;
+  for (let i = 0; i < count; i++) {
+    const n = view.getUint16(offset + 2, true);
+    const face = {
+      id: view.getUint16(offset, true),
+      box: [0, 1, 2, 3].map(k => view.getInt16(offset + 4 + 2 * k, true)),
+      vx: view.getInt16(offset + 12, true),
+      vy: view.getInt16(offset + 14, true),
+      points: null,
+      image: null
+    };
+    const maskW = view.getUint16(offset + 16, true);
+    const maskH = view.getUint16(offset + 18, true);
+    const rleLength = view.getUint32(offset + 20, true);
+    // the shade as the server renders it on this face's lips (LUT engine), B, G, R
+    const [b, g, r] = [view.getUint8(offset + 24), view.getUint8(offset + 25), view.getUint8(offset + 26)];
+    offset += 28;
+    face.points = new Int16Array(buffer.slice(offset, offset + 4 * n)); // x0, y0, x1, y1, ...
+    offset += 4 * n;
+
+    if (maskW && maskH) {
+      // RLE (run, level) pairs -> RGBA image of the shade with the blend alpha
+      const rle = new Uint8Array(buffer, offset, rleLength);
+      const image = new ImageData(maskW, maskH);
+      const data = image.data;
+      let p = 0;
+      for (let j = 0; j < rle.length; j += 2) {
+        const alpha = Math.round(rle[j + 1] * alphaScale);
+        for (let k = 0; k < rle[j]; k++, p += 4) {
+          data[p] = r;
+          data[p + 1] = g;
+          data[p + 2] = b;
+          data[p + 3] = alpha;
+        }
+      }
+      face.image = image;
+    }
+    offset += rleLength;
+    geometry.faces.push(face);
+  }
+  return geometry;
+}
+
+function drawGeometry(ctx, maskCanvas, maskCtx, geometry, leadSec) {
+  ctx.clearRect(0, 0, ctx.canvas.width, ctx.canvas.height);
+  geometry.faces.forEach(face => {
+    if (!face.image) return;
+    const [x0, y0, x1, y1] = face.box;
+    maskCanvas.width = face.image.width;
+    maskCanvas.height = face.image.height;
+    maskCtx.putImageData(face.image, 0, 0);
+    // the preview is newer than the geometry: move the lips along their velocity
+    ctx.drawImage(maskCanvas, x0 + face.vx * leadSec, y0 + face.vy * leadSec, x1 - x0, y1 - y0);
+  });
+}
+
+// Client half of glass-to-glass latency; the server adds its own capture -> send time
+let lastRtcStats = null;
+
+async function reportStreamDelay() {
+  let delayMs = 0;
+  let lowerBound = false;
+
+  try {
+    if (streamTransport === 'webrtc' && rtcPeer) {
+      const stats = await rtcPeer.getStats();
+      let inbound = null;
+      let rttMs = 0;
+      stats.forEach(s => {
+        if (s.type === 'inbound-rtp' && s.kind === 'video') inbound = s;
+        if (s.type === 'candidate-pair' && s.nominated && s.currentRoundTripTime) rttMs = s.currentRoundTripTime * 1000;
+      });
+      if (!inbound) return;
+      const prev = lastRtcStats;
+      lastRtcStats = inbound;
+      if (!prev) return;
+      // Averages over the last interval: jitter buffer wait + decode, plus one-way network time
+      const emitted = (inbound.jitterBufferEmittedCount || 0) - (prev.jitterBufferEmittedCount || 0);
+      const decoded = (inbound.framesDecoded || 0) - (prev.framesDecoded || 0);
+      if (emitted > 0) delayMs += ((inbound.jitterBufferDelay || 0) - (prev.jitterBufferDelay || 0)) / emitted * 1000;
+      if (decoded > 0) delayMs += ((inbound.totalDecodeTime || 0) - (prev.totalDecodeTime || 0)) / decoded * 1000;
+      delayMs += rttMs / 2;
+    } else {
+      // MJPEG exposes neither per-part headers nor per-frame load events to the page, so only
+      // half the round trip of a tiny request is measurable: network time without the socket
+      // backlog or JPEG decode, i.e. a lower bound (flagged as such in /stream_stats)
+      lastRtcStats = null;
+      const t0 = performance.now();
+      await fetch('/stream_stats', { method: 'HEAD' });
+      delayMs = (performance.now() - t0) / 2;
+      lowerBound = true;
+    }
+
+    await fetch('/stream_stats', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ transport: streamTransport, delay_ms: delayMs, lower_bound: lowerBound })
+    });
+  } catch (err) {
+    console.warn("⚠️ Could not report stream delay:", err);
+  }
+}
+
 // Temporary test function for color debugging
 function testColorDisplay() {
   console.log("🧪 Testing color display...");
@@ -0,0 +1,390 @@
+"""
+Out-of-process segmentation worker for TREON
+- Runs the segmentation model (segmentation.py) in its own Python process with its own
+  inference thread budget, so inference never competes with MediaPipe / JPEG encoding for the GIL
+- Lip crops go in and masks come back through a multiprocessing.shared_memory pool of slots;
+  only tiny "SEG seq slot h w [slot h w ...]" / "DONE seq ms ok [ok ...]" lines travel over the
+  worker's stdin/stdout. All crops of one SEG line (one per face) run as a single model batch
+- SegWorkerClient.submit() / poll() never block: the render loop keeps using the freshest mask
+  it has (warped onto the current landmarks, see tracking.SegMaskCache)
+- A face (key) with a crop still in the worker is not submitted again until its mask comes back
+  (or the worker is restarted), so the worker runs at the render loop's refresh cadence instead of
+  chewing through a backlog of stale crops
+- A crashed or hung worker is restarted automatically, waiting twice as long after each restart that
+  did not get a batch through; after max_restarts such restarts in a row it gives up and the feed
+  stays on landmark masks. Until it is back the feed falls back to the last mask / landmark polygon
+
+The worker is started as "python seg_worker.py ..." rather than multiprocessing.Process so it
+never re-imports app.py (Firebase, Flask, MediaPipe) under the Windows spawn start method.
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+from collections import deque
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from metrics import pipeline_metrics
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SLOTS = 3
+DEFAULT_MAX_CROP = (320, 480)  # largest crop (H, W) a slot holds; bigger crops are downscaled to fit
+
+
+def slot_layout(max_h, max_w):
+    """(input bytes, output bytes) per slot: BGR uint8 crop in, float32 mask out"""
+    return max_h * max_w * 3, max_h * max_w * 4
+
+def attach_shared_memory(name):
+    """Attach to an existing segment without letting this process' resource tracker unlink it on exit"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == "posix":
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+# -------------------------
+# Client side (lives in the Flask / render process)
+# -------------------------
+class SegWorkerClient:
+    """
+    Usage:
+        worker = SegWorkerClient(); worker.start()
+        worker.submit([(face_id, crop, box, pts), ...])   # False if busy / not ready, never blocks
+        results = worker.poll()             # {face_id: (mask, box, pts)} of the newest finished crops
+        worker.gave_up                      # True once restarts kept failing: use landmark masks
+    """
+
+    def __init__(self, slots=DEFAULT_SLOTS, max_crop=DEFAULT_MAX_CROP, threads=2,
+                 input_size=None, models_dir="models", timeout=3.0, restart_delay=2.0,
+                 max_restart_delay=60.0, max_restarts=5):
+        self.slots = slots
+        self.max_h, self.max_w = max_crop
+        self.threads = threads
+        self.input_size = input_size        # None = adaptive size buckets (segmentation.SIZE_BUCKETS)
+        self.models_dir = models_dir
+        self.timeout = timeout              # seconds without an answer before the worker counts as hung
+        self.restart_delay = restart_delay  # minimum gap between restarts (doubles per failed restart)
+        self.max_restart_delay = max_restart_delay
+        self.max_restarts = max_restarts    # consecutive restarts without a finished batch before giving up
+        self.in_bytes, self.out_bytes = slot_layout(self.max_h, self.max_w)
+
+        self.proc = None
+        self.shm = None
+        self.state = "stopped"              # stopped / starting / ready / no_model / crashed / failed
+        self.backend = None                 # backend name reported by the worker (torch / onnx / onnx-int8)
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._responses = deque()
+        self._pending = {}                  # seq -> ([(slot, key, box, pts, crop shape), ...], submitted_at)
+        self._free = []                     # slots not holding a pending crop
+        self._seq = 0
+        self._last_start = 0.0
+        self._restarts = 0                  # restarts since the last batch that came back
+        self._stopping = False
+
+    # -------------------------
+    # Lifecycle
+    # -------------------------
+    @property
+    def available(self):
+        return self.state == "ready"
+
+    @property
+    def gave_up(self):
+        return self.state == "failed"
+
+    def start(self):
+        with self._lock:
+            self._stopping = False
+            self._spawn()
+
+    def wait_ready(self, timeout=None):
+        """Block until the worker reported whether a model loaded (used by the background loader only)"""
+        self._ready.wait(timeout)
+        return self.available
+
+    def _spawn(self):
+        self._kill()
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots * (self.in_bytes + self.out_bytes))
+        cmd = [
+            sys.executable, os.path.join(APP_DIR, "seg_worker.py"),
+            "--shm", self.shm.name,
+            "--slots", str(self.slots),
+            "--max-crop", f"{self.max_h}x{self.max_w}",
+            "--input-size", f"{self.input_size[0]}x{self.input_size[1]}" if self.input_size else "auto",
+            "--threads", str(self.threads),
+            "--models-dir", os.path.abspath(self.models_dir),
+        ]
+        env = dict(os.environ, PYTHONIOENCODING="utf-8", OMP_NUM_THREADS=str(self.threads))
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     text=True, encoding="utf-8", bufsize=1, cwd=APP_DIR, env=env)
+        self.state = "starting"
+        self._ready.clear()
+        self._responses.clear()
+        self._pending.clear()
+        self._free = list(range(self.slots))
+        self._last_start = time.time()
+        threading.Thread(target=self._read_loop, args=(self.proc,), daemon=True).start()
+        print(f"🔄 Segmentation worker started (pid {self.proc.pid}, {self.slots} slots)")
+
+    def _kill(self):
+        if self.proc is not None:
+            try:
+                if self.proc.poll() is None:
+                    self.proc.stdin.write("QUIT\n")
+                    self.proc.stdin.flush()
+                    self.proc.wait(timeout=1.0)
+            except Exception:
+                pass
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc = None
+        if self.shm is not None:
+            self.shm.close()
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+            self.shm = None
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            self._kill()
+            self.state = "stopped"
+            self._ready.set()
+
+    def _read_loop(self, proc):
+        """Collects protocol lines from one worker process until it exits"""
+        for line in proc.stdout:
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == "READY":
+                ok = parts[1] == "1"
+                with self._lock:
+                    if proc is not self.proc:
+                        continue  # a worker we already replaced
+                    self.backend = parts[2] if ok and len(parts) > 2 else None
+                    self.state = "ready" if ok else "no_model"
+                    self._ready.set()
+                if ok:
+                    print(f"✅ Segmentation worker ready ({self.backend})")
+                else:
+                    print("🔸 Segmentation worker has no usable model — using landmark masks")
+            elif parts[0] == "DONE":
+                with self._lock:
+                    self._responses.append((int(parts[1]), float(parts[2]), [p == "1" for p in parts[3:]]))
+        # stdout closed: the worker exited (or crashed)
+        with self._lock:
+            if proc is self.proc and self.state in ("starting", "ready"):
+                self.state = "crashed"
+                self._ready.set()
+
+    def restart_wait(self):
+        """Seconds to wait before the next restart: doubles with every restart that did not get a batch through"""
+        return min(self.restart_delay * (2 ** min(self._restarts, 30)), self.max_restart_delay)
+
+    def _check_health(self):
+        """Restart a dead or hung worker (backing off, giving up after max_restarts); called from submit() / poll()"""
+        if self._stopping or self.state in ("no_model", "stopped", "failed"):
+            return
+        dead = self.proc is None or self.proc.poll() is not None or self.state == "crashed"
+        hung = any(time.time() - p[1] > self.timeout for p in self._pending.values())
+        if not (dead or hung):
+            return
+        if self._restarts >= self.max_restarts:
+            print(f"❌ Segmentation worker failed {self._restarts} restarts in a row — giving up, using landmark masks")
+            self._kill()
+            self.state = "failed"
+            self._ready.set()
+            return
+        if time.time() - self._last_start < self.restart_wait():
+            return
+        self._restarts += 1
+        print(f"⚠️ Segmentation worker {'hung' if hung else 'exited'} — restarting "
+              f"(attempt {self._restarts}/{self.max_restarts})")
+        pipeline_metrics.inc("seg_worker_restarts_total")
+        try:
+            self._spawn()
+        except Exception as e:
+            print(f"❌ Could not restart segmentation worker: {e}")
+            self.state = "crashed"
+
+    # -------------------------
+    # Frame exchange
+    # -------------------------
+    def _slot_views(self, slot):
+        base = slot * (self.in_bytes + self.out_bytes)
+        buf = self.shm.buf
+        return buf[base:base + self.in_bytes], buf[base + self.in_bytes:base + self.in_bytes + self.out_bytes]
+
+    def busy(self, count=1):
+        """True if count more crops would leave no slot free (at most slots - 1 crops in flight)"""
+        return len(self._free) - count < 1
+
+    def _slot_size(self, h, w):
+        """(h, w) an h x w crop is stored at: downscaled to fit a slot (the model resizes anyway)"""
+        scale = min(self.max_h / h, self.max_w / w, 1.0)
+        if scale < 1.0:
+            return max(int(h * scale), 1), max(int(w * scale), 1)
+        return h, w
+
+    def in_flight(self):
+        """Keys with a crop submitted but not yet picked up by poll()"""
+        return {item[1] for items, _ in self._pending.values() for item in items}
+
+    def submit(self, items):
+        """
+        Queue lip crops [(key, crop, box, pts), ...] as one inference batch; keys that already
+        have a crop in the worker are skipped. Returns False (without waiting) if nothing was accepted
+        """
+        with self._lock:
+            self._check_health()
+            busy_keys = self.in_flight()
+            items = [it for it in items if it[0] not in busy_keys and it[1] is not None and it[1].size > 0]
+            if not self.available or not items or self.busy(len(items)):
+                return False
+
+            self._seq += 1
+            pending, fields = [], []
+            for key, crop, box, pts in items:
+                h, w = crop.shape[:2]
+                sh, sw = self._slot_size(h, w)
+                if (sh, sw) != (h, w):
+                    crop = cv2.resize(crop, (sw, sh), interpolation=cv2.INTER_AREA)
+                slot = self._free.pop()
+                in_view, _ = self._slot_views(slot)
+                np.ndarray((sh, sw, 3), dtype=np.uint8, buffer=in_view)[:] = crop
+                pending.append((slot, key, box, pts, (h, w)))
+                fields.append(f"{slot} {sh} {sw}")
+            try:
+                self.proc.stdin.write(f"SEG {self._seq} {' '.join(fields)}\n")
+                self.proc.stdin.flush()
+            except (BrokenPipeError, OSError, ValueError):
+                self.state = "crashed"
+                return False
+            self._pending[self._seq] = (pending, time.time())
+            pipeline_metrics.set_gauge("seg_worker_in_flight", len(self._pending))
+            return True
+
+    def _read_mask(self, slot, h, w):
+        sh, sw = self._slot_size(h, w)
+        _, out_view = self._slot_views(slot)
+        mask = np.ndarray((sh, sw), dtype=np.float32, buffer=out_view).copy()
+        if (sh, sw) != (h, w):
+            mask = cv2.resize(mask, (w, h), interpolation=cv2.INTER_LINEAR)
+        return mask
+
+    def poll(self):
+        """{key: (mask, box, pts)} with the newest finished mask per key since the last call; never blocks"""
+        with self._lock:
+            self._check_health()
+            results = {}
+            while self._responses:
+                seq, ms, oks = self._responses.popleft()
+                pending = self._pending.pop(seq, None)
+                if pending is None:
+                    continue  # answer from a worker we already replaced
+                items, submitted_at = pending
+                self._restarts = 0  # the worker got a batch through: it is healthy again
+                pipeline_metrics.observe("segmentation", ms / 1000.0)
+                pipeline_metrics.observe("seg_roundtrip", time.time() - submitted_at)
+                pipeline_metrics.inc("segmentation_batches_total")
+                for (slot, key, box, pts, (h, w)), ok in zip(items, oks):
+                    pipeline_metrics.inc("segmentation_runs_total")
+                    if ok:
+                        # responses arrive in submission order, so later ones replace older masks
+                        results[key] = (self._read_mask(slot, h, w), box, pts)
+                    else:
+                        pipeline_metrics.inc("segmentation_fallbacks_total")
+                self._free.extend(item[0] for item in items)
+            pipeline_metrics.set_gauge("seg_worker_in_flight", len(self._pending))
+            return results
+
+
+# -------------------------
+# Worker side (python seg_worker.py ...)
+# -------------------------
+def _parse_size(text):
+    h, w = text.lower().split("x")
+    return int(h), int(w)
+
+def worker_main(argv=None):
+    parser = argparse.ArgumentParser(description="TREON segmentation worker (started by SegWorkerClient)")
+    parser.add_argument("--shm", required=True)
+    parser.add_argument("--slots", type=int, default=DEFAULT_SLOTS)
+    parser.add_argument("--max-crop", default=f"{DEFAULT_MAX_CROP[0]}x{DEFAULT_MAX_CROP[1]}")
+    parser.add_argument("--input-size", default="auto")
+    parser.add_argument("--threads", type=int, default=2)
+    parser.add_argument("--models-dir", default="models")
+    args = parser.parse_args(argv)
+
+    # stdout carries the protocol; everything else (model loading chatter) goes to stderr
+    proto = sys.stdout
+    sys.stdout = sys.stderr
+
+    import segmentation
+    input_size = segmentation.parse_input_size(args.input_size)
+    backend = segmentation.load_backend(args.models_dir, input_size=input_size, threads=max(1, args.threads))
+    if backend is None:
+        proto.write("READY 0\n")
+        proto.flush()
+        return 0
+
+    max_h, max_w = _parse_size(args.max_crop)
+    in_bytes, out_bytes = slot_layout(max_h, max_w)
+    shm = attach_shared_memory(args.shm)
+    proto.write(f"READY 1 {backend.name}\n")
+    proto.flush()
+
+    crops = out = None
+    try:
+        for line in sys.stdin:
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == "QUIT":
+                break
+            if parts[0] != "SEG":
+                continue
+            seq = int(parts[1])
+            fields = [int(p) for p in parts[2:]]
+            items = [fields[i:i + 3] for i in range(0, len(fields), 3)]
+            crops = []
+            for slot, h, w in items:
+                base = slot * (in_bytes + out_bytes)
+                crops.append(np.ndarray((h, w, 3), dtype=np.uint8, buffer=shm.buf[base:base + in_bytes]))
+            t0 = time.perf_counter()
+            try:
+                masks = segmentation.run_segmentation_batch(backend, crops, input_size)
+            except Exception as e:
+                print(f"⚠️ Segmentation failed on batch {seq}: {e}")
+                masks = [None] * len(crops)
+            for (slot, h, w), mask in zip(items, masks):
+                if mask is not None:
+                    base = slot * (in_bytes + out_bytes)
+                    out = np.ndarray((h, w), dtype=np.float32, buffer=shm.buf[base + in_bytes:base + in_bytes + out_bytes])
+                    out[:] = mask
+            elapsed_ms = (time.perf_counter() - t0) * 1000.0
+            oks = " ".join("1" if m is not None else "0" for m in masks)
+            proto.write(f"DONE {seq} {elapsed_ms:.3f} {oks}\n")
+            proto.flush()
+    finally:
+        crops = out = None  # release views into the segment before closing it
+        shm.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(worker_main())
@@ -0,0 +1,761 @@
+"""
+Lip segmentation model for TREON (BiSeNet-style, optional)
+- Inference backends behind one interface (infer(batch) -> numpy output):
+  TorchBackend (TorchScript / torch.load checkpoints, fp32) and OnnxBackend (ONNX Runtime CPU, fp32 or int8)
+- One-time export of the discovered .pth / .jit model to ONNX, optionally dynamic-int8 quantized;
+  an exported model is only used if its masks match the fp32 model (mean IoU + probability MAE parity
+  check on real lip crops: bundled models/parity_samples/ or the kiosk's own static/captures/)
+- Input size adapts to the lip crop: aspect-preserving letterbox into the smallest of a few fixed
+  size buckets (static shapes, warmed up once), undone again in postprocess_mask()
+- The model output is reduced to a soft lip probability (softmax mass of the upper / lower lip
+  classes, configurable per model) inside the model, so only a single-channel crop-sized map
+  reaches NumPy
+- torch is imported lazily, so a kiosk that ships the exported .onnx never loads it
+- Deliberately light: only numpy, OpenCV and the chosen runtime, no MediaPipe / Flask / Firebase,
+  so the out-of-process worker (seg_worker.py) can import it cheaply
+
+Pick the backend with TREON_SEG_BACKEND=auto|onnx|torch (auto prefers ONNX Runtime when installed),
+int8 with TREON_SEG_INT8=1|0, the input size with TREON_SEG_INPUT=auto|HxW (e.g. 512x512) and the
+lip classes with TREON_SEG_LIP_CLASSES=12,13 or models/lip_classes.json ({"bisenet.pth": [12, 13]}). Export ahead of time with:
+    python segmentation.py --export
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib.util
+import cv2
+import numpy as np
+
+# Optional runtimes, detected without importing them (torch alone costs hundreds of MB)
+TORCH_AVAILABLE = importlib.util.find_spec("torch") is not None
+ORT_AVAILABLE = importlib.util.find_spec("onnxruntime") is not None
+
+MODELS_DIR = "models"
+MODEL_EXTENSIONS = (".pth", ".jit")
+DEFAULT_INPUT_SIZE = (512, 512)  # fixed model input size (H, W), also the ONNX export shape
+# Adaptive input: each crop is letterboxed into the smallest bucket (H, W) that holds it (multiples of 32)
+SIZE_BUCKETS = ((64, 128), (128, 128), (128, 256), (192, 384), (256, 256), (256, 512), (512, 512))
+MIN_LONG_SIDE = 128  # crops smaller than this on their long side are upscaled before bucketing
+
+SEG_BACKEND = os.environ.get("TREON_SEG_BACKEND", "auto").strip().lower()
+SEG_INT8 = os.environ.get("TREON_SEG_INT8", "1").strip().lower() in ("1", "true", "yes", "on")
+PARITY_MIN_IOU = float(os.environ.get("TREON_SEG_PARITY_IOU", "0.90"))  # exported vs fp32 masks
+PARITY_MAX_MAE = float(os.environ.get("TREON_SEG_PARITY_MAE", "0.02"))  # mean |p_exported - p_fp32|
+# Real lip crops for the parity check: bundled crops first, then captures (frame + saved lip mask)
+PARITY_SAMPLE_DIRS = (os.path.join(MODELS_DIR, "parity_samples"), os.path.join("static", "captures"))
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+ONNX_OPSET = 17
+# Upper / lower lip class IDs (face-parsing BiSeNet on CelebAMask-HQ: 12 = upper lip, 13 = lower lip)
+DEFAULT_LIP_CLASSES = (12, 13)
+CLASS_MAP_FILE = "lip_classes.json"  # per-model overrides in models/, keyed by file name or stem
+
+
+def parse_input_size(text):
+    """'auto' -> None (adaptive size buckets), 'HxW' -> (H, W)"""
+    text = (text or "auto").strip().lower()
+    if text == "auto":
+        return None
+    h, w = text.split("x")
+    return int(h), int(w)
+
+SEG_INPUT_SIZE = parse_input_size(os.environ.get("TREON_SEG_INPUT", "auto"))
+
+_torch = None
+
+
+def get_torch():
+    """Import torch on first use (None if it is not installed)"""
+    global _torch
+    if _torch is None and TORCH_AVAILABLE:
+        import torch
+        _torch = torch
+    return _torch
+
+def lip_classes_for(model_path, models_dir=MODELS_DIR):
+    """Lip class IDs for a model: TREON_SEG_LIP_CLASSES, then models/lip_classes.json, then the default"""
+    env = os.environ.get("TREON_SEG_LIP_CLASSES")
+    if env:
+        return tuple(int(c) for c in env.split(",") if c.strip())
+    map_path = os.path.join(models_dir, CLASS_MAP_FILE)
+    if model_path and os.path.exists(map_path):
+        with open(map_path, "r", encoding="utf-8") as f:
+            mapping = json.load(f)
+        name = os.path.basename(model_path)
+        for key in (name, name.split(".")[0]):
+            if key in mapping:
+                return tuple(int(c) for c in mapping[key])
+    return DEFAULT_LIP_CLASSES
+
+def build_lip_head(model, lip_classes):
+    """Wrap a parsing model so it returns the (N, 1, H, W) lip probability instead of per-class logits"""
+    torch = get_torch()
+
+    class LipProbability(torch.nn.Module):
+        def __init__(self, net, classes):
+            super().__init__()
+            self.net = net
+            self.register_buffer("classes", torch.tensor(classes, dtype=torch.long))
+
+        def forward(self, x):
+            out = select_output(self.net(x))
+            if out.shape[1] == 1:
+                return out.clamp(0.0, 1.0)  # model already outputs a single mask channel
+            return torch.softmax(out, dim=1).index_select(1, self.classes).sum(dim=1, keepdim=True)
+
+    return LipProbability(model, lip_classes).eval()
+
+def default_device():
+    torch = get_torch()
+    if torch is None:
+        return None
+    # Prefer CUDA if available
+    return torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+
+# -------------------------
+# Backends
+# -------------------------
+class TorchBackend:
+    """fp32 PyTorch model (TorchScript or eager) on CPU / CUDA, with the lip-probability head on the device"""
+
+    def __init__(self, model, device, source=None, threads=None, lip_classes=DEFAULT_LIP_CLASSES):
+        self.lip_classes = tuple(lip_classes)
+        self.model = build_lip_head(model, self.lip_classes).to(device)
+        self.device = device
+        self.source = source
+        self.name = "torch"
+        self.buckets = SIZE_BUCKETS  # input shapes known to work (see warmup_backend)
+        self.batching = True         # several faces per forward pass (see run_segmentation_batch)
+        if threads:
+            get_torch().set_num_threads(threads)
+
+    def infer(self, batch):
+        """(1, 1, H, W) lip probability at the input resolution"""
+        torch = get_torch()
+        with torch.no_grad():
+            return self.model(torch.from_numpy(batch).to(self.device)).cpu().numpy()
+
+    def infer_mask(self, batch, letterbox_box, target_size):
+        return self.infer_masks(batch, [letterbox_box], [target_size])[0]
+
+    def infer_masks(self, batch, letterbox_boxes, target_sizes):
+        """One forward pass over the batch; each item's lip probability is cropped out of its
+        letterbox and resized to its target_size on the device"""
+        torch = get_torch()
+        masks = []
+        with torch.no_grad():
+            probs = self.model(torch.from_numpy(batch).to(self.device))
+            for i, (lb, target_size) in enumerate(zip(letterbox_boxes, target_sizes)):
+                prob = probs[i:i + 1]
+                if lb is not None:
+                    prob = prob[(Ellipsis,) + letterbox_slices(lb, prob.shape[-2], prob.shape[-1])]
+                prob = torch.nn.functional.interpolate(prob, size=tuple(target_size), mode="bilinear", align_corners=False)
+                masks.append(prob[0, 0].cpu().numpy())
+        return masks
+
+    def __repr__(self):
+        return f"TorchBackend({os.path.basename(self.source or '?')}, {self.device})"
+
+
+class OnnxBackend:
+    """ONNX Runtime CPU session (fp32, or int8 when loaded from a *.int8.onnx file)"""
+
+    def __init__(self, path, threads=None, lip_classes=DEFAULT_LIP_CLASSES):
+        import onnxruntime as ort
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            opts.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, sess_options=opts, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.path = path
+        self.name = "onnx-int8" if path.endswith(".int8.onnx") else "onnx"
+        self.buckets = SIZE_BUCKETS
+        self.batching = True
+        self.lip_classes = tuple(lip_classes)  # only used if the graph has no lip head (shipped .onnx)
+
+    def infer(self, batch):
+        # first output == what select_output() picks from a tuple / dict returning torch model
+        return self.session.run(None, {self.input_name: batch})[0]
+
+    def infer_mask(self, batch, letterbox_box, target_size):
+        return self.infer_masks(batch, [letterbox_box], [target_size])[0]
+
+    def infer_masks(self, batch, letterbox_boxes, target_sizes):
+        out = self.infer(batch)
+        return [postprocess_mask(out[i:i + 1], target_size, lb, self.lip_classes)
+                for i, (lb, target_size) in enumerate(zip(letterbox_boxes, target_sizes))]
+
+    def __repr__(self):
+        return f"OnnxBackend({os.path.basename(self.path)})"
+
+
+# -------------------------
+# Torch model loading
+# -------------------------
+def load_torch_model(models_dir=MODELS_DIR, device=None):
+    """Try every .pth / .jit in models_dir; returns (model, device, path) or (None, device, None)"""
+    torch = get_torch()
+    if torch is None:
+        print("🔸 PyTorch not available — skipping segmentation model load.")
+        return None, None, None
+    device = device or default_device()
+
+    # Check if models directory exists and has any model files
+    if not os.path.exists(models_dir):
+        print(f"❌ Models directory '{models_dir}' not found")
+        return None, device, None
+
+    pth_files = sorted(f for f in os.listdir(models_dir) if f.endswith(MODEL_EXTENSIONS))
+
+    if not pth_files:
+        print("❌ No .pth files found in models directory")
+        return None, device, None
+
+    print(f"🔍 Found {len(pth_files)} model files: {pth_files}")
+
+    # Try loading each model file
+    for model_file in pth_files:
+        model_path = os.path.join(models_dir, model_file)
+        try:
+            print(f"🔄 Attempting to load {model_file}...")
+
+            # Try to load as a traced/scripted model first
+            try:
+                model = torch.jit.load(model_path, map_location=device)
+                model_type = "scripted"
+            except:
+                # If that fails, try loading as a regular PyTorch model
+                try:
+                    checkpoint = torch.load(model_path, map_location=device)
+
+                    # Handle different checkpoint formats
+                    if isinstance(checkpoint, torch.nn.Module):
+                        model = checkpoint
+                    elif 'state_dict' in checkpoint:
+                        # This is likely a BiSeNet model
+                        from models import BiSeNet  # You might need to import your model class
+                        model = BiSeNet(n_classes=19)  # Adjust based on your model
+                        model.load_state_dict(checkpoint['state_dict'])
+                    else:
+                        # Try to use the checkpoint directly as state_dict
+                        from models import BiSeNet
+                        model = BiSeNet(n_classes=19)  # Adjust based on your model
+                        model.load_state_dict(checkpoint)
+
+                    model_type = "regular"
+                except Exception as e:
+                    print(f"⚠️ Failed to load {model_file} as regular model: {e}")
+                    continue
+
+            model.to(device)
+            model.eval()
+            print(f"✅ Successfully loaded {model_type} model from {model_file}")
+            return model, device, model_path
+
+        except Exception as e:
+            print(f"❌ Failed to load {model_file}: {e}")
+            continue
+
+    print("❌ No usable segmentation model found from any .pth file")
+    return None, device, None
+
+def find_model_source(models_dir=MODELS_DIR):
+    """First .pth / .jit file in models_dir (what load_torch_model would try first), or None"""
+    if not os.path.isdir(models_dir):
+        return None
+    files = sorted(f for f in os.listdir(models_dir) if f.endswith(MODEL_EXTENSIONS))
+    return os.path.join(models_dir, files[0]) if files else None
+
+
+# -------------------------
+# ONNX export / quantization / parity
+# -------------------------
+def onnx_paths(source_path):
+    """(fp32 .onnx, int8 .int8.onnx, .onnx.json metadata) next to the source model"""
+    stem = os.path.splitext(source_path)[0]
+    return stem + ".onnx", stem + ".int8.onnx", stem + ".onnx.json"
+
+def export_onnx(model, device, onnx_path, input_size=None):
+    """
+    Export a torch model (TorchBackend.model, lip head included) to ONNX with dynamic H/W
+    so smaller input buckets need no re-export
+    """
+    torch = get_torch()
+    h, w = input_size or DEFAULT_INPUT_SIZE
+    dummy = torch.zeros(1, 3, h, w, device=device)
+    kwargs = dict(
+        input_names=["input"],
+        dynamic_axes={"input": {0: "batch", 2: "height", 3: "width"}},
+        opset_version=ONNX_OPSET,
+        do_constant_folding=True,
+    )
+    with torch.no_grad():
+        # trace first: the exporter cannot call into a loaded TorchScript model from an eager wrapper
+        traced = torch.jit.trace(model, dummy, check_trace=False)
+        try:
+            # TorchScript-based exporter: handles scripted models and needs no onnxscript
+            torch.onnx.export(traced, dummy, onnx_path, dynamo=False, **kwargs)
+        except TypeError:
+            torch.onnx.export(traced, dummy, onnx_path, **kwargs)  # torch < 2.5 has no dynamo flag
+    print(f"💾 Exported ONNX model to {onnx_path}")
+    return onnx_path
+
+def quantize_onnx(onnx_path, int8_path):
+    """Dynamic int8 quantization (weights int8, activations quantized on the fly)"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QInt8)
+    print(f"💾 Quantized ONNX model to {int8_path}")
+    return int8_path
+
+def mask_iou(a, b, thresh=0.5):
+    """IoU of the thresholded masks; None when both are empty (no evidence either way)"""
+    a = a > thresh
+    b = b > thresh
+    union = np.logical_or(a, b).sum()
+    if union == 0:
+        return None
+    return float(np.logical_and(a, b).sum() / union)
+
+def lip_crop(frame, mask, pad=0.25):
+    """Crop a capture frame to the bounding box of its saved lip mask (padded), or None"""
+    ys, xs = np.nonzero(mask > 127)
+    if len(xs) == 0:
+        return None
+    x0, x1, y0, y1 = xs.min(), xs.max() + 1, ys.min(), ys.max() + 1
+    px, py = int((x1 - x0) * pad), int((y1 - y0) * pad)
+    h, w = frame.shape[:2]
+    return frame[max(y0 - py, 0):min(y1 + py, h), max(x0 - px, 0):min(x1 + px, w)]
+
+def real_samples(sample_dirs, count=8):
+    """
+    Real lip crops from sample_dirs (recursive): a capture with a matching *_mask_* PNG is cropped
+    to the mask, any other image is taken as an already-cropped lip image
+    """
+    samples = []
+    for sample_dir in sample_dirs:
+        if not sample_dir or not os.path.isdir(sample_dir):
+            continue
+        for root, _, files in os.walk(sample_dir):
+            names = set(files)
+            for f in sorted(files):
+                if not f.lower().endswith(IMAGE_EXTENSIONS) or "_mask_" in f:
+                    continue
+                img = cv2.imread(os.path.join(root, f))
+                if img is None:
+                    continue
+                stem = os.path.splitext(f)[0]
+                mask_name = stem.replace("_lipstick_", "_mask_") + ".png"
+                if "_lipstick_" in stem and mask_name in names:
+                    mask = cv2.imread(os.path.join(root, mask_name), cv2.IMREAD_GRAYSCALE)
+                    img = lip_crop(img, mask) if mask is not None and mask.shape == img.shape[:2] else None
+                    if img is None or min(img.shape[:2]) < 8:
+                        continue
+                samples.append(img)
+                if len(samples) >= count:
+                    return samples
+    return samples
+
+def has_real_samples(sample_dirs):
+    """Cheap check (no decoding) whether any sample dir holds an image"""
+    for sample_dir in sample_dirs:
+        if sample_dir and os.path.isdir(sample_dir):
+            for _, _, files in os.walk(sample_dir):
+                if any(f.lower().endswith(IMAGE_EXTENSIONS) for f in files):
+                    return True
+    return False
+
+def synthetic_samples(count=8, size=(160, 240)):
+    """Gradient + lip-colored ellipse patterns: only a smoke test, they rarely look like lips to the model"""
+    rng = np.random.default_rng(0)
+    samples = []
+    while len(samples) < count:
+        h, w = size
+        img = np.dstack([
+            np.tile(np.linspace(rng.integers(30, 120), rng.integers(120, 230), w), (h, 1)),
+            np.tile(np.linspace(rng.integers(30, 120), rng.integers(120, 230), h)[:, None], (1, w)),
+            np.full((h, w), rng.integers(100, 200)),
+        ]).astype(np.uint8)
+        center = (int(rng.integers(w // 3, 2 * w // 3)), int(rng.integers(h // 3, 2 * h // 3)))
+        axes = (int(rng.integers(w // 6, w // 3)), int(rng.integers(h // 8, h // 4)))
+        cv2.ellipse(img, center, axes, 0, 0, 360, (int(rng.integers(40, 110)), int(rng.integers(30, 90)), int(rng.integers(140, 220))), -1)
+        samples.append(img)
+    return samples
+
+def parity_samples(sample_dir=None, count=8):
+    """(BGR crops, "real" | "synthetic"): real lip crops from sample_dir or PARITY_SAMPLE_DIRS if any"""
+    samples = real_samples([sample_dir] if sample_dir else PARITY_SAMPLE_DIRS, count)
+    if samples:
+        return samples, "real"
+    print("⚠️ No real lip crops for the parity check (add some to models/parity_samples/ or capture a few "
+          "try-ons) — using synthetic patterns, which only the probability MAE can judge")
+    return synthetic_samples(count), "synthetic"
+
+def parity_check(reference, candidate, samples, input_size=None):
+    """
+    Candidate vs reference backend over the sample crops: mean / min mask IoU over the samples where
+    either mask has lips ("evidence"), and mean absolute error of the soft lip probabilities over all
+    """
+    ious, errors = [], []
+    for crop in samples:
+        batch, lb = preprocess_for_model(crop, input_size)
+        target = (crop.shape[0], crop.shape[1])
+        ref = reference.infer_mask(batch, lb, target)
+        cand = candidate.infer_mask(batch, lb, target)
+        errors.append(float(np.mean(np.abs(ref - cand))))
+        iou = mask_iou(ref, cand)
+        if iou is not None:
+            ious.append(iou)
+    return {
+        "iou": round(float(np.mean(ious)), 4) if ious else None,
+        "iou_min": round(float(np.min(ious)), 4) if ious else None,
+        "mae": round(float(np.mean(errors)), 5),
+        "evidence": len(ious),
+        "samples": len(samples),
+    }
+
+def parity_ok(result):
+    """MAE always has to pass; IoU only where some sample had lips to compare"""
+    if result["mae"] > PARITY_MAX_MAE:
+        return False
+    return result["evidence"] == 0 or result["iou"] >= PARITY_MIN_IOU
+
+def describe_parity(result):
+    if result["evidence"] == 0:
+        return f"no lips in any of {result['samples']} samples (IoU: no evidence), MAE {result['mae']:.4f}"
+    return (f"mean IoU {result['iou']:.4f} (min {result['iou_min']:.4f}) on {result['evidence']}/"
+            f"{result['samples']} samples, MAE {result['mae']:.4f}")
+
+def time_backend(backend, input_size=None, runs=3):
+    """Median inference time in ms on a blank input (after one warm-up run)"""
+    h, w = input_size or SIZE_BUCKETS[2]  # typical lip crop bucket in adaptive mode
+    batch = np.zeros((1, 3, h, w), dtype=np.float32)
+    backend.infer(batch)
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        backend.infer(batch)
+        times.append((time.perf_counter() - t0) * 1000.0)
+    return round(float(np.median(times)), 3)
+
+def prepare_onnx(models_dir=MODELS_DIR, int8=SEG_INT8, input_size=SEG_INPUT_SIZE,
+                 threads=None, force=False, sample_dir=None):
+    """
+    ONNX backend for the model in models_dir, exporting / quantizing it once if needed.
+    Returns an OnnxBackend, a TorchBackend (export failed parity) or None.
+    """
+    source = find_model_source(models_dir)
+    if source is None:
+        # no torch model: use a shipped .onnx as-is (int8 preferred if allowed)
+        shipped = sorted(f for f in os.listdir(models_dir) if f.endswith(".onnx")) if os.path.isdir(models_dir) else []
+        if int8:
+            shipped.sort(key=lambda f: not f.endswith(".int8.onnx"))
+        else:
+            shipped = [f for f in shipped if not f.endswith(".int8.onnx")]
+        if not shipped:
+            return None
+        path = os.path.join(models_dir, shipped[0])
+        return OnnxBackend(path, threads, lip_classes_for(path, models_dir))
+
+    onnx_path, int8_path, meta_path = onnx_paths(source)
+    lip_classes = lip_classes_for(source, models_dir)
+    meta = {}
+    if os.path.exists(meta_path) and not force:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+    up_to_date = (meta.get("source_mtime") == os.path.getmtime(source)
+                  and meta.get("lip_classes") == list(lip_classes)  # the lip head is baked into the graph
+                  and (os.path.exists(onnx_path) or not meta.get("fp32_ok"))
+                  # checked on synthetic patterns only: redo it once real lip crops exist
+                  and not (meta.get("samples") == "synthetic"
+                           and has_real_samples([sample_dir] if sample_dir else PARITY_SAMPLE_DIRS)))
+    if up_to_date:
+        if not meta.get("fp32_ok"):
+            return None  # export was rejected earlier; caller falls back to torch
+        if int8 and meta.get("int8_ok") and meta.get("int8_faster", True) and os.path.exists(int8_path):
+            return OnnxBackend(int8_path, threads, lip_classes)
+        return OnnxBackend(onnx_path, threads, lip_classes)
+
+    # one-time export (needs torch, only on the first run after the model file changes)
+    model, device, path = load_torch_model(models_dir)
+    if model is None:
+        return None
+    reference = TorchBackend(model, device, path, threads, lip_classes)
+    samples, sample_kind = parity_samples(sample_dir)
+    meta = {
+        "source": os.path.basename(source),
+        "source_mtime": os.path.getmtime(source),
+        "exported_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "input_size": list(input_size) if input_size else "auto",
+        "lip_classes": list(lip_classes),
+        "samples": sample_kind,
+        "min_iou": PARITY_MIN_IOU,
+        "max_mae": PARITY_MAX_MAE,
+        "fp32_ok": False,
+        "int8_ok": False,
+    }
+    chosen = reference
+    try:
+        export_onnx(reference.model, device, onnx_path, input_size)
+        fp32 = OnnxBackend(onnx_path, threads, lip_classes)
+        meta["fp32_parity"] = parity_check(reference, fp32, samples, input_size)
+        meta["fp32_ok"] = parity_ok(meta["fp32_parity"])
+        meta["fp32_ms"] = time_backend(fp32, input_size)
+        print(f"🧮 ONNX fp32 parity: {describe_parity(meta['fp32_parity'])}")
+        if meta["fp32_ok"]:
+            chosen = fp32
+            if int8:
+                quantize_onnx(onnx_path, int8_path)
+                q = OnnxBackend(int8_path, threads, lip_classes)
+                meta["int8_parity"] = parity_check(reference, q, samples, input_size)
+                meta["int8_ok"] = parity_ok(meta["int8_parity"])
+                meta["int8_ms"] = time_backend(q, input_size)
+                meta["int8_faster"] = meta["int8_ms"] < meta["fp32_ms"]
+                print(f"🧮 ONNX int8 parity: {describe_parity(meta['int8_parity'])}, "
+                      f"{meta['int8_ms']:.1f} ms vs {meta['fp32_ms']:.1f} ms fp32")
+                if not meta["int8_ok"]:
+                    print("⚠️ int8 model failed the parity check — keeping fp32 ONNX")
+                elif not meta["int8_faster"]:
+                    print("🔸 int8 model is not faster on this CPU — keeping fp32 ONNX")
+                else:
+                    chosen = q
+        else:
+            print("⚠️ ONNX export failed the parity check — keeping the torch model")
+    except Exception as e:
+        meta["error"] = str(e)
+        print(f"❌ ONNX export failed: {e}")
+
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=4)
+    return chosen
+
+def warmup_backend(backend, input_size=None):
+    """
+    Run every input shape once so real frames never pay for graph setup / allocation, and keep
+    only the buckets the model accepts (traced models may be shape-specialized)
+    """
+    if input_size is not None:
+        backend.infer(np.zeros((1, 3, input_size[0], input_size[1]), dtype=np.float32))
+        return
+    working = []
+    for h, w in SIZE_BUCKETS:
+        try:
+            backend.infer(np.zeros((1, 3, h, w), dtype=np.float32))
+            working.append((h, w))
+        except Exception:
+            continue
+    backend.buckets = tuple(working)
+    if not working:
+        print(f"⚠️ Model rejected every size bucket — using fixed {DEFAULT_INPUT_SIZE[0]}x{DEFAULT_INPUT_SIZE[1]} input")
+
+def load_backend(models_dir=MODELS_DIR, kind=SEG_BACKEND, int8=SEG_INT8, input_size=SEG_INPUT_SIZE, threads=None):
+    """Best available inference backend for the model in models_dir (warmed up), or None"""
+    backend = _select_backend(models_dir, kind, int8, input_size, threads)
+    if backend is not None:
+        try:
+            warmup_backend(backend, input_size)
+        except Exception as e:
+            print(f"⚠️ Segmentation warm-up failed: {e}")
+    return backend
+
+def _select_backend(models_dir, kind, int8, input_size, threads):
+    if kind in ("auto", "onnx"):
+        if ORT_AVAILABLE:
+            try:
+                backend = prepare_onnx(models_dir, int8, input_size, threads)
+            except Exception as e:
+                print(f"⚠️ ONNX Runtime backend unavailable: {e}")
+                backend = None
+            if backend is not None:
+                print(f"✅ Segmentation backend: {backend!r}")
+                return backend
+        elif kind == "onnx":
+            print("⚠️ onnxruntime not installed — falling back to torch")
+
+    model, device, path = load_torch_model(models_dir)
+    if model is None:
+        return None
+    backend = TorchBackend(model, device, path, threads, lip_classes_for(path, models_dir))
+    print(f"✅ Segmentation backend: {backend!r}")
+    return backend
+
+
+# -------------------------
+# Pre / post processing
+# -------------------------
+def choose_bucket(h, w, buckets=SIZE_BUCKETS, min_long_side=MIN_LONG_SIDE):
+    """(bucket, scale) for an h x w crop: the smallest bucket that holds it at native scale"""
+    scale = max(1.0, min_long_side / max(h, w))
+    fits = [b for b in buckets if b[0] >= h * scale and b[1] >= w * scale]
+    if fits:
+        return min(fits, key=lambda b: b[0] * b[1]), scale
+    # bigger than every bucket: shrink into the largest one
+    bucket = max(buckets, key=lambda b: b[0] * b[1])
+    return bucket, min(bucket[0] / h, bucket[1] / w)
+
+def letterbox(img, bucket, scale):
+    """
+    Resize img by scale (aspect preserved) and pad it to bucket (H, W), centered.
+    Returns (padded, (x0, y0, x1, y1, H, W)) where the box is the image inside the bucket.
+    """
+    h, w = img.shape[:2]
+    bh, bw = bucket
+    nh = min(max(int(round(h * scale)), 1), bh)
+    nw = min(max(int(round(w * scale)), 1), bw)
+    if (nh, nw) != (h, w):
+        img = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_LINEAR if scale >= 1.0 else cv2.INTER_AREA)
+    top = (bh - nh) // 2
+    left = (bw - nw) // 2
+    # replicate the crop border so the model sees no artificial edge next to the lips
+    padded = cv2.copyMakeBorder(img, top, bh - nh - top, left, bw - nw - left, cv2.BORDER_REPLICATE)
+    return padded, (left, top, left + nw, top + nh, bh, bw)
+
+def preprocess_for_model(img_bgr, size=None, buckets=SIZE_BUCKETS):
+    """
+    Fit the crop to the model input and normalize to 0..1: plain resize to size (H, W), or with
+    size=None an aspect-preserving letterbox into the smallest fitting bucket.
+    Returns (float32 (1, C, H, W) array, letterbox box or None).
+    """
+    lb = None
+    if size is None and buckets:
+        img, lb = letterbox(img_bgr, *choose_bucket(img_bgr.shape[0], img_bgr.shape[1], buckets))
+    else:
+        size = size or DEFAULT_INPUT_SIZE
+        img = cv2.resize(img_bgr, (size[1], size[0]), interpolation=cv2.INTER_LINEAR)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    img = img.astype(np.float32) / 255.0
+    img = np.transpose(img, (2, 0, 1))  # CHW
+    return np.expand_dims(img, 0).copy(), lb  # 1,C,H,W
+
+def preprocess_batch(crops, size=None, buckets=SIZE_BUCKETS):
+    """
+    Several crops as one (B, C, H, W) batch: all letterboxed into the smallest bucket that holds
+    the largest of them (or plain-resized to size). Returns (batch, [letterbox box or None, ...]).
+    """
+    if len(crops) == 1 or size is not None or not buckets:
+        items = [preprocess_for_model(c, size, buckets) for c in crops]
+        return np.concatenate([b for b, _ in items]), [lb for _, lb in items]
+
+    max_h = max(c.shape[0] for c in crops)
+    max_w = max(c.shape[1] for c in crops)
+    bucket, _ = choose_bucket(max_h, max_w, buckets)
+    batch = np.empty((len(crops), 3, bucket[0], bucket[1]), dtype=np.float32)
+    boxes = []
+    for i, crop in enumerate(crops):
+        h, w = crop.shape[:2]
+        scale = min(max(1.0, MIN_LONG_SIDE / max(h, w)), bucket[0] / h, bucket[1] / w)
+        img, lb = letterbox(crop, bucket, scale)
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        batch[i] = np.transpose(img, (2, 0, 1)) / np.float32(255.0)
+        boxes.append(lb)
+    return batch, boxes
+
+def select_output(out):
+    """Pick the mask tensor out of whatever the model returned (tensor, list/tuple or dict)"""
+    if isinstance(out, (list, tuple)):
+        return out[0]
+    if isinstance(out, dict):
+        # common keys
+        for k in ('out', 'mask', 'pred'):
+            if k in out:
+                return out[k]
+        # fallback: use first value
+        return list(out.values())[0]
+    return out
+
+def letterbox_slices(letterbox_box, out_h, out_w):
+    """(rows, cols) slices of the un-padded crop inside a model output of size out_h x out_w"""
+    x0, y0, x1, y1, bh, bw = letterbox_box
+    fy, fx = out_h / bh, out_w / bw
+    oy0, ox0 = int(y0 * fy), int(x0 * fx)
+    return slice(oy0, max(int(round(y1 * fy)), oy0 + 1)), slice(ox0, max(int(round(x1 * fx)), ox0 + 1))
+
+def lip_probability(logits, lip_classes=DEFAULT_LIP_CLASSES):
+    """Softmax probability mass of the lip classes: (C, H, W) logits -> (H, W) in [0, 1]"""
+    logits = logits.astype(np.float32, copy=False)
+    e = np.exp(logits - logits.max(axis=0, keepdims=True))
+    return e[list(lip_classes)].sum(axis=0) / e.sum(axis=0)
+
+def postprocess_mask(mask_pred, target_size, letterbox_box=None, lip_classes=DEFAULT_LIP_CLASSES):
+    """
+    Convert a model output into a soft lip mask in [0, 1] resized to target_size (H,W).
+    Single-channel outputs (lip head / mask models) are used as probabilities; per-class logits
+    (C, H, W) are reduced to the softmax mass of lip_classes.
+    letterbox_box (from preprocess_for_model) crops the padding away first, at the output's resolution.
+    """
+    arr = np.asarray(mask_pred)
+    if arr.ndim == 4 and arr.shape[0] == 1:
+        arr = arr[0]
+    if arr.ndim == 2:
+        arr = arr[None]
+    if letterbox_box is not None:
+        arr = arr[(slice(None),) + letterbox_slices(letterbox_box, arr.shape[-2], arr.shape[-1])]
+
+    if arr.shape[0] == 1:
+        mask = np.clip(arr[0].astype(np.float32), 0.0, 1.0)
+    else:
+        mask = lip_probability(arr, lip_classes)
+
+    # Resize to target
+    mask_resized = cv2.resize(mask, (target_size[1], target_size[0]), interpolation=cv2.INTER_LINEAR)
+    return mask_resized
+
+# -------------------------
+# Inference
+# -------------------------
+def run_segmentation(backend, crop_bgr, input_size=None):
+    """Lip mask in [0,1] at the crop's size, or None if the model produced nothing usable"""
+    return run_segmentation_batch(backend, [crop_bgr], input_size)[0]
+
+def run_segmentation_batch(backend, crops, input_size=None):
+    """
+    Lip masks for several crops (one per face) from a single model call.
+    Returns a list with a mask or None per crop. Models that reject batches > 1
+    (e.g. a shipped .onnx with a fixed batch axis) are remembered and fed one crop at a time.
+    """
+    buckets = getattr(backend, "buckets", SIZE_BUCKETS)
+    targets = [(c.shape[0], c.shape[1]) for c in crops]
+    if len(crops) > 1 and not backend.batching:
+        masks = []
+        for crop, target in zip(crops, targets):
+            batch, lbs = preprocess_batch([crop], input_size, buckets)
+            masks.extend(backend.infer_masks(batch, lbs, [target]))
+    else:
+        batch, lbs = preprocess_batch(crops, input_size, buckets)
+        try:
+            masks = backend.infer_masks(batch, lbs, targets)
+        except Exception as e:
+            if len(crops) == 1:
+                raise
+            print(f"⚠️ {backend.name} model does not take batches ({e}) — running faces one by one")
+            backend.batching = False
+            return run_segmentation_batch(backend, crops, input_size)
+    # no pixel is more likely lips than not -> None so callers fall back to landmarks
+    return [m if m.max() >= 0.5 else None for m in masks]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the TREON segmentation model to ONNX (+ int8) with a parity check")
+    parser.add_argument("--export", action="store_true", help="(re)export even if an up-to-date .onnx exists")
+    parser.add_argument("--models-dir", default=MODELS_DIR)
+    parser.add_argument("--no-int8", action="store_true", help="skip dynamic int8 quantization")
+    parser.add_argument("--samples", help="folder of lip crops / captures for the parity check "
+                                          "(default: models/parity_samples, then static/captures)")
+    args = parser.parse_args()
+
+    if not ORT_AVAILABLE:
+        print("❌ onnxruntime is not installed")
+        return 1
+    backend = prepare_onnx(args.models_dir, int8=not args.no_int8, force=args.export, sample_dir=args.samples)
+    if backend is None:
+        print("❌ No segmentation model to export")
+        return 1
+    print(f"✅ Runtime backend: {backend!r}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+"""
+Visitor session store for app.py
+- Sessions are compact __slots__ records (SessionRecord) held in a bounded in-memory LRU
+  (TREON_SESSION_MAX); the least recently used ones are dropped from memory only after they are
+  saved, and loaded back from disk on demand
+- A session idle for TREON_SESSION_TTL seconds is finalized through the same code path as
+  /end_session (the on_expire callback, app.finalize_session) and removed, so visitors who walk
+  away no longer stay in memory for the life of the kiosk process
+- Write-behind: changed sessions are flushed to a local SQLite file (WAL) every
+  TREON_SESSION_FLUSH seconds and on shutdown, so a restart resumes the live sessions
+- Shared by default (TREON_SESSION_SHARED=1), so several server worker processes can use the
+  same file: every change is a read-modify-write inside one SQLite write transaction, and ending /
+  expiring a session claims its row first (expiry only while the row is still idle), so each
+  session is finalized exactly once. TREON_SESSION_SHARED=0 skips the per-change write for a
+  single-process server only: there another process's sweep can see stale rows
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+SESSION_TTL = float(os.environ.get("TREON_SESSION_TTL", "900"))           # idle seconds before expiry
+SESSION_MAX = max(1, int(os.environ.get("TREON_SESSION_MAX", "500")))      # records kept in memory
+FLUSH_INTERVAL = float(os.environ.get("TREON_SESSION_FLUSH", "5"))
+SESSION_SHARED = os.environ.get("TREON_SESSION_SHARED", "1").strip().lower() in ("1", "true", "yes", "on")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    last_activity REAL NOT NULL,
+    rev INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_idle ON sessions (last_activity);
+"""
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    raise TypeError(f"Cannot store {type(value).__name__} in a session")
+
+def _decode(obj):
+    if len(obj) == 1 and "$dt" in obj:
+        return datetime.fromisoformat(obj["$dt"])
+    return obj
+
+
+class SessionRecord:
+    """One visitor's try-on session (same fields as the old sessions dict entries)"""
+
+    __slots__ = ("user_id", "start_time", "end_time", "shades", "current_shade_id", "current_brand",
+                 "current_shade_start", "shade_ratings", "feedback", "last_activity", "rev", "dirty")
+
+    FIELDS = ("start_time", "end_time", "shades", "current_shade_id", "current_brand",
+              "current_shade_start", "shade_ratings", "feedback")
+
+    def __init__(self, user_id, start_time, current_shade_id=1, current_brand="MAC"):
+        self.user_id = user_id
+        self.start_time = start_time
+        self.end_time = None
+        self.shades = []
+        self.current_shade_id = current_shade_id
+        self.current_brand = current_brand
+        self.current_shade_start = start_time
+        self.shade_ratings = []
+        self.feedback = None
+        self.last_activity = time.time()
+        self.rev = 0
+        self.dirty = True
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def dumps(self):
+        return json.dumps(self.to_dict(), default=_encode, ensure_ascii=False)
+
+    @classmethod
+    def loads(cls, user_id, data, last_activity, rev):
+        fields = json.loads(data, object_hook=_decode)
+        record = cls(user_id, fields["start_time"])
+        for name in cls.FIELDS:
+            setattr(record, name, fields.get(name))
+        record.shades = record.shades or []
+        record.shade_ratings = record.shade_ratings or []
+        record.last_activity = last_activity
+        record.rev = rev
+        record.dirty = False
+        return record
+
+
+class SessionStore:
+    """
+    Usage:
+        sessions = SessionStore("sessions.db", on_expire=finalize_session)
+        sessions.start()
+        sessions.create(user_id, start_time)
+        with sessions.edit(user_id) as session:     # None for an unknown session
+            session.current_brand = "MAC"
+        session = sessions.pop(user_id)             # claim it for finalizing (None if already gone)
+    """
+
+    def __init__(self, path="sessions.db", ttl=SESSION_TTL, max_entries=SESSION_MAX,
+                 flush_interval=FLUSH_INTERVAL, shared=SESSION_SHARED, on_expire=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self.on_expire = on_expire
+        self._records = OrderedDict()       # user_id -> SessionRecord, least recently used first
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._thread = None
+        self.expired = 0
+
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+    def _conn(self):
+        """One SQLite connection per thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # -------------------------
+    # Records
+    # -------------------------
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __len__(self):
+        return len(self._records)
+
+    def create(self, user_id, start_time, **defaults):
+        record = SessionRecord(user_id, start_time, **defaults)
+        with self._lock:
+            self._remember(record)
+            if self.shared:
+                self._write_through(record)
+        return record
+
+    def get(self, user_id):
+        """The session (loaded from disk if this process does not hold it), or None"""
+        if not user_id:
+            return None
+        with self._lock:
+            record = self._records.get(user_id)
+            if record is not None and not self.shared:
+                self._records.move_to_end(user_id)
+                return record
+            # shared: another worker may have changed it since we cached it
+            row = self._conn().execute(
+                "SELECT data, last_activity, rev FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                if record is not None and not record.dirty:
+                    # ended or expired by another worker
+                    self._records.pop(user_id, None)
+                    return None
+                return record
+            if record is None or record.rev < row[2]:
+                record = SessionRecord.loads(user_id, *row)
+            self._remember(record)
+            return record
+
+    @contextmanager
+    def edit(self, user_id):
+        """Change a session; it is marked active and saved (at once when shared, else by the flusher)"""
+        with self._lock:
+            conn = self._conn()
+            if self.shared:
+                conn.execute("BEGIN IMMEDIATE")
+            try:
+                record = self.get(user_id)
+                yield record
+                if record is not None:
+                    record.last_activity = time.time()
+                    record.dirty = True
+                    if self.shared:
+                        self._write_through(record)
+                if self.shared:
+                    conn.execute("COMMIT")
+            except BaseException:
+                if self.shared:
+                    conn.execute("ROLLBACK")
+                raise
+
+    def pop(self, user_id, idle_before=None):
+        """
+        Remove a session for finalizing; only one caller (thread or process) gets the record.
+        With idle_before, the row is only claimed if it was not active since then (expiry).
+        """
+        with self._lock:
+            record = self.get(user_id)
+            if record is None:
+                return None
+            if idle_before is None:
+                claimed = self._conn().execute("DELETE FROM sessions WHERE user_id = ?", (user_id,)).rowcount
+            else:
+                # another worker may have touched the session since we read it
+                claimed = self._conn().execute("DELETE FROM sessions WHERE user_id = ? AND last_activity < ?",
+                                               (user_id, idle_before)).rowcount
+            if self.shared and not claimed:
+                return None
+            self._records.pop(user_id, None)
+            return record
+
+    def _remember(self, record):
+        self._records[record.user_id] = record
+        self._records.move_to_end(record.user_id)
+        if len(self._records) > self.max_entries:
+            self._shrink()
+
+    def _shrink(self):
+        """Drop least recently used records from memory; unsaved ones are written first"""
+        overflow = list(self._records.values())[:len(self._records) - self.max_entries]
+        self._save([r for r in overflow if r.dirty])
+        for record in overflow:
+            del self._records[record.user_id]
+
+    # -------------------------
+    # Persistence
+    # -------------------------
+    def _write_through(self, record):
+        record.rev += 1
+        self._conn().execute(
+            "INSERT OR REPLACE INTO sessions (user_id, data, last_activity, rev) VALUES (?, ?, ?, ?)",
+            (record.user_id, record.dumps(), record.last_activity, record.rev))
+        record.dirty = False
+
+    def _save(self, records):
+        if not records:
+            return 0
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for record in records:
+                self._write_through(record)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            for record in records:
+                record.dirty = True
+            raise
+        return len(records)
+
+    def flush(self):
+        """Write every changed session to disk (one transaction)"""
+        with self._lock:
+            return self._save([r for r in self._records.values() if r.dirty])
+
+    def sweep(self, now=None):
+        """Finalize sessions idle for longer than the TTL, in this process or left on disk by others"""
+        now = time.time() if now is None else now
+        cutoff = now - self.ttl
+        with self._lock:
+            self.flush()
+            idle = [row[0] for row in self._conn().execute(
+                "SELECT user_id FROM sessions WHERE last_activity < ?", (cutoff,))]
+        finalized = 0
+        for user_id in idle:
+            with self._lock:
+                record = self.get(user_id)
+                if record is None or record.last_activity >= cutoff:
+                    continue
+                record = self.pop(user_id, idle_before=cutoff)
+            if record is None:
+                continue
+            finalized += 1
+            self.expired += 1
+            if self.on_expire is not None:
+                try:
+                    self.on_expire(record)
+                except Exception as e:
+                    print(f"⚠️ Failed to finalize expired session {user_id}: {e}")
+        return finalized
+
+    def stats(self):
+        with self._lock:
+            stored = self._conn().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            return {
+                "in_memory": len(self._records),
+                "unsaved": sum(1 for r in self._records.values() if r.dirty),
+                "stored": stored,
+                "expired_total": self.expired,
+                "ttl_sec": self.ttl,
+                "shared": self.shared,
+            }
+
+    # -------------------------
+    # Background flush / expiry
+    # -------------------------
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="treon-sessions", daemon=True)
+        self._thread.start()
+        print(f"💾 Session store started ({self.path}, TTL {self.ttl:.0f}s)")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.sweep()
+            except sqlite3.Error as e:
+                print(f"⚠️ Session store flush failed: {e}")
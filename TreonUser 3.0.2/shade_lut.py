@@ -0,0 +1,170 @@
+"""
+3D colour LUT shade engine
+- Each shade (BGR + finish) is baked once into a 64x64x64 BGR -> BGR table (6 bits per channel,
+  packed as one uint32 per cell, 1 MB); applying it inside the lip ROI is one gather plus the
+  same fixed-point alpha blend by the mask as lip.blend_color_int
+- Recolouring happens in CIE LAB: a lip pixel keeps its own lightness relative to the others
+  (texture, creases, shadows and highlights survive), its overall lightness moves part way to the
+  shade's, and its a/b chroma is replaced by the shade's
+- The finish shapes the result: matte flattens highlights, gloss lifts them, sheer keeps more of
+  the natural lip colour; each finish also has its own opacity
+- Baked tables live in a bounded LRU cache (ShadeLutCache) keyed by (shade hex, finish), so
+  switching between recently used shades never re-bakes; lip.set_color() bakes a new one
+  in the background before the first frame needs it
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+LUT_BITS = 6
+LUT_LEVELS = 1 << LUT_BITS
+LUT_SHIFT = 8 - LUT_BITS
+LIP_LIGHTNESS = 55.0       # typical bare-lip L*, the reference the shade's lightness is compared to
+HIGHLIGHT_FROM = 70.0      # L* above which a pixel counts as a highlight
+
+DEFAULT_FINISH = "satin"
+FINISHES = {
+    # l_pull: share of (shade L - lip L) added to every pixel, chroma: share of a/b taken from the shade,
+    # highlight: L* added (gloss) or removed (matte) at full highlight, opacity: max blend weight
+    "matte": {"l_pull": 0.6, "chroma": 1.0, "highlight": -12.0, "opacity": 0.85},
+    "satin": {"l_pull": 0.5, "chroma": 0.95, "highlight": 0.0, "opacity": 0.75},
+    "gloss": {"l_pull": 0.4, "chroma": 0.9, "highlight": 14.0, "opacity": 0.7},
+    "sheer": {"l_pull": 0.2, "chroma": 0.6, "highlight": 6.0, "opacity": 0.5},
+}
+CACHE_SIZE = max(1, int(os.environ.get("TREON_SHADE_LUT_CACHE", "32")))   # tables kept, 1 MB each
+
+
+def normalize_finish(finish):
+    finish = (finish or DEFAULT_FINISH).strip().lower()
+    return finish if finish in FINISHES else DEFAULT_FINISH
+
+def bgr_to_hex(bgr):
+    b, g, r = (int(c) for c in bgr)
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+def _lut_grid_lab():
+    """L*a*b* of the centre of every LUT cell, (LEVELS^3, 3) float32 in B-major, G, R order"""
+    centers = (np.arange(LUT_LEVELS, dtype=np.float32) * (1 << LUT_SHIFT) + ((1 << LUT_SHIFT) - 1) / 2.0) / 255.0
+    b, g, r = np.meshgrid(centers, centers, centers, indexing="ij")
+    grid = np.stack([b, g, r], axis=-1).reshape(-1, 1, 3)
+    return cv2.cvtColor(grid, cv2.COLOR_BGR2LAB).reshape(-1, 3)
+
+_grid_lab = None
+
+def bake_shade_lut(bgr, finish=DEFAULT_FINISH):
+    """(LEVELS^3,) uint32 table: lip pixel BGR (index, see lut_index) -> shaded BGRx bytes"""
+    global _grid_lab
+    if _grid_lab is None:
+        _grid_lab = _lut_grid_lab()
+    params = FINISHES[normalize_finish(finish)]
+    shade = np.array(bgr, dtype=np.float32).reshape(1, 1, 3) / 255.0
+    shade_l, shade_a, shade_b = cv2.cvtColor(shade, cv2.COLOR_BGR2LAB).reshape(3)
+
+    lab = _grid_lab.copy()
+    lightness = lab[:, 0]
+    highlight = np.clip((lightness - HIGHLIGHT_FROM) / (100.0 - HIGHLIGHT_FROM), 0.0, 1.0)
+    lightness += params["l_pull"] * (shade_l - LIP_LIGHTNESS) + params["highlight"] * highlight
+    np.clip(lightness, 0.0, 100.0, out=lightness)
+    lab[:, 1] += params["chroma"] * (shade_a - lab[:, 1])
+    lab[:, 2] += params["chroma"] * (shade_b - lab[:, 2])
+
+    out = cv2.cvtColor(lab.reshape(-1, 1, 3), cv2.COLOR_LAB2BGR).reshape(-1, 3)
+    bgrx = np.zeros((out.shape[0], 4), dtype=np.uint8)
+    bgrx[:, :3] = np.clip(out * 255.0 + 0.5, 0, 255)
+    # one uint32 per cell: a single gather per pixel instead of three
+    return bgrx.view(np.uint32).ravel()
+
+def lut_index(pixels):
+    """(..., 3) uint8 BGR -> (...) int32 LUT cells"""
+    q = pixels >> LUT_SHIFT
+    return (q[..., 0].astype(np.int32) << (2 * LUT_BITS)) | (q[..., 1].astype(np.int32) << LUT_BITS) | q[..., 2]
+
+def apply_shade_lut(out_roi, mask, lut, opacity):
+    """
+    Shade the lip ROI in place: out = src + opacity * mask * (lut[src] - src) in uint16 fixed point,
+    only where mask > 0.02 (same cut-off as the flat engines).
+    """
+    alpha = cv2.convertScaleAbs(cv2.threshold(mask, 0.02, 0, cv2.THRESH_TOZERO)[1], alpha=255.0 * opacity)
+    h, w = alpha.shape
+    shaded = cv2.cvtColor(lut.take(lut_index(out_roi)).view(np.uint8).reshape(h, w, 4), cv2.COLOR_BGRA2BGR)
+    alpha_3ch = cv2.merge([alpha, alpha, alpha])
+    weighted = cv2.multiply(out_roi, cv2.bitwise_not(alpha_3ch), dtype=cv2.CV_16U)
+    weighted = cv2.add(weighted, cv2.multiply(shaded, alpha_3ch, dtype=cv2.CV_16U))
+    cv2.copyTo(cv2.convertScaleAbs(weighted, alpha=1.0 / 255.0), alpha, out_roi)
+
+def shade_pixel(lut, bgr):
+    """The table's output for a single BGR colour (e.g. a face's mean lip colour), as a BGR tuple"""
+    px = np.clip(np.rint(np.asarray(bgr, dtype=np.float32)), 0, 255).astype(np.uint8).reshape(1, 3)
+    return tuple(int(c) for c in lut.take(lut_index(px)).view(np.uint8)[:3])
+
+
+class ShadeLutCache:
+    """
+    Thread-safe LRU of baked shade tables keyed by (hex, finish).
+    get() bakes on a miss (~tens of ms); prefetch() does that on a background thread.
+    """
+
+    def __init__(self, max_entries=CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._tables = OrderedDict()
+        self._baking = {}          # key -> Event while a bake is running
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._tables)
+
+    def get(self, bgr, finish=DEFAULT_FINISH):
+        """(lut, opacity) for a shade, baking it if needed"""
+        finish = normalize_finish(finish)
+        key = (bgr_to_hex(bgr), finish)
+        while True:
+            with self._lock:
+                lut = self._tables.get(key)
+                if lut is not None:
+                    self._tables.move_to_end(key)
+                    self.hits += 1
+                    return lut, FINISHES[finish]["opacity"]
+                event = self._baking.get(key)
+                if event is None:
+                    event = self._baking[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # someone else is baking this shade
+            event.wait()
+
+        try:
+            lut = bake_shade_lut(bgr, finish)
+            with self._lock:
+                self._tables[key] = lut
+                self._tables.move_to_end(key)
+                while len(self._tables) > self.max_entries:
+                    self._tables.popitem(last=False)
+        finally:
+            with self._lock:
+                self._baking.pop(key).set()
+        return lut, FINISHES[finish]["opacity"]
+
+    def prefetch(self, bgr, finish=DEFAULT_FINISH):
+        """Bake a shade on a background thread unless it is cached"""
+        key = (bgr_to_hex(bgr), normalize_finish(finish))
+        with self._lock:
+            if key in self._tables or key in self._baking:
+                return
+        threading.Thread(target=self.get, args=(bgr, finish), daemon=True).start()
+
+    def warm(self, shades):
+        """Bake a list of (bgr, finish) on one background thread (at most max_entries of them)"""
+        shades = list(shades)[:self.max_entries]
+        if shades:
+            threading.Thread(target=lambda: [self.get(bgr, finish) for bgr, finish in shades],
+                             daemon=True).start()
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
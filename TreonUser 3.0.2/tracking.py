@@ -0,0 +1,349 @@
+"""
+Lip landmark tracking between FaceMesh detections
+- LipTracker is one face's state: it says when the (expensive) detector is due again (every N
+  frames, or as soon as tracking confidence drops) and takes the detector's points (accept())
+- In between, the lip polygon is propagated with pyramidal Lucas-Kanade optical flow (track())
+  on a small grayscale ROI around the lips (forward-backward checked)
+- N adapts to measured lip motion: still face -> detect rarely, fast motion -> detect every frame
+- MultiLipTracker keeps one LipTracker per face with a stable face id; a single detector call
+  serves every face
+- SegMaskCache carries the last segmentation mask forward between model runs with a
+  piecewise-affine warp over the lip landmark triangulation
+"""
+
+import time
+import cv2
+import numpy as np
+
+from metrics import pipeline_metrics
+
+
+class LipTracker:
+    """
+    One face's tracking state, driven by MultiLipTracker (which runs the detector):
+        if tracker.due(): tracker.accept(frame, detected_pts)   # (N, 2) points or None
+        else: pts = tracker.track(frame)                        # (N, 2) int32, None = re-detect
+    """
+
+    def __init__(self, min_interval=1, max_interval=6, motion_low=1.0, motion_high=6.0,
+                 min_good_ratio=0.85, max_fb_error=1.0, roi_margin=32,
+                 win_size=(15, 15), max_level=2):
+        self.min_interval = min_interval      # detect at least every N frames (fast motion)
+        self.max_interval = max_interval      # ... and at most every N frames (still face)
+        self.motion_low = motion_low          # px/frame below which we use max_interval
+        self.motion_high = motion_high        # px/frame above which we use min_interval
+        self.min_good_ratio = min_good_ratio  # fraction of points that must track cleanly
+        self.max_fb_error = max_fb_error      # forward-backward error (px) for a point to count as good
+        self.roi_margin = roi_margin
+        self.lk_params = dict(
+            winSize=win_size,
+            maxLevel=max_level,
+            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03),
+        )
+        self.reset()
+
+    def reset(self):
+        self.points = None        # (N, 2) float32, frame coords
+        self.prev_gray = None     # gray crop of the previous frame at prev_box
+        self.prev_box = None      # (x0, y0, x1, y1)
+        self.frames_since_detect = 0
+        self.interval = self.min_interval
+        self.motion = 0.0         # EMA of median lip motion, px/frame
+        self.confidence = 0.0
+
+    # -------------------------
+    # Helpers
+    # -------------------------
+    def _roi_box(self, points, shape):
+        h, w = shape[:2]
+        x0 = max(int(points[:, 0].min()) - self.roi_margin, 0)
+        y0 = max(int(points[:, 1].min()) - self.roi_margin, 0)
+        x1 = min(int(points[:, 0].max()) + self.roi_margin + 1, w)
+        y1 = min(int(points[:, 1].max()) + self.roi_margin + 1, h)
+        if x1 - x0 < 8 or y1 - y0 < 8:
+            return None
+        return x0, y0, x1, y1
+
+    @staticmethod
+    def _gray_crop(frame, box):
+        x0, y0, x1, y1 = box
+        return cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+
+    def _remember(self, frame, points):
+        self.points = points.astype(np.float32)
+        self.prev_box = self._roi_box(self.points, frame.shape)
+        self.prev_gray = self._gray_crop(frame, self.prev_box) if self.prev_box is not None else None
+
+    def _update_motion(self, displacement):
+        self.motion = 0.5 * self.motion + 0.5 * displacement
+        if self.motion <= self.motion_low:
+            interval = self.max_interval
+        elif self.motion >= self.motion_high:
+            interval = self.min_interval
+        else:
+            t = (self.motion - self.motion_low) / (self.motion_high - self.motion_low)
+            interval = self.max_interval + t * (self.min_interval - self.max_interval)
+        self.interval = max(self.min_interval, int(round(interval)))
+
+    # -------------------------
+    # Detection / tracking
+    # -------------------------
+    def due(self):
+        """True when the next frame must go through the detector"""
+        return self.points is None or self.prev_gray is None or self.frames_since_detect + 1 >= self.interval
+
+    def accept(self, frame, pts):
+        """Take detector points (or None) for this frame. Returns them as float32, or None"""
+        self.frames_since_detect = 0
+        if pts is None:
+            self.reset()
+            return None
+        pts = np.asarray(pts, dtype=np.float32)
+        if self.points is not None and len(self.points) == len(pts):
+            # motion since the last known position, so cadence reacts even on detect frames
+            self._update_motion(float(np.median(np.linalg.norm(pts - self.points, axis=1))))
+        self.confidence = 1.0
+        self._remember(frame, pts)
+        return pts
+
+    def _track(self, frame):
+        """LK-propagate self.points into frame. Returns new points or None if tracking is unreliable"""
+        x0, y0, x1, y1 = self.prev_box
+        cur_gray = self._gray_crop(frame, self.prev_box)
+        if cur_gray.shape != self.prev_gray.shape:
+            return None
+
+        origin = np.array([x0, y0], dtype=np.float32)
+        p0 = (self.points - origin).reshape(-1, 1, 2)
+        p1, st1, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, cur_gray, p0, None, **self.lk_params)
+        if p1 is None:
+            return None
+        p0r, st2, _ = cv2.calcOpticalFlowPyrLK(cur_gray, self.prev_gray, p1, None, **self.lk_params)
+        if p0r is None:
+            return None
+
+        fb_error = np.linalg.norm((p0 - p0r).reshape(-1, 2), axis=1)
+        good = (st1.ravel() == 1) & (st2.ravel() == 1) & (fb_error < self.max_fb_error)
+        self.confidence = float(good.mean())
+        if self.confidence < self.min_good_ratio:
+            return None
+
+        flow = (p1 - p0).reshape(-1, 2)
+        median_flow = np.median(flow[good], axis=0)
+        # points that lost track follow the median motion of the lip polygon
+        flow[~good] = median_flow
+        self._update_motion(float(np.linalg.norm(median_flow)))
+        return self.points + flow
+
+    def track(self, frame):
+        """Optical-flow step only. Returns (N, 2) int32 points, or None when a re-detect is needed"""
+        t0 = time.perf_counter()
+        pts = self._track(frame)
+        pipeline_metrics.observe("tracking", time.perf_counter() - t0)
+        if pts is None:
+            pipeline_metrics.inc("tracking_lost_total")
+            return None
+        pipeline_metrics.inc("landmark_tracked_total")
+        self.frames_since_detect += 1
+        self._remember(frame, pts)
+        return np.rint(pts).astype(np.int32)
+
+
+class MultiLipTracker:
+    """
+    Usage: faces = tracker.update(frame, detect_fn)
+    detect_fn(frame) must return a list of (N, 2) lip point arrays, one per face found.
+    Returns [(face_id, (N, 2) int32 points), ...] sorted by id; a face keeps its id while it
+    is tracked. The detector runs once for all faces whenever any of them is due (or lost).
+    """
+
+    def __init__(self, max_faces=1, match_dist=1.5, **tracker_kwargs):
+        self.max_faces = max_faces
+        self.match_dist = match_dist          # max centroid distance, in lip widths, to keep an id
+        self.tracker_kwargs = tracker_kwargs
+        self.reset()
+
+    def reset(self):
+        self.tracks = {}                      # face_id -> LipTracker
+        self.next_id = 0
+
+    def update(self, frame, detect_fn):
+        if self.tracks and not any(t.due() for t in self.tracks.values()):
+            results = []
+            for face_id, tracker in self.tracks.items():
+                pts = tracker.track(frame)
+                if pts is None:
+                    break  # one face lost -> a single detector run refreshes all of them
+                results.append((face_id, pts))
+            else:
+                self._report_interval()
+                return results
+
+        detections = detect_fn(frame)
+        pipeline_metrics.inc("landmark_detections_total")
+        return self._assign(frame, detections[:self.max_faces])
+
+    def _assign(self, frame, detections):
+        """Greedy nearest-centroid matching of detections to tracked faces; new faces get new ids"""
+        centers = [np.asarray(d, dtype=np.float32).mean(axis=0) for d in detections]
+        pairs = []
+        for face_id, tracker in self.tracks.items():
+            if tracker.points is None:
+                continue
+            center = tracker.points.mean(axis=0)
+            limit = self.match_dist * max(float(np.ptp(tracker.points[:, 0])), 10.0)
+            for i, c in enumerate(centers):
+                dist = float(np.linalg.norm(c - center))
+                if dist <= limit:
+                    pairs.append((dist, face_id, i))
+
+        tracks = {}
+        taken = set()
+        for _, face_id, i in sorted(pairs):
+            if face_id in tracks or i in taken:
+                continue
+            tracks[face_id] = self.tracks[face_id]
+            taken.add(i)
+            tracks[face_id].accept(frame, detections[i])
+        for i, pts in enumerate(detections):
+            if i in taken:
+                continue
+            tracker = LipTracker(**self.tracker_kwargs)
+            tracker.accept(frame, pts)
+            tracks[self.next_id] = tracker
+            self.next_id += 1
+
+        self.tracks = tracks
+        pipeline_metrics.set_gauge("faces_tracked", len(tracks))
+        self._report_interval()
+        return [(face_id, np.rint(tracks[face_id].points).astype(np.int32)) for face_id in sorted(tracks)]
+
+    def _report_interval(self):
+        """The detector runs as soon as any face is due, so its cadence is the shortest interval"""
+        if self.tracks:
+            pipeline_metrics.set_gauge("detect_interval", min(t.interval for t in self.tracks.values()))
+
+
+# -------------------------
+# Segmentation mask carry-forward
+# -------------------------
+def triangulate(points, box):
+    """Delaunay triangles (T, 3) of point indices, for points in box=(x0, y0, x1, y1) (clipped to it)"""
+    x0, y0, x1, y1 = box
+    subdiv = cv2.Subdiv2D((int(x0) - 1, int(y0) - 1, int(x1 - x0) + 2, int(y1 - y0) + 2))
+    # lips running off the frame edge: insert them on the box border instead
+    points = np.clip(np.asarray(points, dtype=np.float32), (x0, y0), (x1 - 1, y1 - 1))
+    lookup = {}
+    for i, (x, y) in enumerate(points):
+        key = (float(x), float(y))
+        if key in lookup:
+            continue  # duplicate landmark (lips collapse when the mouth closes)
+        lookup[key] = i
+        subdiv.insert(key)
+    tris = []
+    for t in subdiv.getTriangleList():
+        idx = [lookup.get((float(t[0]), float(t[1]))),
+               lookup.get((float(t[2]), float(t[3]))),
+               lookup.get((float(t[4]), float(t[5])))]
+        if None not in idx:
+            tris.append(idx)
+    return np.array(tris, dtype=np.int32).reshape(-1, 3)
+
+def warp_mask_piecewise(mask, src_origin, src_pts, dst_pts, tris, dst_box, fallback):
+    """
+    Warp a float mask crop (top-left at src_origin in frame coords) so that src_pts land on dst_pts.
+    Each triangle gets its own affine; pixels outside every triangle use the 2x3 fallback
+    (dst -> src) affine. Returns the warped mask sized to dst_box.
+    """
+    x0, y0, x1, y1 = dst_box
+    bh, bw = y1 - y0, x1 - x0
+
+    # label every destination pixel with the triangle covering it (255 = none)
+    labels = np.full((bh, bw), 255, dtype=np.uint8)
+    origin = np.array([x0, y0], dtype=np.float32)
+    inverse = np.empty((len(tris) + 1, 2, 3), dtype=np.float32)
+    for t, (a, b, c) in enumerate(tris):
+        dst_tri = np.float32([dst_pts[a], dst_pts[b], dst_pts[c]])
+        src_tri = np.float32([src_pts[a], src_pts[b], src_pts[c]])
+        inverse[t] = cv2.getAffineTransform(dst_tri, src_tri)
+        cv2.fillConvexPoly(labels, np.rint(dst_tri - origin).astype(np.int32), int(t))
+    inverse[-1] = fallback
+    labels[labels == 255] = len(tris)
+
+    # per-pixel dst -> src coordinates in one vectorized pass, then a single remap
+    ys, xs = np.mgrid[y0:y1, x0:x1].astype(np.float32)
+    A = inverse[labels]
+    map_x = A[..., 0, 0] * xs + A[..., 0, 1] * ys + A[..., 0, 2] - src_origin[0]
+    map_y = A[..., 1, 0] * xs + A[..., 1, 1] * ys + A[..., 1, 2] - src_origin[1]
+    return cv2.remap(mask, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+
+class SegMaskCache:
+    """
+    Keeps the last segmentation mask with the lip landmarks it was computed for.
+    needs_refresh() says when the model has to run again (every `interval` frames, or when
+    the lips moved / deformed past a threshold); warp_to() carries the cached mask
+    onto the current landmarks in between.
+    """
+
+    def __init__(self, interval=4, move_thresh=12.0, deform_thresh=0.06):
+        self.interval = interval            # run the model at least every N frames
+        self.move_thresh = move_thresh      # px of lip centroid motion since the model ran
+        self.deform_thresh = deform_thresh  # RMS shape change (after similarity alignment) / lip width
+        self.clear()
+
+    def clear(self):
+        self.mask = None
+        self.box = None
+        self.pts = None
+        self.tris = None
+        self.age = 0
+
+    def _alignment(self, pts):
+        """Similarity transform cached pts -> pts, plus (motion px, deformation ratio)"""
+        src = self.pts.astype(np.float32)
+        dst = pts.astype(np.float32)
+        M, _ = cv2.estimateAffinePartial2D(src, dst)
+        if M is None:
+            return None, float("inf"), float("inf")
+        aligned = src @ M[:, :2].T + M[:, 2]
+        width = max(float(np.ptp(dst[:, 0])), 1.0)
+        deform = float(np.sqrt(np.mean(np.sum((aligned - dst) ** 2, axis=1)))) / width
+        motion = float(np.linalg.norm(dst.mean(axis=0) - src.mean(axis=0)))
+        return M, motion, deform
+
+    def needs_refresh(self, pts):
+        if self.mask is None or pts is None or len(pts) != len(self.pts):
+            return True
+        if self.age + 1 >= self.interval:
+            return True
+        _, motion, deform = self._alignment(pts)
+        return motion > self.move_thresh or deform > self.deform_thresh
+
+    def store(self, mask, box, pts):
+        self.mask = mask.astype(np.float32)
+        self.box = box
+        self.pts = np.asarray(pts, dtype=np.float32)
+        self.age = 0
+        x0, y0, x1, y1 = box
+        corners = np.float32([[x0, y0], [x1 - 1, y0], [x1 - 1, y1 - 1], [x0, y1 - 1]])
+        self.tris = triangulate(np.vstack([self.pts, corners]), box)
+
+    def warp_to(self, pts, box):
+        """Cached mask warped onto the current landmarks, sized to box; None if it can't be warped"""
+        if self.mask is None or pts is None or len(pts) != len(self.pts):
+            return None
+        M, _, _ = self._alignment(pts)
+        if M is None:
+            return None
+        pts = np.asarray(pts, dtype=np.float32)
+
+        # box corners ride along with the overall (similarity) lip motion
+        x0, y0, x1, y1 = self.box
+        corners = np.float32([[x0, y0], [x1 - 1, y0], [x1 - 1, y1 - 1], [x0, y1 - 1]])
+        src_pts = np.vstack([self.pts, corners])
+        dst_pts = np.vstack([pts, corners @ M[:, :2].T + M[:, 2]])
+
+        fallback = cv2.invertAffineTransform(M)
+        self.age += 1
+        return warp_mask_piecewise(self.mask, (x0, y0), src_pts, dst_pts, self.tris, box, fallback)
@@ -0,0 +1,233 @@
+"""
+WebRTC transport for the TREON try-on feed (optional, needs aiortc: pip install aiortc)
+- Sends the same processed frames as /video_feed (lip.frame_hub) as H.264 or VP8 video,
+  one RTCPeerConnection per viewer, so the tablet gets inter-frame compression instead of a JPEG per frame
+- aiortc runs on its own asyncio loop thread; Flask handlers call WebRTCStreamer.offer() synchronously
+- Encoder time, bytes sent and capture -> encoded latency per frame go to metrics.stream_stats,
+  next to the MJPEG numbers (see /stream_stats in app.py)
+
+Without aiortc installed (or with TREON_WEBRTC=0) the streamer reports itself unavailable
+and script.js stays on MJPEG.
+"""
+
+import os
+import time
+import asyncio
+import fractions
+import threading
+import importlib.util
+
+from metrics import pipeline_metrics, stream_stats
+
+AIORTC_AVAILABLE = importlib.util.find_spec("aiortc") is not None
+WEBRTC_ENABLED = os.environ.get("TREON_WEBRTC", "1").strip().lower() in ("1", "true", "yes", "on")
+# "h264", "vp8" or "auto" (let the browser pick from everything aiortc offers)
+WEBRTC_CODEC = os.environ.get("TREON_WEBRTC_CODEC", "h264").strip().lower()
+WEBRTC_MAX_PEERS = max(1, int(os.environ.get("TREON_WEBRTC_MAX_PEERS", "4")))
+
+VIDEO_CLOCK_RATE = 90000             # RTP video clock
+CLOCK_BASE = time.perf_counter()     # frame pts are perf_counter() capture times relative to this
+
+
+# -------------------------
+# Encoder instrumentation
+# -------------------------
+class TimedEncoder:
+    """Wraps an aiortc video encoder: encode time, payload bytes and capture -> encoded latency to stream_stats"""
+
+    def __init__(self, encoder):
+        self.__dict__["_encoder"] = encoder
+
+    def encode(self, frame, force_keyframe=False):
+        captured_at = None
+        if frame.pts is not None and frame.time_base:
+            captured_at = CLOCK_BASE + float(frame.pts * frame.time_base)
+        t0 = time.perf_counter()
+        payloads, timestamp = self._encoder.encode(frame, force_keyframe)
+        now = time.perf_counter()
+        stream_stats.observe_encode("webrtc", now - t0)
+        stream_stats.add_bytes("webrtc", sum(len(p) for p in payloads))
+        if captured_at is not None:
+            stream_stats.observe_latency("webrtc", now - captured_at)
+        return payloads, timestamp
+
+    def pack(self, packet):
+        return self._encoder.pack(packet)
+
+    # target_bitrate (set from REMB feedback) and anything else go to the real encoder
+    def __getattr__(self, name):
+        return getattr(self._encoder, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._encoder, name, value)
+
+def install_encoder_timing():
+    """Route aiortc's per-sender encoder creation through TimedEncoder (video only, once)"""
+    import aiortc.rtcrtpsender as rtcrtpsender
+    original = rtcrtpsender.get_encoder
+    if getattr(original, "treon_timed", False):
+        return
+
+    def get_encoder(codec):
+        encoder = original(codec)
+        return TimedEncoder(encoder) if codec.mimeType.lower().startswith("video/") else encoder
+
+    get_encoder.treon_timed = True
+    rtcrtpsender.get_encoder = get_encoder
+
+
+# -------------------------
+# Hub -> WebRTC video track
+# -------------------------
+_track_class = None
+
+def hub_track_class():
+    """MediaStreamTrack subclass reading processed frames from a FrameHub (defined lazily: aiortc is optional)"""
+    global _track_class
+    if _track_class is not None:
+        return _track_class
+
+    import av
+    from aiortc import MediaStreamTrack
+    from aiortc.mediastreams import MediaStreamError
+
+    class HubVideoTrack(MediaStreamTrack):
+        kind = "video"
+
+        def __init__(self, hub):
+            super().__init__()
+            self.hub = hub
+            self.last_seq = 0
+            self.attached = True
+            hub.attach()
+
+        async def recv(self):
+            loop = asyncio.get_running_loop()
+            while True:
+                if self.readyState != "live":
+                    raise MediaStreamError
+                item = await loop.run_in_executor(None, self.hub.wait_frame, self.last_seq, 1.0)
+                if item is not None:
+                    break
+            seq, frame, captured_at = item
+            if self.last_seq and seq - self.last_seq > 1:
+                pipeline_metrics.inc("webrtc_frames_skipped_total", seq - self.last_seq - 1)
+            self.last_seq = seq
+            video_frame = av.VideoFrame.from_ndarray(frame, format="bgr24")
+            video_frame.pts = int((captured_at - CLOCK_BASE) * VIDEO_CLOCK_RATE)
+            video_frame.time_base = fractions.Fraction(1, VIDEO_CLOCK_RATE)
+            return video_frame
+
+        def stop(self):
+            super().stop()
+            if self.attached:
+                self.attached = False
+                self.hub.detach()
+
+    _track_class = HubVideoTrack
+    return _track_class
+
+
+# -------------------------
+# Signaling / peer management
+# -------------------------
+class WebRTCStreamer:
+    """
+    Usage (from a Flask handler):
+        answer = streamer.offer(sdp, "offer")   # {"sdp": ..., "type": "answer"}
+    Raises RuntimeError when WebRTC is unavailable or the peer limit is reached.
+    """
+
+    def __init__(self, hub, codec=WEBRTC_CODEC, max_peers=WEBRTC_MAX_PEERS):
+        self.hub = hub
+        self.codec = codec
+        self.max_peers = max_peers
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._peers = set()
+
+    @property
+    def available(self):
+        return AIORTC_AVAILABLE and WEBRTC_ENABLED
+
+    @property
+    def peer_count(self):
+        return len(self._peers)
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                install_encoder_timing()
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="treon-webrtc", daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def offer(self, sdp, kind="offer", timeout=10.0):
+        if not self.available:
+            raise RuntimeError("WebRTC is not available (install aiortc or set TREON_WEBRTC=1)")
+        if len(self._peers) >= self.max_peers:
+            raise RuntimeError(f"Too many WebRTC viewers (max {self.max_peers})")
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self._offer(sdp, kind), loop).result(timeout)
+
+    async def _offer(self, sdp, kind):
+        from aiortc import RTCPeerConnection, RTCSessionDescription, RTCRtpSender
+
+        pc = RTCPeerConnection()
+        self._peers.add(pc)
+        self._update_gauges()
+
+        @pc.on("connectionstatechange")
+        async def on_connectionstatechange():
+            if pc.connectionState in ("failed", "closed"):
+                await self._close_peer(pc)
+
+        try:
+            # track + codec preference go in before the offer is applied: aiortc negotiates
+            # codecs in setRemoteDescription and reuses this transceiver for the video m-line
+            sender = pc.addTrack(hub_track_class()(self.hub))
+            if self.codec in ("h264", "vp8"):
+                codecs = [c for c in RTCRtpSender.getCapabilities("video").codecs
+                          if c.mimeType.lower() in (f"video/{self.codec}", "video/rtx")]
+                transceiver = next(t for t in pc.getTransceivers() if t.sender == sender)
+                transceiver.setCodecPreferences(codecs)
+            await pc.setRemoteDescription(RTCSessionDescription(sdp=sdp, type=kind))
+            answer = await pc.createAnswer()
+            await pc.setLocalDescription(answer)
+        except Exception:
+            await self._close_peer(pc)
+            raise
+        print(f"📡 WebRTC viewer connected ({self.codec}, {len(self._peers)} peer(s))")
+        return {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
+
+    async def _close_peer(self, pc):
+        if pc not in self._peers:
+            return
+        self._peers.discard(pc)
+        for sender in pc.getSenders():
+            if sender.track is not None:
+                sender.track.stop()
+        await pc.close()
+        self._update_gauges()
+        print(f"📡 WebRTC viewer left ({len(self._peers)} peer(s))")
+
+    def _update_gauges(self):
+        pipeline_metrics.set_gauge("webrtc_peers", len(self._peers))
+        stream_stats.set_viewers("webrtc", len(self._peers))
+
+    def close(self):
+        """Close every peer connection and stop the loop (atexit)"""
+        if self._loop is None:
+            return
+
+        async def close_all():
+            for pc in list(self._peers):
+                await self._close_peer(pc)
+
+        try:
+            asyncio.run_coroutine_threadsafe(close_all(), self._loop).result(5.0)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)